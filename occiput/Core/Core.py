@@ -20,6 +20,9 @@ from occiput import global_settings
 from occiput.global_settings import printoptions
 from occiput.Core.NiftyCore_wrap import transform_grid, grid_from_box_and_affine, resample_image_on_grid
 from occiput.Core.Conversion import nipy_to_occiput, nifti_to_occiput, occiput_to_nifti, occiput_from_array
+from occiput.Core.SharedMemory import to_shared, is_shared
+from occiput.Core.Resampling import is_axis_aligned, resample_axis_aligned, INTERPOLATION_LINEAR, INTERPOLATION_POINT
+from occiput.Core.Smoothing import gaussian_smoothing, sigma_world_to_voxels
 
 
 
@@ -279,12 +282,39 @@ class Transform_6DOF(Transform_Affine):
         tra = tr.translation_matrix(translation) 
         mat = numpy.dot(tra,rot)
         Transform_Affine.__init__(self, mat,map_from,map_to) 
+        self.rotation_point = rotation_point 
 
     def derivative_parameters(self, gradient_transformed_image, grid_transformed_image ): 
-        dRx = []
-        dRy = []
-        dRz = []
-        return [0,0,0,0,0,0]
+        """Derivatives of the intensity of the transformed image at the points of the grid with respect to 
+        [tx,ty,tz,rx,ry,rz]: translation and rotation about the x, y and z axes through the transformed rotation 
+        point, composed with the transformation (see derivative_rigid_parameters()). """
+        point = numpy.zeros(3) 
+        if self.rotation_point is not None: 
+            point = numpy.float64(self.rotation_point)[0:3] 
+        point = self.data[0:3,0:3].dot(point) + self.data[0:3,3] 
+        return derivative_rigid_parameters(gradient_transformed_image, grid_transformed_image, point) 
+
+
+
+def derivative_rigid_parameters(gradient, points, rotation_point=None): 
+    """Derivatives (array [6,n_1,..,n_N]) of the intensity of a transformed image at the given points with respect to 
+    the parameters [tx,ty,tz,rx,ry,rz] of a small rigid transformation applied to the image: translation and 
+    rotation [rad] about the x, y and z axes through 'rotation_point'. 'gradient' is the spatial gradient of the 
+    transformed image at the points (list of 3 arrays or array [n_1,..,n_N,3]), 'points' their coordinates 
+    (array [n_1,..,n_N,3] or GridND). Moving the image by dT changes the intensity at p by -gradient.(dT p). """
+    if isinstance(gradient,(list,tuple)): 
+        gradient = numpy.concatenate([numpy.asarray(g)[...,None] for g in gradient], axis=-1) 
+    if isinstance(points,GridND): 
+        points = points.data 
+    gradient = numpy.float32(gradient) 
+    v = numpy.float32(points) 
+    if rotation_point is not None: 
+        v = v - numpy.float32(rotation_point) 
+    derivatives = numpy.empty((6,)+gradient.shape[0:-1], dtype=numpy.float32) 
+    derivatives[0:3] = -numpy.rollaxis(gradient,-1) 
+    # rotation about axis k: displacement e_k x v, derivative -gradient.(e_k x v) = -(v x gradient)_k 
+    derivatives[3:6] = -numpy.rollaxis(numpy.cross(v,gradient),-1) 
+    return derivatives 
         
 
 
@@ -293,23 +323,70 @@ class Transform_6DOF(Transform_Affine):
 
 
 class GridND(object):
-    def __init__(self, data=None, space="", is_uniform=True, is_affine=True, is_axis_aligned=True): 
+    def __init__(self, data=None, space="", is_uniform=True, is_affine=True, is_axis_aligned=True, shape=None, affine=None): 
+        """Grid of points. The grid is either explicit - 'data' is the array of the coordinates of the points, of shape 
+        [n_1,..,n_N,N] - or implicit: the points are the affine transformation 'affine' (array (N+1)x(N+1)) of the 
+        lattice of indexes of shape 'shape'. The coordinates of an implicit grid are computed only when 'data' is 
+        accessed; get_slab() computes them one slab at a time. """
         self.ndim = None
-        self.__set_data(data)
+        self.__affine = None 
+        self.__grid_shape = None 
+        if affine is not None: 
+            self.__set_implicit(shape, affine)
+        else: 
+            self.__set_data(data)
         self.space = space 
         self.__clear_cache() 
         self.__is_uniform = is_uniform 
         self.__is_affine  = is_affine 
         self.__is_axis_aligned = is_axis_aligned 
+        if self.is_implicit(): 
+            self.__is_uniform = True 
+            self.__is_affine  = True 
+            A = self.__affine[0:self.ndim,0:self.ndim] 
+            self.__is_axis_aligned = bool((A == numpy.diag(numpy.diag(A))).all()) 
+
+    def is_implicit(self): 
+        """Returns True if the grid is defined by shape and affine (the coordinates are computed on demand). """
+        return self.__affine is not None 
+
+    def get_affine(self): 
+        """Affine transformation from the indexes to the coordinates of the points (implicit grids), None for explicit grids. """
+        return self.__affine 
+
+    def get_grid_shape(self): 
+        """Number of points along each axis. """
+        if self.is_implicit(): 
+            return tuple(self.__grid_shape) 
+        return self.data.shape[0:self.ndim] 
+
+    def get_slab(self, start, stop): 
+        """Coordinates of the points with first index in [start,stop), array of shape [stop-start,n_2,..,n_N,N]. """
+        if not self.is_implicit(): 
+            return self.data[start:stop]
+        return _affine_grid_coordinates(self.__grid_shape, self.__affine, start, stop) 
+
+    def iter_slabs(self, slab_size): 
+        """Iterate over the grid in slabs of slab_size points along the first axis: yields (start, stop, coordinates). """
+        n = self.get_grid_shape()[0] 
+        for start in range(0, n, max(1,int(slab_size))): 
+            stop = min(start+int(slab_size), n)
+            yield start, stop, self.get_slab(start, stop) 
 
     def min(self): 
         if self.__min  is None: 
-            self.__min = eval('self.data%s'%('.min(0)'*self.ndim))
+            if self.is_implicit(): 
+                self.__min = self.corners().min(1)
+            else: 
+                self.__min = self.data.reshape((-1,self.ndim)).min(0)
         return self.__min
 
     def max(self): 
         if self.__max  is None:
-            self.__max = eval('self.data%s'%('.max(0)'*self.ndim))
+            if self.is_implicit(): 
+                self.__max = self.corners().max(1)
+            else: 
+                self.__max = self.data.reshape((-1,self.ndim)).max(0)
         return self.__max 
 
     def span(self): 
@@ -319,12 +396,11 @@ class GridND(object):
 
     def center(self,use_corners_only=True): 
         if self.__center  is None or (self.__use_corners_only != use_corners_only): 
-            if use_corners_only: 
+            if use_corners_only or self.is_implicit(): 
                 corners = self.corners()
                 center = corners.mean(1)
             else: 
-                center = None 
-                #FIXME: implement 
+                center = self.data.reshape((-1,self.ndim)).mean(0)
             self.__center = center
             self.__use_corners_only = use_corners_only
         return self.__center
@@ -346,7 +422,7 @@ class GridND(object):
         return self.__mean_dist_center
         
     def get_shape(self):
-        return self.data.shape
+        return self.__get_shape() 
 
     def is_uniform(self): 
         """Returns True if the grid is uniform. """
@@ -367,33 +443,49 @@ class GridND(object):
     def corners(self, homogeneous_coords=False): 
         if self.__corners  is None: 
             n_corners = 2**self.ndim 
-            corners = []
-            for i in range(n_corners): 
-                b = eval( '['+bin(i)[2:].zfill(self.ndim).replace('0','0,').replace('1','1,') +"]" )
-                b = (numpy.asarray(self.data.shape[0:self.ndim])-1) * numpy.asarray(b)
-                s = str(b.tolist())[1:-1]
-                corner = eval('self.data[%s,:]'%s)
-                corners.append(corner)
-            corners = numpy.asarray(corners).transpose() 
-            if homogeneous_coords: 
-                corners2 = numpy.ones((4,n_corners))
-                corners2[0:3,:] = corners
-                corners = corners2
+            shape = numpy.asarray(self.get_grid_shape()) 
+            # index of corner i: bit k of i selects the first or the last point along axis k 
+            indexes = numpy.asarray([[(i>>(self.ndim-1-k))&1 for k in range(self.ndim)] for i in range(n_corners)]) * (shape-1) 
+            if self.is_implicit(): 
+                A = self.__affine 
+                corners = A[0:self.ndim,0:self.ndim].dot(indexes.transpose()) + A[0:self.ndim,self.ndim].reshape((self.ndim,1))
+            else: 
+                corners = numpy.asarray([self.data[tuple(index)] for index in indexes]).transpose() 
             self.__corners = corners
-        return self.__corners
+        corners = self.__corners 
+        if homogeneous_coords: 
+            corners2 = numpy.ones((self.ndim+1,corners.shape[1]))
+            corners2[0:self.ndim,:] = corners
+            corners = corners2
+        return corners
 
     def __get_data(self):
+        if self.__data is None and self.is_implicit(): 
+            self.__data = _affine_grid_coordinates(self.__grid_shape, self.__affine) 
         return self.__data 
     
     def __set_data(self,data): 
         self.__data = data
+        self.__affine = None 
+        self.__grid_shape = None 
         if data is not None: 
             self.ndim = self.data.ndim-1 
         else: 
             self.ndim = None
         self.__clear_cache() 
+
+    def __set_implicit(self, shape, affine): 
+        if isinstance(affine,Transform_Affine): 
+            affine = affine.data 
+        self.__data = None 
+        self.__grid_shape = tuple(int(n) for n in shape) 
+        self.__affine = numpy.float64(affine) 
+        self.ndim = len(self.__grid_shape) 
+        self.__clear_cache() 
         
     def __get_shape(self): 
+        if self.is_implicit(): 
+            return tuple(self.__grid_shape) + (self.ndim,) 
         return self.data.shape 
     
     def __clear_cache(self): 
@@ -463,12 +555,34 @@ class GridND(object):
 
     
 class Grid3D(GridND):
-    def __init__(self, data=None, space=""): 
-        GridND.__init__(self, data, space)
+    def __init__(self, data=None, space="", shape=None, affine=None): 
+        GridND.__init__(self, data, space, shape=shape, affine=affine)
         self.ndim = 3
 
 
 
+def _affine_grid_coordinates(shape, affine, start=0, stop=None): 
+    """Coordinates of the affine grid (shape, affine) for first index in [start,stop): array [stop-start,n_2,..,n_N,N]. """
+    ndim = len(shape) 
+    if stop is None: 
+        stop = shape[0] 
+    shape = [stop-start] + list(shape[1:]) 
+    axes = [] 
+    for k in range(ndim): 
+        index = numpy.arange(shape[k], dtype=numpy.float64) + (start if k==0 else 0) 
+        s = [1]*ndim 
+        s[k] = shape[k] 
+        axes.append(index.reshape(s)) 
+    coordinates = numpy.empty(shape+[ndim], dtype=numpy.float32) 
+    for j in range(ndim): 
+        c = affine[j,ndim] 
+        for k in range(ndim): 
+            c = c + affine[j,k]*axes[k] 
+        coordinates[...,j] = c 
+    return coordinates 
+
+
+
 
 
 
@@ -589,6 +703,15 @@ class ImageND(object):
     def copy(self): 
         return copy.copy(self)
 
+    def share_memory(self): 
+        """Move the data to shared memory (see occiput.Core.SharedMemory): the image then pickles as a lightweight 
+        handle and can be exchanged with worker processes without copying the data. """
+        self.data = to_shared(self.data) 
+        return self 
+
+    def is_shared_memory(self): 
+        return is_shared(self.data) 
+
     shape = property(__get_shape)
     size  = property(__get_size)
 
@@ -604,17 +727,54 @@ class Image3D(ImageND):
         return Image3D(data=resampled_data) #FIXME: perhaps just return the raw resampled data
     
     def compute_resample_in_box(self,box_min,box_max,box_n): 
-        pass 
+        """Resample the image on a regular grid of box_n points from box_min to box_max (included), in the space 
+        of the image. Returns an Image3D whose affine maps its indexes to the space of the image. """
+        grid = grid_from_box_and_affine(box_min, box_max, box_n, space=self.space) 
+        return self._resample_on_affine_grid(grid.get_grid_shape(), grid.get_affine(), self.space) 
 
     def compute_resample_in_space_of_image(self,image): 
-        pass 
+        """Resample the image on the voxels of 'image'. Returns an Image3D with the shape, the affine and the space 
+        of 'image'. """
+        if image.space != self.space: 
+            print "The images are not in the same space. "
+            #FIXME: raise exception
+            return 
+        return self._resample_on_affine_grid(image.shape, image.affine.data, image.space) 
+
+    def lazy(self): 
+        """Lazy view of the image (see LazyImage3D): transformations and resamplings are accumulated and the data 
+        is interpolated once, when it is requested. """
+        return LazyImage3D(self) 
+
+    def _resample_on_affine_grid(self, shape, affine_grid, space): 
+        # If the map from the indexes of the grid to the indexes of the image is axis-aligned (scaling and 
+        # translation), interpolate along one axis at a time; otherwise resample on the full grid. 
+        affine_grid = numpy.float64(affine_grid) 
+        index_to_index = numpy.linalg.inv(numpy.float64(self.affine.data)).dot(affine_grid) 
+        if is_axis_aligned(index_to_index): 
+            if self.is_mask(): 
+                interpolation_mode = INTERPOLATION_POINT 
+            else: 
+                interpolation_mode = INTERPOLATION_LINEAR 
+            resampled_data = resample_axis_aligned(self.data, index_to_index, shape, self.background, interpolation_mode) 
+        else: 
+            grid = Grid3D(space=space, shape=shape, affine=affine_grid) 
+            resampled_data = resample_image_on_grid(self, grid, None, False, self.background, self.use_gpu) 
+        resampled = Image3D(data=resampled_data, affine=Transform_Affine(affine_grid.copy()), space=space) 
+        resampled.set_mask_flag(self.is_mask()) 
+        resampled.background = self.background 
+        return resampled 
 
     def compute_gradient_on_grid(self, grid, affine_grid_to_world=None, verify_mapping=True): 
+        return self.compute_resample_and_gradient_on_grid(grid, affine_grid_to_world, verify_mapping)[1] 
+
+    def compute_resample_and_gradient_on_grid(self, grid, affine_grid_to_world=None, verify_mapping=True): 
+        """Resample the image on the grid and compute the gradient of the resampled image (with respect to the 
+        indexes of the grid) from the same resampling. Returns the resampled Image3D and the list of the 
+        components of the gradient. """
         resampled_data = resample_image_on_grid(self, grid, affine_grid_to_world, verify_mapping, self.background, self.use_gpu)
-        # create new Image3D object
-        #print resampled_data.max()
         gradient_data = numpy.gradient(resampled_data) #FIXME: use NiftyCore
-        return gradient_data
+        return Image3D(data=resampled_data), gradient_data 
         
     def compute_gradient_in_box(self,box): 
         pass 
@@ -626,8 +786,13 @@ class Image3D(ImageND):
         gradient_data = numpy.gradient(self.data)  #FIXME: use NiftyCore
         return gradient_data
 
-    def compute_smoothed(self, smoothing): 
-        pass 
+    def compute_smoothed(self, smoothing, n_threads=None): 
+        """Smooth the image with a Gaussian kernel; 'smoothing' is the standard deviation in the units of the space 
+        of the image (e.g. mm), scalar or one value per axis. Returns a new Image3D. """
+        sigma = sigma_world_to_voxels(smoothing, self.affine.data) 
+        smoothed = Image3D(data=gaussian_smoothing(self.data, sigma, n_threads=n_threads), affine=self.affine.data.copy(), space=self.space) 
+        smoothed.set_mask_flag(self.is_mask()) 
+        return smoothed 
 
     def get_data(self):
         return self.data 
@@ -687,11 +852,131 @@ class Image3D(ImageND):
 
 
 
+class LazyImage3D(object): 
+    """Lazy view of an Image3D. transform() composes affine transformations and the compute_resample_* methods record 
+    the grid on which the image is resampled; nothing is interpolated until the data is requested (get_data(), 
+    'data' or compute()). The data is then obtained from the original image with a single resampling, instead of 
+    one interpolation (and one loss of resolution) per step. The methods that resample return a new lazy view. 
+    Resampling a view that is already resampled on an implicit grid keeps the crop of the previous grid: the points 
+    outside of its box take the background value, as if the image had been resampled twice. Views resampled on an 
+    explicit grid are computed before they are resampled again. """
+    def __init__(self, image, transformation=None, grid=None, grid_transformation=None, supports=None): 
+        self.image = image 
+        self.space = image.space 
+        if transformation is None: 
+            transformation = numpy.eye(4) 
+        if grid_transformation is None: 
+            grid_transformation = numpy.eye(4) 
+        if supports is None: 
+            supports = [] 
+        self.__transformation = numpy.float64(transformation) 
+        self.__grid = grid 
+        self.__grid_transformation = numpy.float64(grid_transformation) 
+        # boxes of the previous grids: (affine from the indexes of the grid to the space of the view, shape) 
+        self.__supports = list(supports) 
+        self.__computed = None 
+
+    def transform(self, affine): 
+        """Transform the image (and the grid it is resampled on) by 'affine', as ImageND.transform(). """
+        if not isinstance(affine,Transform_Affine): 
+            raise TypeError("Transformation must be an instance of Transform_Affine. ") 
+        T = numpy.float64(affine.data) 
+        self.__transformation = T.dot(self.__transformation) 
+        self.__grid_transformation = T.dot(self.__grid_transformation) 
+        self.__supports = [(T.dot(S),shape) for (S,shape) in self.__supports] 
+        self.space = affine.map_to 
+        self.__computed = None 
+
+    def compute_resample_on_grid(self, grid, affine_grid_to_world=None, verify_mapping=True): 
+        """Lazy view of the image resampled on 'grid', as Image3D.compute_resample_on_grid(): 'affine_grid_to_world' 
+        (optional) is composed with the affine of the image, i.e. the grid is moved by its inverse. """
+        grid_transformation = numpy.eye(4) 
+        if affine_grid_to_world is not None: 
+            if verify_mapping and not (affine_grid_to_world.can_left_multiply(grid) and affine_grid_to_world.map_to == self.space): 
+                raise ValueError("grid, affine_grid_to_world and image are not compatible. ") 
+            grid_transformation = numpy.linalg.inv(numpy.float64(affine_grid_to_world.data)) 
+        elif verify_mapping and grid.space != self.space: 
+            raise ValueError("grid and image are not compatible. ") 
+        if self.__grid is None: 
+            return LazyImage3D(self.image, self.__transformation, grid, grid_transformation, self.__supports) 
+        if not self.__grid.is_implicit(): 
+            return self.compute().lazy().compute_resample_on_grid(grid, affine_grid_to_world, False) 
+        support = (self.__grid_transformation.dot(self.__grid.get_affine()), tuple(self.__grid.get_grid_shape())) 
+        return LazyImage3D(self.image, self.__transformation, grid, grid_transformation, self.__supports+[support]) 
+
+    def compute_resample_in_box(self, box_min, box_max, box_n): 
+        return self.compute_resample_on_grid(grid_from_box_and_affine(box_min, box_max, box_n, space=self.space)) 
+
+    def compute_resample_in_space_of_image(self, image): 
+        if image.space != self.space: 
+            raise ValueError("The images are not in the same space. ") 
+        return self.compute_resample_on_grid(Grid3D(space=image.space, shape=image.shape, affine=image.affine.data)) 
+
+    def get_transformation(self): 
+        """Transformation accumulated since the view was created (4x4 array). """
+        return self.__transformation 
+
+    def is_computed(self): 
+        return self.__computed is not None 
+
+    def compute(self): 
+        """Image3D obtained by resampling the original image once. """
+        if self.__computed is not None: 
+            return self.__computed 
+        image = self.image 
+        affine = self.__transformation.dot(numpy.float64(image.affine.data)) 
+        if self.__grid is None: 
+            # no resampling: only the affine changes 
+            computed = Image3D(data=image.data, affine=Transform_Affine(affine), space=self.space) 
+            computed.set_mask_flag(image.is_mask()) 
+        else: 
+            source = Image3D(data=image.data, space=self.space, affine=Transform_Affine(affine)) 
+            source.set_mask_flag(image.is_mask()) 
+            source.background = image.background 
+            source.use_gpu = image.use_gpu 
+            if self.__grid.is_implicit(): 
+                grid_affine = self.__grid_transformation.dot(self.__grid.get_affine()) 
+                computed = source._resample_on_affine_grid(self.__grid.get_grid_shape(), grid_affine, self.space) 
+                if self.__supports: 
+                    self.__crop(computed.data, _affine_grid_coordinates(self.__grid.get_grid_shape(), grid_affine), image) 
+            else: 
+                # explicit grid: express the image in the space of the (untransformed) grid 
+                source.affine = Transform_Affine(numpy.linalg.inv(self.__grid_transformation).dot(affine), map_from="index", map_to=self.__grid.space) 
+                computed = Image3D(data=resample_image_on_grid(source, self.__grid, None, False, source.background, source.use_gpu)) 
+                if self.__supports: 
+                    points = numpy.dot(numpy.float64(self.__grid.data), self.__grid_transformation[0:3,0:3].T) + self.__grid_transformation[0:3,3] 
+                    self.__crop(computed.data, points, image) 
+        self.__computed = computed 
+        return computed 
+
+    def __crop(self, data, points, image): 
+        # points (in the space of the view) outside of the box of a previous grid take the background value 
+        outside = numpy.zeros(data.shape,dtype=bool) 
+        for S, shape in self.__supports: 
+            S = numpy.linalg.inv(S) 
+            indexes = numpy.dot(points, S[0:3,0:3].T) + S[0:3,3] 
+            if image.is_mask(): 
+                low, high = -0.5, numpy.float64(shape)-0.5 
+            else: 
+                low, high = -1e-6, numpy.float64(shape)-1+1e-6 
+            outside |= ((indexes < low) | (indexes > high)).any(-1) 
+        data[outside] = image.background 
 
+    def get_data(self): 
+        return self.compute().data 
 
+    def __get_affine(self): 
+        return self.compute().affine 
 
+    def __get_shape(self): 
+        if self.__grid is None: 
+            return self.image.shape 
+        return tuple(self.__grid.get_grid_shape()) 
 
+    def __repr__(self): 
+        return "Lazy view of %s (%s)"%(repr(self.image), "computed" if self.is_computed() else "not computed") 
 
-
-
+    data   = property(get_data) 
+    affine = property(__get_affine) 
+    shape  = property(__get_shape) 
 
@@ -12,6 +12,10 @@
 
 import occiput as __occiput
 import numpy as __np
+import multiprocessing as __multiprocessing
+import threading as __threading
+from multiprocessing.pool import ThreadPool as __ThreadPool
+from occiput.Core.Resampling import TR_resample_grid_batch as __TR_resample_grid_batch
 try:
     from NiftyCore.NiftyRec import INTERPOLATION_LINEAR, INTERPOLATION_POINT
     from NiftyCore.NiftyRec import TR_resample_grid as             __TR_resample_grid 
@@ -24,19 +28,27 @@ try:
 except: 
     print "NiftyCore could not be loaded: it will not be possible to reconstruct the PET data. "
     has_NiftyCore = False
+    # CPU implementation of the grid functions 
+    from occiput.Core.Resampling import INTERPOLATION_LINEAR, INTERPOLATION_POINT
+    from occiput.Core.Resampling import TR_resample_grid as             __TR_resample_grid 
+    from occiput.Core.Resampling import TR_grid_from_box_and_affine as  __TR_grid_from_box_and_affine 
+    from occiput.Core.Resampling import TR_transform_grid as            __TR_transform_grid 
     PET_project_compressed = None
     PET_backproject_compressed = None
     SPECT_project_parallelholes = None
     SPECT_backproject_parallelholes = None 
 
+# serializes the calls to the GPU 
+__gpu_lock = __threading.Lock() 
+
 
 ## Transformation 
 
-def __make_grid(data,space,ndim):
+def __make_grid(data,space,ndim,shape=None,affine=None):
     if ndim==3: 
-        return __occiput.Core.Grid3D(data,space)
+        return __occiput.Core.Grid3D(data,space,shape=shape,affine=affine)
     else: 
-        return __occiput.Core.GridND(data,space)
+        return __occiput.Core.GridND(data,space,shape=shape,affine=affine)
 
 
 
@@ -45,7 +57,10 @@ def transform_grid(grid, affine_from_grid):
     if not affine_from_grid.can_left_multiply(grid): 
         print "Affine transformation not compatible with grid. " 
         # FIXME: raise error, or warning, depending on a global setting 
-    # 2) transform 
+    # 2) transform: the transformation of an implicit grid is implicit 
+    if grid.is_implicit(): 
+        affine = __compose_affine(affine_from_grid.data, grid.get_affine(), grid.ndim) 
+        return __make_grid(None, affine_from_grid.map_to, grid.ndim, grid.get_grid_shape(), affine) 
     transformed = __TR_transform_grid( grid.data, affine_from_grid.data ) 
     # 3) instantiate a new grid 
     grid = __make_grid(transformed, affine_from_grid.map_to, transformed.ndim-1)
@@ -53,16 +68,40 @@ def transform_grid(grid, affine_from_grid):
 
 
 
+def __compose_affine(affine_3d, affine_grid, ndim): 
+    # affine_3d is a 4x4 transformation of the coordinates; affine_grid maps the indexes to the coordinates 
+    affine_3d = __np.float64(affine_3d) 
+    if ndim == affine_3d.shape[0]-1: 
+        return affine_3d.dot(affine_grid) 
+    composed = __np.eye(ndim+1) 
+    composed[0:ndim,0:ndim+1] = affine_3d[0:ndim,0:ndim].dot(affine_grid[0:ndim,0:ndim+1]) 
+    composed[0:ndim,ndim] += affine_3d[0:ndim,affine_3d.shape[0]-1] 
+    return composed
+
+
+
 def grid_from_box_and_affine(min_coords, max_coords, n_points, affine=None, space="world"): 
-    #FIXME: optionally use the affine to transform min_coords and max_coords 
-    data = __TR_grid_from_box_and_affine(min_coords,max_coords,n_points)
-    ndim = data.ndim-1
-    grid = __make_grid(data, space, ndim)
+    """Regular grid of n_points[k] points from min_coords[k] to max_coords[k] (included) along each axis k, optionally 
+    transformed by 'affine'. The grid is implicit (see GridND): the coordinates are computed only if they are needed. """
+    min_coords = __np.float64(min_coords).ravel() 
+    max_coords = __np.float64(max_coords).ravel() 
+    n_points = __np.int64(n_points).ravel() 
+    ndim = n_points.size 
+    step = (max_coords - min_coords) / __np.maximum(n_points-1, 1) 
+    grid_affine = __np.eye(ndim+1) 
+    grid_affine[0:ndim,0:ndim] = __np.diag(step) 
+    grid_affine[0:ndim,ndim] = min_coords 
+    if affine is not None: 
+        if isinstance(affine,__occiput.Core.Transform_Affine): 
+            affine = affine.data 
+        grid_affine = __compose_affine(affine, grid_affine, ndim) 
+    grid = __make_grid(None, space, ndim, n_points, grid_affine)
     return grid
 
 
 
-def resample_image_on_grid(image, grid, affine_grid_to_world=None, verify_mapping=True, background=0.0, use_gpu=1): 
+def __resampling_affine(image, grid, affine_grid_to_world, verify_mapping): 
+    # affine from the voxel indexes of the image to the space of the grid, None if they are not compatible 
     if verify_mapping:
         # check if the image, the grid and the affine mapping are compatible: 
         # 1) if affine_grid_to_world is not defined, verify if image and grid are compatible
@@ -85,19 +124,84 @@ def resample_image_on_grid(image, grid, affine_grid_to_world=None, verify_mappin
                 return
     # compute affine: 
     if affine_grid_to_world == None:
-        affine = image.affine
-    else: 
-         affine = affine_grid_to_world.left_multiply(image.affine)
-    # decide sampling mode
+        return image.affine
+    return affine_grid_to_world.left_multiply(image.affine)
+
+
+
+def __interpolation_mode(image): 
     if image.is_mask(): 
-        interpolation_mode = INTERPOLATION_POINT
-    else:
-        interpolation_mode = INTERPOLATION_LINEAR 
-    # resample: 
-    resampled_data = __TR_resample_grid( image.data, grid.data, affine.data, background, use_gpu, interpolation_mode )
-    return resampled_data 
-    
-    
-
-    
-    
+        return INTERPOLATION_POINT
+    return INTERPOLATION_LINEAR 
+
+
+
+def __resample_grid(image_data, grid_data, affine, background, use_gpu, interpolation_mode): 
+    # NiftyCore: the GPU calls are serialized (the GPU context is not known to be thread-safe) 
+    if use_gpu: 
+        with __gpu_lock: 
+            return __TR_resample_grid( image_data, grid_data, affine, background, use_gpu, interpolation_mode )
+    return __TR_resample_grid( image_data, grid_data, affine, background, use_gpu, interpolation_mode )
+
+
+
+def resample_image_on_grid(image, grid, affine_grid_to_world=None, verify_mapping=True, background=0.0, use_gpu=1): 
+    affine = __resampling_affine(image, grid, affine_grid_to_world, verify_mapping) 
+    if affine is None: 
+        return 
+    # resample: the CPU implementation processes the grid in slabs, implicit grids are not materialized 
+    if has_NiftyCore: 
+        return __resample_grid( image.data, grid.data, affine.data, background, use_gpu, __interpolation_mode(image) )
+    return __TR_resample_grid( image.data, grid, affine.data, background, use_gpu, __interpolation_mode(image) )
+
+
+
+def resample_images_on_grid(images, grid, affines_grid_to_world=None, verify_mapping=True, background=0.0, use_gpu=1, affines=None, n_threads=None): 
+    """Resample several images on the same grid. 'images' is a list of images or an array whose last axis indexes 
+    the images (4D stack); in the latter case 'affines' (one affine, or one per image) maps the voxel indexes of the 
+    images to world. 'affines_grid_to_world' is None, one affine, or one per image. Without NiftyCore, the grid is 
+    processed in slabs by n_threads threads (default: number of CPUs): the coordinates of each slab are computed 
+    once and shared by all the images. With NiftyCore, the coordinates of the grid are converted once; the images 
+    are resampled in n_threads threads on the CPU, one at a time on the GPU. Returns a list of arrays (None for the 
+    images that are not compatible with the grid), or an array with the images along the last axis if 'images' is 
+    an array. """
+    stack = isinstance(images,__np.ndarray)
+    if stack: 
+        n = images.shape[-1]
+        if affines is None or isinstance(affines,__occiput.Core.Transform_Affine) or isinstance(affines,__np.ndarray): 
+            affines = [affines]*n 
+        images = [__occiput.Core.Image3D(data=__np.asfortranarray(images[...,i]), affine=affines[i], space="world") for i in range(n)] 
+    n = len(images) 
+    if n == 0: 
+        return [] 
+    if affines_grid_to_world is None or isinstance(affines_grid_to_world,__occiput.Core.Transform_Affine): 
+        affines_grid_to_world = [affines_grid_to_world]*n 
+    affines = [__resampling_affine(images[i], grid, affines_grid_to_world[i], verify_mapping) for i in range(n)] 
+    valid = [i for i in range(n) if affines[i] is not None] 
+    resampled = [None]*n 
+    if not has_NiftyCore: 
+        batch = __TR_resample_grid_batch([images[i].data for i in valid], grid, [affines[i].data for i in valid], background, 
+                                         [__interpolation_mode(images[i]) for i in valid], n_threads) 
+        for i, r in zip(valid, batch): 
+            resampled[i] = r 
+    else: 
+        # the coordinates of the grid are converted once 
+        grid_data = __np.ascontiguousarray(grid.data, dtype=__np.float32) 
+        def resample(i): 
+            resampled[i] = __resample_grid(images[i].data, grid_data, affines[i].data, background, use_gpu, __interpolation_mode(images[i])) 
+        if n_threads is None: 
+            n_threads = __multiprocessing.cpu_count() 
+        n_threads = max(1,min(int(n_threads),len(valid))) 
+        if use_gpu or n_threads <= 1: 
+            for i in valid: 
+                resample(i) 
+        else: 
+            pool = __ThreadPool(n_threads) 
+            try: 
+                pool.map(resample, valid) 
+            finally: 
+                pool.close() 
+                pool.join() 
+    if stack: 
+        return __np.concatenate([__np.asarray(r)[...,None] for r in resampled], axis=-1) 
+    return resampled 
@@ -0,0 +1,213 @@
+
+# occiput
+# Stefano Pedemonte
+# Harvard University, Martinos Center for Biomedical Imaging
+# Boston, MA, USA
+
+# CPU implementation (numpy) of the grid functions of NiftyCore: resampling of an image on a grid of points,
+# transformation of a grid and generation of a regular grid. The functions have the same arguments and semantics
+# as TR_resample_grid, TR_transform_grid and TR_grid_from_box_and_affine of NiftyCore.NiftyRec and are used when
+# NiftyCore is not available (see occiput.Core.NiftyCore_wrap). The grid is processed in slabs (along its first
+# axis) by a pool of threads.
+
+
+__all__ = ['TR_resample_grid','TR_resample_grid_batch','TR_transform_grid','TR_grid_from_box_and_affine','INTERPOLATION_LINEAR','INTERPOLATION_POINT',
+           'is_axis_aligned','resample_axis_aligned']
+
+
+import numpy
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+
+
+INTERPOLATION_LINEAR = 0
+INTERPOLATION_POINT  = 1
+DEFAULT_SLAB_SIZE    = 8                  # number of grid points along the first axis processed by one task
+AXIS_ALIGNED_TOLERANCE = 1e-6             # relative magnitude of the off-diagonal terms of an axis-aligned affine
+
+
+
+def _n_threads(n_threads, n_tasks):
+    if n_threads is None:
+        n_threads = multiprocessing.cpu_count()
+    return max(1,min(int(n_threads),n_tasks))
+
+
+def _map_slabs(function, n, slab_size, n_threads):
+    """Apply function(start, stop) to the slabs [start,stop) of range(n), in a pool of threads. """
+    slab_size = max(1,int(slab_size))
+    slabs = [(start,min(start+slab_size,n)) for start in range(0,n,slab_size)]
+    n_threads = _n_threads(n_threads, len(slabs))
+    if n_threads == 1:
+        for slab in slabs:
+            function(*slab)
+        return
+    pool = ThreadPool(n_threads)
+    try:
+        pool.map(lambda slab: function(*slab), slabs)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def _slab_of(grid, start, stop):
+    # 'grid' is an array of coordinates [n_1,..,n_N,N] or a GridND (implicit grids are computed slab by slab)
+    if hasattr(grid,'get_slab'):
+        return grid.get_slab(start, stop)
+    return grid[start:stop]
+
+
+def _grid_shape(grid):
+    if hasattr(grid,'get_grid_shape'):
+        return tuple(grid.get_grid_shape())
+    return tuple(grid.shape[0:-1])
+
+
+def _apply_affine(points, affine):
+    """Coordinates affine * [points,1] of an array of points [...,N]. """
+    ndim = points.shape[-1]
+    affine = numpy.float64(affine)
+    return numpy.dot(points, affine[0:ndim,0:ndim].transpose()) + affine[0:ndim,ndim]
+
+
+def flatten(data):
+    """Flat (Fortran order) float32 copy of 'data', its shape and the strides of its axes: the arguments of
+    interpolate_flat(). """
+    shape = numpy.int64(numpy.shape(data))
+    strides = numpy.cumprod(numpy.concatenate(([1],shape[0:-1])))
+    return numpy.float32(data).ravel(order="F"), shape, strides
+
+
+def interpolate_flat(flat, shape, strides, indexes, background=0.0, interpolation_mode=INTERPOLATION_LINEAR):
+    """Value at the (continuous) voxel indexes [...,N] of the image flattened by flatten(). Linear interpolation
+    uses the 2**N neighbours of each point, neighbours outside of the image have value 'background'; nearest
+    neighbour interpolation returns 'background' for points outside of the image. """
+    ndim = shape.size
+    background = numpy.float32(background)
+    if interpolation_mode == INTERPOLATION_POINT:
+        i = numpy.floor(indexes + 0.5).astype(numpy.int64)
+        inside = ((i >= 0) & (i < shape)).all(-1)
+        i = numpy.where(inside[...,None], i, 0)
+        return numpy.where(inside, flat[(i*strides).sum(-1)], background)
+    i0 = numpy.floor(indexes).astype(numpy.int64)
+    f = numpy.float32(indexes - i0)
+    values = numpy.zeros(indexes.shape[0:-1],dtype=numpy.float32)
+    for corner in range(2**ndim):
+        offset = numpy.asarray([(corner>>k)&1 for k in range(ndim)])
+        i = i0 + offset
+        w = numpy.ones(values.shape,dtype=numpy.float32)
+        for k in range(ndim):
+            w *= f[...,k] if offset[k] else 1-f[...,k]
+        inside = ((i >= 0) & (i < shape)).all(-1)
+        i = numpy.where(inside[...,None], i, 0)
+        values += w * numpy.where(inside, flat[(i*strides).sum(-1)], background)
+    return values
+
+
+def interpolate(data, indexes, background=0.0, interpolation_mode=INTERPOLATION_LINEAR):
+    """Value of 'data' at the (continuous) voxel indexes [...,N], see interpolate_flat(). Flattens 'data': when
+    interpolating the same image many times, flatten it once and use interpolate_flat(). """
+    return interpolate_flat(*(flatten(data)+(indexes, background, interpolation_mode)))
+
+
+
+def TR_resample_grid(image_data, grid, affine, background=0.0, use_gpu=0, interpolation_mode=INTERPOLATION_LINEAR, n_threads=None, slab_size=DEFAULT_SLAB_SIZE):
+    """Resample 'image_data' on the points of 'grid' (array [n_1,..,n_N,N] or GridND). 'affine' maps the voxel
+    indexes of the image to the space of the grid. Returns an array of shape [n_1,..,n_N] (Fortran order).
+    'use_gpu' is ignored. """
+    # the image is flattened once, the slabs only compute indexes
+    flat, image_shape, strides = flatten(image_data)
+    inverse = numpy.linalg.inv(numpy.float64(affine))
+    shape = _grid_shape(grid)
+    resampled = numpy.zeros(shape,dtype=numpy.float32,order="F")
+    def resample_slab(start, stop):
+        indexes = _apply_affine(numpy.float64(_slab_of(grid,start,stop)), inverse)
+        resampled[start:stop] = interpolate_flat(flat, image_shape, strides, indexes, background, interpolation_mode)
+    _map_slabs(resample_slab, shape[0], slab_size, n_threads)
+    return resampled
+
+
+def TR_resample_grid_batch(images_data, grid, affines, background=0.0, interpolation_modes=INTERPOLATION_LINEAR, n_threads=None, slab_size=DEFAULT_SLAB_SIZE):
+    """Resample several images on the points of the same 'grid' (array [n_1,..,n_N,N] or GridND). 'affines' (one
+    per image) map the voxel indexes of the images to the space of the grid; 'interpolation_modes' is one mode, or
+    one per image. The images are flattened once and the coordinates of each slab of the grid are computed once
+    and shared by all the images; the slabs are processed by a pool of threads. Returns a list of arrays of shape
+    [n_1,..,n_N] (Fortran order). """
+    n = len(images_data)
+    if numpy.isscalar(interpolation_modes):
+        interpolation_modes = [interpolation_modes]*n
+    flats = [flatten(data) for data in images_data]
+    inverses = [numpy.linalg.inv(numpy.float64(affine)) for affine in affines]
+    shape = _grid_shape(grid)
+    resampled = [numpy.zeros(shape,dtype=numpy.float32,order="F") for i in range(n)]
+    def resample_slab(start, stop):
+        points = numpy.float64(_slab_of(grid,start,stop))
+        for i in range(n):
+            indexes = _apply_affine(points, inverses[i])
+            resampled[i][start:stop] = interpolate_flat(*(flats[i]+(indexes, background, interpolation_modes[i])))
+    _map_slabs(resample_slab, shape[0], slab_size, n_threads)
+    return resampled
+
+
+def TR_transform_grid(grid_data, affine, n_threads=None, slab_size=DEFAULT_SLAB_SIZE):
+    """Transform the points of 'grid_data' (array [n_1,..,n_N,N]) by 'affine'. """
+    grid_data = numpy.asarray(grid_data)
+    transformed = numpy.zeros(grid_data.shape,dtype=numpy.float32)
+    def transform_slab(start, stop):
+        transformed[start:stop] = _apply_affine(numpy.float64(grid_data[start:stop]), affine)
+    _map_slabs(transform_slab, grid_data.shape[0], slab_size, n_threads)
+    return transformed
+
+
+def TR_grid_from_box_and_affine(min_coords, max_coords, n_points):
+    """Regular grid of n_points[k] points from min_coords[k] to max_coords[k] (included) along each axis k: array
+    [n_1,..,n_N,N]. """
+    min_coords = numpy.float64(min_coords).ravel()
+    max_coords = numpy.float64(max_coords).ravel()
+    n_points = [int(n) for n in numpy.ravel(n_points)]
+    axes = [numpy.linspace(min_coords[k],max_coords[k],n_points[k]) for k in range(len(n_points))]
+    return numpy.float32(numpy.concatenate([a[...,None] for a in numpy.meshgrid(*axes,indexing='ij')],axis=-1))
+
+
+
+def is_axis_aligned(affine, tolerance=AXIS_ALIGNED_TOLERANCE):
+    """Returns True if 'affine' ((N+1)x(N+1)) only scales and translates each axis (no rotation, shear or
+    permutation of the axes). """
+    affine = numpy.float64(affine)
+    ndim = affine.shape[0]-1
+    A = affine[0:ndim,0:ndim]
+    diagonal = numpy.abs(numpy.diag(A))
+    if (diagonal == 0).any():
+        return False
+    return bool((numpy.abs(A - numpy.diag(numpy.diag(A))) <= tolerance*diagonal.max()).all())
+
+
+def _interpolate_axis(data, axis, x, interpolation_mode):
+    """Interpolate 'data' along 'axis' at the (continuous) indexes x; points beyond the edges have value 0. """
+    n = data.shape[axis]
+    shape = [1]*data.ndim
+    shape[axis] = x.size
+    if interpolation_mode == INTERPOLATION_POINT:
+        i = numpy.floor(x + 0.5).astype(numpy.int64)
+        inside = numpy.float32((i >= 0) & (i < n)).reshape(shape)
+        return numpy.take(data, numpy.clip(i,0,n-1), axis=axis) * inside
+    i0 = numpy.floor(x).astype(numpy.int64)
+    f = numpy.float32(x - i0)
+    w0 = ((1-f) * ((i0 >= 0) & (i0 < n))).reshape(shape)
+    w1 = (f * ((i0+1 >= 0) & (i0+1 < n))).reshape(shape)
+    return numpy.take(data, numpy.clip(i0,0,n-1), axis=axis) * w0 + numpy.take(data, numpy.clip(i0+1,0,n-1), axis=axis) * w1
+
+
+def resample_axis_aligned(image_data, affine, shape, background=0.0, interpolation_mode=INTERPOLATION_LINEAR):
+    """Resample 'image_data' on a grid of the given shape, where the axis-aligned 'affine' maps the indexes of the
+    grid to the voxel indexes of the image (see is_axis_aligned()). The interpolation is separable: the image is
+    interpolated along one axis at a time. Same result as TR_resample_grid() on the corresponding grid. """
+    affine = numpy.float64(affine)
+    ndim = len(shape)
+    background = numpy.float32(background)
+    # the weights along each axis sum to 1: interpolate the difference from the background, padded with zeros
+    resampled = numpy.float32(image_data) - background
+    for k in range(ndim):
+        x = affine[k,k] * numpy.arange(shape[k]) + affine[k,ndim]
+        resampled = _interpolate_axis(resampled, k, x, interpolation_mode)
+    return numpy.asfortranarray(resampled + background)
@@ -0,0 +1,134 @@
+
+# occiput
+# Stefano Pedemonte
+# Harvard University, Martinos Center for Biomedical Imaging
+# Boston, MA, USA
+
+# Arrays backed by named shared memory segments (memory-mapped files in /dev/shm, if available). A shared array
+# pickles as a lightweight handle (name of the segment, shape, dtype, strides), hence it can be sent to worker
+# processes without copying the data: the workers map the same memory and their writes are visible to all the
+# processes. The process that creates a segment owns it and removes it when the last array that refers to it is
+# deleted (or when the interpreter exits).
+
+
+__all__ = ['SharedArray','shared_array','to_shared','is_shared','cleanup_shared_memory','SHARED_MEMORY_PATH']
+
+
+import os
+import atexit
+import mmap
+import tempfile
+import weakref
+import numpy
+
+
+if os.path.isdir('/dev/shm'):
+    SHARED_MEMORY_PATH = '/dev/shm'
+else:
+    SHARED_MEMORY_PATH = tempfile.gettempdir()
+SHARED_MEMORY_PREFIX = 'occiput_'
+
+_owned_segments = weakref.WeakValueDictionary()
+
+
+
+class SharedMemorySegment(object):
+    """Memory-mapped file; the segment is removed by the process that created it. """
+    def __init__(self, nbytes=None, filename=None):
+        if filename is None:
+            fd, filename = tempfile.mkstemp(prefix=SHARED_MEMORY_PREFIX, dir=SHARED_MEMORY_PATH)
+            os.ftruncate(fd, max(int(nbytes),1))
+            self.owner = os.getpid()
+            _owned_segments[filename] = self
+        else:
+            fd = os.open(filename, os.O_RDWR)
+            self.owner = None
+        try:
+            self.nbytes = os.fstat(fd).st_size
+            self.mmap = mmap.mmap(fd, self.nbytes)
+        finally:
+            os.close(fd)
+        self.filename = filename
+        self.address = numpy.frombuffer(self.mmap, dtype=numpy.uint8).__array_interface__['data'][0]
+
+    def contains(self, array):
+        start = array.__array_interface__['data'][0]
+        return self.address <= start < self.address + self.nbytes
+
+    def unlink(self):
+        if self.owner == os.getpid() and os.path.exists(self.filename):
+            os.unlink(self.filename)
+        self.owner = None
+
+    def __del__(self):
+        self.unlink()
+
+    def __repr__(self):
+        return "Shared memory segment %s (%d bytes)"%(self.filename, self.nbytes)
+
+
+
+def _open_shared_array(filename, shape, dtype, offset, strides):
+    segment = SharedMemorySegment(filename=filename)
+    array = numpy.ndarray(shape, dtype=numpy.dtype(dtype), buffer=segment.mmap, offset=offset, strides=strides).view(SharedArray)
+    array._segment = segment
+    return array
+
+
+
+class SharedArray(numpy.ndarray):
+    """numpy array in a shared memory segment, see shared_array(). Views of a shared array are shared arrays;
+    the results of computations on shared arrays are ordinary arrays. """
+    def __array_finalize__(self, obj):
+        self._segment = getattr(obj, '_segment', None)
+
+    def __array_wrap__(self, out, context=None):
+        if self._segment is None or not self._segment.contains(out):
+            out = numpy.asarray(out)
+            return out[()] if out.ndim == 0 else out
+        return numpy.ndarray.__array_wrap__(self, out, context)
+
+    def is_shared(self):
+        return self._segment is not None and self._segment.contains(self)
+
+    def __reduce__(self):
+        if not self.is_shared():
+            return numpy.asarray(self).__reduce__()
+        offset = self.__array_interface__['data'][0] - self._segment.address
+        return (_open_shared_array, (self._segment.filename, self.shape, self.dtype.str, offset, self.strides))
+
+
+
+def shared_array(shape, dtype=numpy.float32, order="F"):
+    """New array of zeros in shared memory. """
+    dtype = numpy.dtype(dtype)
+    shape = tuple(int(n) for n in numpy.atleast_1d(shape))
+    segment = SharedMemorySegment(nbytes=int(numpy.prod(shape))*dtype.itemsize)
+    array = numpy.ndarray(shape, dtype=dtype, buffer=segment.mmap, order=order).view(SharedArray)
+    array._segment = segment
+    return array
+
+
+def to_shared(array):
+    """Copy of 'array' in shared memory (the array itself if it is already shared). """
+    if is_shared(array):
+        return array
+    array = numpy.asarray(array)
+    order = "F" if (array.flags.f_contiguous and not array.flags.c_contiguous) else "C"
+    shared = shared_array(array.shape, array.dtype, order)
+    shared[...] = array
+    return shared
+
+
+def is_shared(array):
+    return isinstance(array, SharedArray) and array.is_shared()
+
+
+def cleanup_shared_memory():
+    """Remove all the shared memory segments created by this process. Arrays that refer to them remain
+    valid in the processes that have mapped them, but can no longer be sent to new processes. """
+    for segment in list(_owned_segments.values()):
+        segment.unlink()
+
+atexit.register(cleanup_shared_memory)
+
@@ -0,0 +1,131 @@
+
+# occiput
+# Stefano Pedemonte
+# Harvard University, Martinos Center for Biomedical Imaging
+# Boston, MA, USA
+
+# Separable Gaussian smoothing (numpy). The volume is filtered along one axis at a time; each pass is split into
+# slabs that are processed by a pool of threads. Short kernels are applied by direct convolution, long kernels
+# (large sigma) by FFT convolution. The kernel is truncated at DEFAULT_TRUNCATE standard deviations and the
+# convolution is normalized by the weight of the kernel inside of the volume, so that the edges are not darkened
+# and constant images are preserved.
+
+
+__all__ = ['gaussian_smoothing','gaussian_kernel','sigma_world_to_voxels','DEFAULT_TRUNCATE','FFT_SIGMA_THRESHOLD']
+
+
+import numpy
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+
+
+DEFAULT_TRUNCATE    = 4.0           # the kernel is truncated at DEFAULT_TRUNCATE standard deviations
+FFT_SIGMA_THRESHOLD = 6.0           # [voxels] use FFT convolution for sigma larger than this
+DEFAULT_SLAB_SIZE   = 16            # number of voxels along the slab axis processed by one task
+
+
+
+def gaussian_kernel(sigma, truncate=DEFAULT_TRUNCATE):
+    """Normalized 1D Gaussian kernel of standard deviation sigma [voxels], of odd length. """
+    half = max(1,int(numpy.ceil(truncate*sigma)))
+    x = numpy.arange(-half,half+1,dtype=numpy.float64)
+    kernel = numpy.exp(-0.5*x**2/sigma**2)
+    return numpy.float32(kernel/kernel.sum())
+
+
+def sigma_world_to_voxels(sigma, affine):
+    """Per-axis standard deviation in voxels of a Gaussian of standard deviation 'sigma' (scalar or one per
+    axis) in the units of the space of an image with the given affine (index to space). """
+    if not isinstance(affine,numpy.ndarray):
+        affine = affine.data
+    affine = numpy.float64(affine)
+    ndim = affine.shape[0]-1
+    voxel_size = numpy.sqrt((affine[0:ndim,0:ndim]**2).sum(0))
+    return numpy.float64(sigma) * numpy.ones(ndim) / voxel_size
+
+
+def _convolve_direct(data, axis, kernel):
+    n = data.shape[axis]
+    half = kernel.size // 2
+    padding = [(0,0)]*data.ndim
+    padding[axis] = (half,half)
+    padded = numpy.pad(data, padding, mode='constant')
+    out = numpy.zeros(data.shape,dtype=numpy.float32)
+    index = [slice(None)]*data.ndim
+    for k in range(kernel.size):
+        index[axis] = slice(k,k+n)
+        out += kernel[k] * padded[tuple(index)]
+    return out
+
+
+def _convolve_fft(data, axis, kernel):
+    n = data.shape[axis]
+    half = kernel.size // 2
+    n_fft = 1
+    while n_fft < n + kernel.size - 1:
+        n_fft *= 2
+    shape = [1]*data.ndim
+    shape[axis] = -1
+    spectrum = numpy.fft.rfft(data, n_fft, axis=axis) * numpy.fft.rfft(kernel, n_fft).reshape(shape)
+    out = numpy.fft.irfft(spectrum, n_fft, axis=axis)
+    return numpy.float32(numpy.take(out, numpy.arange(half,half+n), axis=axis))
+
+
+def _smooth_axis(data, out, axis, sigma, truncate, n_threads, slab_size):
+    """Filter 'data' along 'axis' into 'out'; the volume is split into slabs along another axis. """
+    kernel = gaussian_kernel(sigma, truncate)
+    n = data.shape[axis]
+    half = kernel.size // 2
+    # weight of the kernel inside of the volume, for each position along the axis
+    weight = numpy.convolve(numpy.ones(n), numpy.float64(kernel))[half:half+n]
+    shape = [1]*data.ndim
+    shape[axis] = n
+    weight = numpy.float32(weight).reshape(shape)
+    if sigma > FFT_SIGMA_THRESHOLD:
+        convolve = _convolve_fft
+    else:
+        convolve = _convolve_direct
+    others = [k for k in range(data.ndim) if k != axis]
+    if len(others) == 0:
+        out[...] = convolve(data, axis, kernel) / weight
+        return
+    slab_axis = max(others, key=lambda k: data.shape[k])
+    def smooth_slab(start):
+        index = [slice(None)]*data.ndim
+        index[slab_axis] = slice(start,min(start+slab_size,data.shape[slab_axis]))
+        out[tuple(index)] = convolve(data[tuple(index)], axis, kernel) / weight
+    starts = range(0,data.shape[slab_axis],slab_size)
+    if n_threads == 1 or len(starts) == 1:
+        for start in starts:
+            smooth_slab(start)
+        return
+    pool = ThreadPool(min(n_threads,len(starts)))
+    try:
+        pool.map(smooth_slab, starts)
+    finally:
+        pool.close()
+        pool.join()
+
+
+
+def gaussian_smoothing(data, sigma, truncate=DEFAULT_TRUNCATE, n_threads=None, slab_size=DEFAULT_SLAB_SIZE):
+    """Smooth the array 'data' with a Gaussian of standard deviation 'sigma' [voxels], scalar or one per axis
+    (0: no smoothing along the axis). Returns a new array (float32, Fortran order). The axes are filtered in
+    n_threads threads (default: number of CPUs). """
+    data = numpy.asarray(data)
+    sigma = numpy.float64(sigma) * numpy.ones(data.ndim)
+    if n_threads is None:
+        n_threads = multiprocessing.cpu_count()
+    n_threads = max(1,int(n_threads))
+    slab_size = max(1,int(slab_size))
+    smoothed = numpy.asfortranarray(numpy.float32(data))
+    for axis in range(data.ndim):
+        if sigma[axis] <= 0 or data.shape[axis] <= 1:
+            continue
+        out = numpy.zeros(data.shape,dtype=numpy.float32,order="F")
+        _smooth_axis(smoothed, out, axis, sigma[axis], truncate, n_threads, slab_size)
+        smoothed = out
+    if smoothed is data:
+        smoothed = smoothed.copy(order="F")
+    return smoothed
+
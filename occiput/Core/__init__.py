@@ -8,10 +8,15 @@
 
 
 from . import Core
-from .Core import Transform_Affine, Transform_Identity, Transform_6DOF, Transform_Scale, Transform_Translation, Transform_Rotation, Grid3D, Image3D, GridND, ImageND
+from .Core import Transform_Affine, Transform_Identity, Transform_6DOF, Transform_Scale, Transform_Translation, Transform_Rotation, Grid3D, Image3D, GridND, ImageND, LazyImage3D
 from .Core import grid_from_box_and_affine
 from .Core import nipy_to_occiput, nifti_to_occiput, occiput_from_array
 
 from . import transformations 
 from . import NiftyCore_wrap
-from . import Conversion
\ No newline at end of file
+from .NiftyCore_wrap import resample_images_on_grid
+from . import Conversion
+from . import Resampling
+from . import Smoothing
+from . import SharedMemory
+from .SharedMemory import shared_array, to_shared, is_shared, cleanup_shared_memory
\ No newline at end of file
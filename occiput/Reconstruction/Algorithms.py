@@ -0,0 +1,199 @@
+
+# occiput
+# Stefano Pedemonte
+# Harvard University, Martinos Center for Biomedical Imaging
+# Boston, MA, USA
+
+
+# Iterative reconstruction algorithms for emission tomography. The algorithms are independent of the imaging
+# modality: they only make use of the following methods of the scan object (see PET_Static_Scan and SPECT_Static_Scan):
+#   _new_subset(subset_size, subset_mode)   -> subset (None for all the projections)
+#   _n_subsets(subset_size)                 -> number of subsets that cover the projections
+#   _forward(activity, subset)              -> projection of 'activity' (numpy array), same layout as _measured(subset)
+#   _backward(projection, subset)           -> backprojection (numpy array)
+#   _measured(subset)                       -> measurement (numpy array)
+#   _sensitivity(subset)                    -> backprojection of ones (numpy array)
+#   _constraint(activity)                   -> activity with the support constraint applied (e.g. mask)
+
+
+__all__ = ['ReconstructionAlgorithm','OSEM','RelaxedOSEM','BSREM','PreconditionedConjugateGradient','ALGORITHMS','get_algorithm']
+
+
+import numpy
+
+
+EPS = 1e-6
+DEFAULT_RELAXATION      = 1.0
+DEFAULT_BSREM_DECAY     = 0.2
+DEFAULT_LINE_SEARCH_ITERATIONS = 5
+
+
+
+class UnknownParameter(Exception):
+    def __init__(self,msg):
+        self.msg = str(msg)
+    def __str__(self):
+        return "Unkwnown parameter: %s"%(self.msg)
+
+
+
+class ReconstructionAlgorithm(object):
+    """Base class of the iterative reconstruction algorithms. Derived classes implement iterate(). """
+    def __init__(self, epsilon=EPS):
+        self.epsilon = epsilon
+
+    def initialize(self, scan, activity):
+        pass
+
+    def iterate(self, scan, activity, subset, iteration):
+        raise NotImplementedError
+
+    def run(self, scan, activity, iterations, subset_size=None, subset_mode='random', progress_callback=None):
+        activity = scan._constraint(numpy.float32(activity))
+        self._n_subsets = scan._n_subsets(subset_size)
+        self.initialize(scan, activity)
+        for i in range(iterations):
+            subset = scan._new_subset(subset_size, subset_mode)
+            activity = self.iterate(scan, activity, subset, i)
+            activity = scan._constraint(activity)
+            if progress_callback is not None:
+                progress_callback((i+1)*100.0/iterations)
+        return activity
+
+    def _epoch(self, iteration):
+        """Number of complete passes through the data at the given (sub-)iteration. """
+        return iteration // self._n_subsets
+
+    def __repr__(self):
+        return "Reconstruction algorithm: %s"%self.__class__.__name__
+
+
+
+class OSEM(ReconstructionAlgorithm):
+    """Ordered Subsets Expectation Maximization (MLEM if subset_size is None). """
+    def iterate(self, scan, activity, subset, iteration):
+        eps  = self.epsilon
+        proj = scan._forward(activity, subset)
+        norm = scan._sensitivity(subset)
+        update = (scan._backward((scan._measured(subset)+eps)/(proj+eps), subset)+eps) / (norm+eps)
+        return activity * update
+
+
+
+class RelaxedOSEM(ReconstructionAlgorithm):
+    """Relaxed ordered subsets: x <- x + relaxation_n * x/s_b * grad_b(L), where grad_b(L) is the gradient of the
+    Poisson log-likelihood of subset b and s_b is the sensitivity of subset b. The relaxation decays with the
+    number of passes n through the data: relaxation_n = relaxation / (1 + decay*n); relaxation=1, decay=0 is OSEM.
+    If momentum is True, the update is evaluated at the Nesterov extrapolation of the last two estimates.
+    Values above upper_bound (if not None) are truncated. """
+    def __init__(self, relaxation=DEFAULT_RELAXATION, decay=0.0, momentum=False, upper_bound=None, epsilon=EPS):
+        ReconstructionAlgorithm.__init__(self, epsilon)
+        self.relaxation  = relaxation
+        self.decay       = decay
+        self.momentum    = momentum
+        self.upper_bound = upper_bound
+
+    def initialize(self, scan, activity):
+        self._previous = None
+        self._t = 1.0
+
+    def get_relaxation(self, iteration):
+        return self.relaxation / (1.0 + self.decay * self._epoch(iteration))
+
+    def iterate(self, scan, activity, subset, iteration):
+        eps = self.epsilon
+        x = activity
+        if self.momentum:
+            t = 0.5 * (1.0 + numpy.sqrt(1.0 + 4.0*self._t**2))
+            if self._previous is not None:
+                x = numpy.maximum(activity + (self._t - 1.0)/t * (activity - self._previous), 0.0)
+            self._previous = activity
+            self._t = t
+        proj = scan._forward(x, subset)
+        norm = scan._sensitivity(subset)
+        gradient = scan._backward((scan._measured(subset)+eps)/(proj+eps), subset) - norm
+        x = x + self.get_relaxation(iteration) * x / (norm+eps) * gradient
+        x = numpy.maximum(x, 0.0)
+        if self.upper_bound is not None:
+            x = numpy.minimum(x, self.upper_bound)
+        return numpy.float32(x)
+
+
+
+class BSREM(RelaxedOSEM):
+    """Block Sequential Regularized Expectation Maximization: relaxed ordered subsets with diminishing relaxation
+    and bounded estimates; unlike OSEM, it converges to the maximum of the likelihood. """
+    def __init__(self, relaxation=DEFAULT_RELAXATION, decay=DEFAULT_BSREM_DECAY, momentum=False, upper_bound=None, epsilon=EPS):
+        RelaxedOSEM.__init__(self, relaxation, decay, momentum, upper_bound, epsilon)
+
+
+
+class PreconditionedConjugateGradient(ReconstructionAlgorithm):
+    """Conjugate gradient ascent of the Poisson log-likelihood (Polak-Ribiere), with the diagonal preconditioner
+    x/s of EM and an exact (Newton) line search along each direction, constrained to non-negative estimates.
+    The projection of the estimate is updated from the projection of the search direction, hence each iteration
+    costs one projection and one backprojection. Subsets are not used: each iteration processes all the data. """
+    def __init__(self, line_search_iterations=DEFAULT_LINE_SEARCH_ITERATIONS, epsilon=EPS):
+        ReconstructionAlgorithm.__init__(self, epsilon)
+        self.line_search_iterations = line_search_iterations
+
+    def initialize(self, scan, activity):
+        self._proj      = None
+        self._gradient  = None
+        self._direction = None
+        self._preconditioned = None
+
+    def iterate(self, scan, activity, subset, iteration):
+        eps = self.epsilon
+        measurement = scan._measured(None)
+        if self._proj is None:
+            self._proj = scan._forward(activity, None)
+        norm = scan._sensitivity(None)
+        gradient = scan._backward((measurement+eps)/(self._proj+eps), None) - norm
+        preconditioned = activity / (norm+eps) * gradient
+        if self._direction is None:
+            direction = preconditioned
+        else:
+            beta = (preconditioned*(gradient-self._gradient)).sum() / ((self._preconditioned*self._gradient).sum() + eps)
+            direction = preconditioned + max(beta, 0.0) * self._direction
+        direction = scan._constraint(numpy.float32(direction))
+        self._gradient, self._preconditioned, self._direction = gradient, preconditioned, direction
+        # line search
+        proj_direction = scan._forward(direction, None)
+        alpha = self._line_search(measurement, self._proj, proj_direction, activity, direction)
+        self._proj = self._proj + alpha*proj_direction
+        return numpy.float32(numpy.maximum(activity + alpha*direction, 0.0))
+
+    def _line_search(self, measurement, proj, proj_direction, activity, direction):
+        """Maximize sum(y*log(p+alpha*q) - (p+alpha*q)) for alpha in [0, alpha_max], where alpha_max keeps the
+        estimate non-negative. """
+        eps = self.epsilon
+        negative = direction < 0
+        if negative.any():
+            alpha_max = (activity[negative] / -direction[negative]).min()
+        else:
+            alpha_max = numpy.inf
+        alpha = 0.0
+        for i in range(self.line_search_iterations):
+            p = numpy.maximum(proj + alpha*proj_direction, eps)
+            first  = ((measurement/p - 1.0) * proj_direction).sum()
+            second = -(measurement * proj_direction**2 / p**2).sum()
+            if second >= 0:
+                break
+            alpha = min(max(alpha - first/second, 0.0), alpha_max)
+        return alpha
+
+
+
+ALGORITHMS = {'osem':OSEM, 'mlem':OSEM, 'ros':RelaxedOSEM, 'bsrem':BSREM, 'pcg':PreconditionedConjugateGradient}
+
+
+def get_algorithm(method, epsilon=EPS):
+    """Return an instance of ReconstructionAlgorithm: 'method' is either an instance (returned unchanged) or
+    one of the names in ALGORITHMS. """
+    if isinstance(method, ReconstructionAlgorithm):
+        return method
+    if method not in ALGORITHMS:
+        raise UnknownParameter("Reconstruction method '%s' is not one of %s. "%(str(method),str(ALGORITHMS.keys())))
+    return ALGORITHMS[method](epsilon=epsilon)
+
@@ -0,0 +1,71 @@
+
+# occiput
+# Stefano Pedemonte
+# Harvard University, Martinos Center for Biomedical Imaging
+# Boston, MA, USA
+
+
+__all__ = ['ramp_filter','RAMP_WINDOWS']
+
+
+import numpy
+
+
+RAMP_WINDOWS = ['ramp','shepp-logan','cosine','hamming','hann']
+
+
+
+class UnknownParameter(Exception):
+    def __init__(self,msg):
+        self.msg = str(msg)
+    def __str__(self):
+        return "Unkwnown parameter: %s"%(self.msg)
+
+
+
+def _ramp_frequency_response(n_fft, pixel_size, window, cutoff):
+    # Band-limited ramp (Ram-Lak) designed in the spatial domain, this avoids the DC offset of the sampled |f|
+    k = numpy.arange(n_fft)
+    k[k>n_fft/2] = k[k>n_fft/2] - n_fft
+    h = numpy.zeros(n_fft)
+    h[0] = 1.0 / (4.0*pixel_size**2)
+    odd = (k%2)==1
+    h[odd] = -1.0 / (numpy.pi*k[odd]*pixel_size)**2
+    response = numpy.real(numpy.fft.rfft(h)) * pixel_size
+    # Apodization window; f is the frequency as a fraction of the Nyquist frequency
+    f = numpy.arange(response.size) * 2.0 / n_fft
+    if window == 'ramp':
+        w = numpy.ones(f.shape)
+    elif window == 'shepp-logan':
+        w = numpy.sinc(f/(2.0*cutoff))
+    elif window == 'cosine':
+        w = numpy.cos(numpy.pi*f/(2.0*cutoff))
+    elif window == 'hamming':
+        w = 0.54 + 0.46*numpy.cos(numpy.pi*f/cutoff)
+    elif window == 'hann':
+        w = 0.5 + 0.5*numpy.cos(numpy.pi*f/cutoff)
+    else:
+        raise UnknownParameter("Window '%s' is not one of %s. "%(str(window),str(RAMP_WINDOWS)))
+    w[f>cutoff] = 0.0
+    return response * w
+
+
+
+def ramp_filter(data, axis=0, pixel_size=1.0, window='ramp', cutoff=1.0):
+    """Apply the ramp filter of filtered backprojection along one axis of an array of projections.
+    All the projections are filtered at once, with a zero-padded FFT along 'axis'.
+    pixel_size is the sampling step along 'axis'; cutoff is the cutoff frequency of the apodization
+    window, as a fraction of the Nyquist frequency. """
+    data = numpy.asarray(data)
+    n = data.shape[axis]
+    # zero padding to (at least) twice the length prevents wrap-around of the convolution
+    n_fft = int(max(64, 2**numpy.ceil(numpy.log2(2*n))))
+    response = _ramp_frequency_response(n_fft, pixel_size, window, cutoff)
+    shape = [1]*data.ndim
+    shape[axis] = response.size
+    spectrum = numpy.fft.rfft(data, n=n_fft, axis=axis) * response.reshape(shape)
+    filtered = numpy.fft.irfft(spectrum, n=n_fft, axis=axis)
+    index = [slice(None)]*data.ndim
+    index[axis] = slice(0,n)
+    return numpy.float32(filtered[tuple(index)])
+
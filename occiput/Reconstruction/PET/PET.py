@@ -11,20 +11,30 @@ __all__ = ['PET_Static_Scan','PET_Dynamic_Scan','PET_Interface_Petlink32','PET_I
 
 
 # Import occiput: 
-from occiput.Core import Image3D
+from occiput.Core import Image3D, Transform_Affine, grid_from_box_and_affine, to_shared
 from occiput.Visualization import *
 from occiput.Visualization.Colors import *
 from occiput.DataSources.Synthetic.Shapes import uniform_cylinder
 from occiput.Visualization import ipy_table, has_ipy_table, svgwrite, has_svgwrite 
 from occiput.Core.NiftyCore_wrap import PET_project_compressed, PET_backproject_compressed, has_NiftyCore
 from occiput.DataSources.FileSources.vNAV import load_vnav_mprage
+from occiput.Reconstruction.Filters import ramp_filter
+from occiput.Reconstruction.Algorithms import get_algorithm
+from occiput.Registration.TranslationRotation import register_to_reference, transformation_matrix_6DOF, parameters_6DOF
+from PET_tof import PET_project_tof, PET_backproject_tof, tof_bin_centers
+from PET_parallel import ShardedProjector
+from PET_interface import InterfaceHandle, snapshot, read_only
+from PET_pipeline import FramePipeline, DEFAULT_QUEUE_DEPTH
 
 # Import other modules
 from PIL import Image as PIL 
 import ImageDraw
-from numpy import isscalar, linspace, int32, uint32, ones, zeros, pi, float32, where, ndarray, nan, inf
-from numpy.random import randint 
+from numpy import isscalar, linspace, int32, uint32, ones, zeros, pi, float32, where, ndarray, nan, inf, diag, asarray, asfortranarray, arange, rint, int64
+from numpy import cos, floor, clip, minimum, maximum, take, concatenate, searchsorted, unique, repeat, array_split, ascontiguousarray, unravel_index, dot
+from numpy.random import randint, RandomState 
 import os
+import copy
+from types import InstanceType
 
 # Import ilang (inference language; optimisation) 
 from PET_ilang import PET_Static_Poisson, PET_Dynamic_Poisson, ProbabilisticGraphicalModel
@@ -63,6 +73,11 @@ DEFAULT_BINNING = {      "n_axial":                252,
                          "n_v":                    64,   }
 
 
+DEFAULT_TOF_BINNING = {  "n_tof":                  1,            # 1: no time-of-flight information 
+                         "size_tof":               0.0,          # range of the TOF bins along the line of response [mm] 
+                         "tof_resolution":         0.0,   }      # timing resolution, FWHM along the line of response [mm] 
+
+
 DEFAULT_ROI = {          "x":                      0.0, 
                          "y":                      0.0, 
                          "z":                      0.0, 
@@ -94,6 +109,18 @@ DEFAULT_BACKPROJECTION_PARAMETERS  =  {
 DEFAULT_N_TIME_BINS       = 30
 DEFAULT_SUBSET_SIZE       = 20
 DEFAULT_RECON_ITERATIONS  = 10
+DEFAULT_MULTIRESOLUTION_DOWNSAMPLING = [2, 1]       # downsampling factor of activity_shape at each resolution level 
+DEFAULT_MULTIRESOLUTION_ITERATIONS   = [4, 6]       # number of iterations at each resolution level 
+DEFAULT_SUPPORT_THRESHOLD   = 0.05                  # fraction of the maximum (of the attenuation or of a quick MLEM estimate) above which a voxel belongs to the object support 
+DEFAULT_SUPPORT_ITERATIONS  = 3                     # MLEM iterations of the quick activity estimate that defines the object support 
+DEFAULT_SUPPORT_MARGIN      = 10.0                  # margin added around the object support, in the units of activity_size 
+DEFAULT_SUPPORT_DOWNSAMPLING = 4                    # downsampling of activity_shape for the quick backprojection that estimates the support 
+DEFAULT_FBP_WINDOW        = 'ramp'
+DEFAULT_FBP_CUTOFF        = 1.0
+DEFAULT_LISTMODE_SUBSETS  = 10                      # number of subsets the event stream is split into 
+DEFAULT_MOTION_ITERATIONS = 2                       # iterations of the quick reconstruction of each frame for motion estimation 
+DEFAULT_MOTION_COST       = 'ncc'                   # similarity metric of the registration of the frames (insensitive to the counts of the frames) 
+DEFAULT_MOTION_SIGMA      = 1e-3                    # scale of the log likelihood of the registration: metric/sigma 
 EPS = 1e-6
 
 
@@ -145,6 +172,39 @@ def pretty_print_large_number(number):
 
 def print_percentage(number):
     return "%2.2f %%"%((1.0*number)*100)
+
+def interpolate_along_axis(array, positions, axis): 
+    """Linear interpolation of 'array' at the fractional indices 'positions' along 'axis'. Returns the interpolated 
+    array and a boolean array that flags the positions that fall within the array (within half a sample). """
+    n = array.shape[axis]
+    positions = asarray(positions,dtype=float32)
+    p  = clip(positions, 0, n-1)
+    i0 = int32(floor(p))
+    i1 = minimum(i0+1, n-1)
+    w  = p - i0 
+    shape = [1]*array.ndim 
+    shape[axis] = positions.size 
+    valid = (positions > -0.5) & (positions < n-0.5) 
+    values = take(array,i0,axis=axis)*(1-w).reshape(shape) + take(array,i1,axis=axis)*w.reshape(shape)
+    return values * valid.reshape(shape), valid
+
+def resample_activity(activity, activity_size, activity_shape): 
+    """Resample an activity volume that spans the physical extent 'activity_size' onto a grid of 'activity_shape' voxels 
+    spanning the same extent. Voxel values are interpolated, hence concentrations are preserved. """
+    if isinstance(activity,ndarray): 
+        data = float32(activity)
+    else: 
+        data = float32(activity.data)
+    size = float32(activity_size)
+    voxel_from = size / float32(data.shape)
+    voxel_to   = size / float32(activity_shape)
+    # affine from voxel index to physical coordinates (voxel centers) 
+    affine = diag([voxel_from[0],voxel_from[1],voxel_from[2],1.0])
+    affine[0:3,3] = 0.5*voxel_from
+    image = Image3D(data=data, affine=Transform_Affine(affine), space="world")
+    grid = grid_from_box_and_affine(0.5*voxel_to, size-0.5*voxel_to, uint32(activity_shape))
+    resampled = image.compute_resample_on_grid(grid).data
+    return asfortranarray(float32(resampled).reshape(activity_shape))
     
 
 
@@ -215,7 +275,8 @@ class Binning():
         elif type(parameters) == dict:  
             self.load_from_dictionary(parameters)        
         elif type(parameters) in [list, tuple]: 
-            if len(parameters) == len(DEFAULT_BINNING.keys()): 
+            # the TOF parameters (last three) are optional 
+            if len(parameters) in [len(DEFAULT_BINNING.keys()), len(DEFAULT_BINNING.keys())+len(DEFAULT_TOF_BINNING.keys())]: 
                 self.N_axial                = parameters[0]
                 self.N_azimuthal            = parameters[1]
                 self.angular_step_axial     = parameters[2] 
@@ -224,6 +285,11 @@ class Binning():
                 self.size_v                 = parameters[5] 
                 self.N_u                    = parameters[6]
                 self.N_v                    = parameters[7] 
+                self._load_tof_from_dictionary(DEFAULT_TOF_BINNING)
+                if len(parameters) > len(DEFAULT_BINNING.keys()): 
+                    self.N_tof                  = parameters[8]
+                    self.size_tof               = parameters[9]
+                    self.tof_resolution         = parameters[10]
             else: 
                 raise UnknownParameter('Parameter %s specified for the construction of Binning is not compatible. '%str(parameters)) 
         else: 
@@ -238,6 +304,54 @@ class Binning():
         self.size_v                 = dictionary['size_v']                     # Size of the detector plane, axis v,  [adimensional]
         self.N_u                    = dictionary['n_u']                        # Number of pixels of the detector plan, axis u 
         self.N_v                    = dictionary['n_v']                        # Number of pixels of the detector plan, axis v 
+        self._load_tof_from_dictionary(dictionary)
+
+    def _load_tof_from_dictionary(self,dictionary): 
+        self.N_tof                  = dictionary.get('n_tof',DEFAULT_TOF_BINNING['n_tof'])                     # Number of time-of-flight bins 
+        self.size_tof               = dictionary.get('size_tof',DEFAULT_TOF_BINNING['size_tof'])               # Range of the TOF bins along the line of response [mm] 
+        self.tof_resolution         = dictionary.get('tof_resolution',DEFAULT_TOF_BINNING['tof_resolution'])   # Timing resolution (FWHM) along the line of response [mm] 
+
+    def export_dictionary(self): 
+        return {"n_axial":self.N_axial, "n_azimuthal":self.N_azimuthal, "angular_step_axial":self.angular_step_axial, 
+                "angular_step_azimuthal":self.angular_step_azimuthal, "size_u":self.size_u, "size_v":self.size_v, "n_u":self.N_u, "n_v":self.N_v, 
+                "n_tof":self.N_tof, "size_tof":self.size_tof, "tof_resolution":self.tof_resolution} 
+
+    def has_tof(self): 
+        return self.N_tof > 1 
+
+    def downsample(self, axial=1, u=1, v=1): 
+        """Coarser binning: 'axial' adjacent axial angles, 'u' adjacent radial bins and 'v' adjacent planes are merged. 
+        The size of the detector plane is unchanged. """
+        for factor, n, name in [(axial,self.N_axial,'N_axial'), (u,self.N_u,'N_u'), (v,self.N_v,'N_v')]: 
+            if factor < 1 or n % factor != 0: 
+                raise UnexpectedParameter("Downsampling factor %s is not a divisor of %s=%d. "%(str(factor),name,n))
+        binning = self.export_dictionary() 
+        binning['n_axial'] = self.N_axial / axial 
+        binning['angular_step_axial'] = self.angular_step_axial * axial 
+        binning['n_u'] = self.N_u / u 
+        binning['n_v'] = self.N_v / v 
+        return Binning(binning) 
+
+    def get_angles_axial(self): 
+        """Axial angles of the projections, [rad]. """
+        return arange(self.N_axial) * self.angular_step_axial 
+
+    def get_angles_azimuthal(self): 
+        """Azimuthal angles (tilt with respect to the transaxial plane) of the projections, [rad]. The 
+        azimuthal angles are symmetric with respect to the transaxial plane. """
+        return (arange(self.N_azimuthal) - 0.5*(self.N_azimuthal-1)) * self.angular_step_azimuthal 
+
+    def get_coordinates_u(self): 
+        """Coordinates of the centers of the detector pixels along u, with respect to the center of the detector plane. """
+        return (arange(self.N_u) + 0.5) * self.size_u / self.N_u - 0.5 * self.size_u 
+
+    def get_coordinates_v(self): 
+        """Coordinates of the centers of the detector pixels along v, with respect to the center of the detector plane. """
+        return (arange(self.N_v) + 0.5) * self.size_v / self.N_v - 0.5 * self.size_v 
+
+    def get_coordinates_tof(self): 
+        """Coordinates of the centers of the TOF bins along the line of response, with respect to its midpoint [mm]. """
+        return tof_bin_centers(self.N_tof, self.size_tof) 
         
     def __repr__(self): 
         s = "PET Binning: \n"        
@@ -249,6 +363,10 @@ class Binning():
         s = s+" - Size_v:                   %f \n"%self.size_v        
         s = s+" - N_u:                      %d \n"%self.N_u
         s = s+" - N_v:                      %d \n"%self.N_v
+        if self.has_tof(): 
+            s = s+" - N_tof:                    %d \n"%self.N_tof
+            s = s+" - Size_tof:                 %f \n"%self.size_tof
+            s = s+" - TOF_resolution:           %f \n"%self.tof_resolution
         return s
 
     def _repr_html_(self):
@@ -256,6 +374,8 @@ class Binning():
             return "Please install ipy_table."
         table_data = [['N_axial',self.N_axial],['N_azimuthal',self.N_azimuthal],['Angular_step_axial',self.angular_step_axial],
         ['Angular_step_azimuthal',self.angular_step_azimuthal],['Size_u',self.size_u],['Size_v',self.size_v],['N_u',self.N_u],['N_v',self.N_v]] 
+        if self.has_tof(): 
+            table_data += [['N_tof',self.N_tof],['Size_tof',self.size_tof],['TOF_resolution',self.tof_resolution]] 
         table = ipy_table.make_table(table_data)
         table = ipy_table.apply_theme('basic_left')
         #table = ipy_table.set_column_style(0, color='lightBlue')
@@ -380,7 +500,118 @@ class SubsetGenerator():
 
 
 
+class ListmodeSubsets(): 
+    """Event-by-event (listmode) model of a PET scan, to be used with the reconstruction algorithms 
+    (occiput.Reconstruction.Algorithms). The event stream is split into n_subsets consecutive blocks; the 
+    projector and backprojector of each block only run along the lines of response of its events. 
+    'events' is a sequence of location numbers (indexes in the compressed projection data of 'scan'). 
+    The sensitivity is computed over all the lines of response, not only the recorded ones. """
+    def __init__(self, scan, events, n_subsets=DEFAULT_LISTMODE_SUBSETS): 
+        if scan.binning.has_tof(): 
+            raise UnexpectedParameter("Listmode reconstruction of time-of-flight data not yet supported.")
+        self.scan = scan 
+        events = asarray(events,dtype=int64).ravel()
+        n_subsets = max(1,min(int(n_subsets),events.size))
+        self._subsets = [self._make_subset(block) for block in array_split(events,n_subsets)]
+        self._all     = self._make_subset(events)
+        self._index   = -1 
+        self._sensitivity_full = None 
+
+    def _make_subset(self, events): 
+        """Sparse structure ('offsets', 'locations') of the lines of response hit by 'events' and number of 
+        events on each of them. """
+        kept, counts = unique(events, return_counts=True)
+        offsets, locations = self.scan._offsets, self.scan._locations 
+        N = max(locations.shape) 
+        axis = len(locations.shape)-1-list(locations.shape)[::-1].index(N) 
+        # The locations of each angle are contiguous and 'offsets' points to the first one: the offset of the 
+        # subset is the number of retained locations that precede it. 
+        sub_offsets = searchsorted(kept, offsets, 'left').astype(offsets.dtype) 
+        sub_locations = take(locations, kept, axis=axis) 
+        if locations.flags.f_contiguous and not locations.flags.c_contiguous: 
+            sub_locations, sub_offsets = asfortranarray(sub_locations), asfortranarray(sub_offsets)
+        else: 
+            sub_locations, sub_offsets = ascontiguousarray(sub_locations), ascontiguousarray(sub_offsets)
+        return (sub_offsets, sub_locations, float32(counts).reshape((1,kept.size),order="F")) 
+
+    def _get(self, subset): 
+        if subset is None: 
+            return self._all 
+        return self._subsets[subset]
+
+    def _new_subset(self, subset_size, subset_mode): 
+        self._index = (self._index + 1) % len(self._subsets)
+        return self._index 
+
+    def _n_subsets(self, subset_size): 
+        return len(self._subsets) 
+
+    def _forward(self, activity, subset): 
+        offsets, locations, counts = self._get(subset) 
+        return self.scan.project(activity, offsets=offsets, locations=locations)
+
+    def _backward(self, projection_data, subset): 
+        offsets, locations, counts = self._get(subset) 
+        return self.scan.backproject(projection_data, offsets=offsets, locations=locations).data 
+
+    def _measured(self, subset): 
+        return self._get(subset)[2] 
+
+    def _sensitivity(self, subset): 
+        if self._sensitivity_full is None: 
+            R = self.scan.interface.full_sampling(self.scan.binning.N_axial,self.scan.binning.N_azimuthal,self.scan.binning.N_u,self.scan.binning.N_v) 
+            N = max(R['locations'].shape) 
+            self._sensitivity_full = self.scan.backproject(ones((1,N),dtype=float32,order="F"), offsets=R['offsets'], locations=R['locations']).data 
+        if subset is None: 
+            return self._sensitivity_full 
+        return self._sensitivity_full / len(self._subsets) 
+
+    def _constraint(self, activity): 
+        return self.scan._constraint(activity) 
+
+
+
         
+def _verify_roi_not_rotated(*rois): 
+    # The time-of-flight CPU projector translates the volumes by their ROI but does not rotate them 
+    for roi in rois: 
+        if roi.theta_x != 0 or roi.theta_y != 0 or roi.theta_z != 0: 
+            raise UnexpectedParameter("The time-of-flight projector does not support rotated ROIs (theta_x=%f, theta_y=%f, theta_z=%f). "%(roi.theta_x,roi.theta_y,roi.theta_z)) 
+
+
+def _roi_matrix(roi): 
+    # Convention of the ROI: a point s in the coordinates of the scanner is at R*s + [x,y,z] in the activity volume, 
+    # R = Rz*Ry*Rx (angles theta_x, theta_y, theta_z, see transformation_matrix_6DOF()). The rotations are verified 
+    # against the NiftyCore projectors by occiput/test/test_motion.py (TestROIConvention); the time-of-flight projector 
+    # implements the translation only. 
+    return transformation_matrix_6DOF([roi.x,roi.y,roi.z,roi.theta_x,roi.theta_y,roi.theta_z]) 
+
+
+def _moved_roi(roi, transformation): 
+    """ROI of the activity volume moved by 'transformation' (4x4, in the coordinates of the volume [mm]): the activity 
+    at v in the volume of 'roi' is at transformation*v in the volume of the new ROI. The rotations are composed. """
+    return ROI(tuple(parameters_6DOF(dot(transformation, _roi_matrix(roi))))) 
+
+
+def _copy_scan(scan, memo=None): 
+    """Copy of a scan, deep if 'memo' is given. The copy holds its own reference to the interface (see 
+    PET_interface.InterfaceHandle) and its own ilang model; it projects locally: the worker processes of the sharded 
+    projector are not copied. """
+    state = dict((key,value) for key,value in scan.__dict__.items() if key not in ['interface','_sharded_projector','ilang_model','graph','sampler']) 
+    copied = InstanceType(scan.__class__) 
+    if memo is not None: 
+        memo[id(scan)] = copied 
+        state = copy.deepcopy(state, memo) 
+    copied.__dict__.update(state) 
+    if '_sharded_projector' in scan.__dict__: 
+        copied._sharded_projector = None 
+    copied.interface = None 
+    copied.set_interface(scan.__dict__.get('interface')) 
+    copied._construct_ilang_model() 
+    return copied 
+
+
+
 class PET_Static_Scan(): 
     """PET Static Scan. """
     def __init__(self): 
@@ -397,16 +628,19 @@ class PET_Static_Scan():
         self._offsets          = None                           # 'offsets' and 'locations' define the structure of the sparse measurement (and projection) data
         self._locations        = None                           # 'offsets' and 'locations' define the structure of the sparse measurement (and projection) data
         self._measurement_data = None                           # measurement data, photon counts, locations are defined by 'offsets' and 'locations'
+        self._time_bin         = None                           # time bin of the measurement, for frames of a dynamic scan 
 
         self.activity_shape    = [128,128,128]  #FIXME: have a default value (from dictionary)
         self.activity_size     = [256,256,256]  #FIXME: have a default value (from dictionary), but adapt to the detector size, and also have a set method 
         self.attenuation_shape = [128,128,128]  #FIXME: have a default value (from dictionary)
         self.attenuation_size  = [256,256,256]  #FIXME: see previous line  
+        self.roi_activity      = None                            # Location of the activity volume (ROI); if None, the volume is at the center of the scanner 
         self.scanner_detected  = False                           # True if scanner model has been detected, False if unknown scanner model 
 
         self.projection_parameters     = ProjectionParameters()       
         self.backprojection_parameters = BackprojectionParameters()   
         self.enable_gpu_acceleration()                          # change to self.disable_gpu_acceleration() to disable by default      
+        self._sharded_projector = None                          # if not None, projections are distributed across worker processes 
 
         self._construct_ilang_model() 
         #self._display_node = DisplayNode() 
@@ -434,8 +668,44 @@ class PET_Static_Scan():
         self._subsets_generator = SubsetGenerator(self.binning.N_axial,self.binning.N_azimuthal) 
     
     def set_interface(self,interface): 
+        """The scan holds a reference to the (shared) handle of the interface, see PET_interface.InterfaceHandle. """
+        interface = InterfaceHandle.wrap(interface) 
+        if interface is not None: 
+            interface.acquire() 
+        if self.interface is not None: 
+            self.interface.release() 
         self.interface = interface 
 
+    def set_activity_shape(self, activity_shape): 
+        """Set the number of voxels of the activity volume. The normalization volume and the mask are recomputed 
+        when next needed. """
+        self.activity_shape = list(activity_shape) 
+        self._invalidate_activity_cache()
+
+    def set_activity_size(self, activity_size): 
+        """Set the physical size of the activity volume. """
+        self.activity_size = list(activity_size) 
+        self._invalidate_activity_cache()
+
+    def set_roi_activity(self, roi_activity): 
+        """Set the location of the activity volume with respect to the scanner. If None, the center of the 
+        activity volume is at the center of the scanner. """
+        if roi_activity is not None and not isinstance(roi_activity,ROI): 
+            roi_activity = ROI(roi_activity)
+        self.roi_activity = roi_activity 
+        self._invalidate_activity_cache()
+
+    def get_roi_activity(self): 
+        if self.roi_activity is None: 
+            # By default, the center of the imaging volume is at the center of the scanner 
+            return ROI((0.5*self.activity_size[0],0.5*self.activity_size[1],0.5*self.activity_size[2],0,0,0))
+        return self.roi_activity
+
+    def _invalidate_activity_cache(self): 
+        self._need_normalization_update = True 
+        if hasattr(self,"_mask"): 
+            del self._mask
+
     def load_listmode_file(self, hdr_filename, data_filename=None): 
         """Load measurement data from a listmode file. """
         print_debug("- Loading dynamic PET data from listmode file "+str(hdr_filename) )
@@ -515,6 +785,8 @@ class PET_Static_Scan():
         return self 
         
     def project(self,activity,attenuation=None,roi_activity=None,roi_attenuation=None,offsets=None,locations=None,subsets_matrix=None): 
+        if self._sharded_projector is not None: 
+            return self._sharded_projector.project(activity,attenuation,roi_activity,roi_attenuation,offsets,locations,subsets_matrix) 
         if isinstance(activity,ndarray): 
             activity = float32(activity)
         else: 
@@ -533,15 +805,17 @@ class PET_Static_Scan():
             offsets=self._offsets
         if locations is None:
             locations=self._locations
-        # By default, the center of the imaging volume is at the center of the scanner 
         if roi_activity  is None: 
-            roi_activity = ROI((0.5*self.activity_size[0],0.5*self.activity_size[1],0.5*self.activity_size[2],0,0,0))
+            roi_activity = self.get_roi_activity()
         # By default, the center of the imaging volume is at the center of the scanner 
         if roi_attenuation  is None: 
             roi_attenuation = ROI((0.5*self.attenuation_size[0],0.5*self.attenuation_size[1],0.5*self.attenuation_size[2],0,0,0))    
         # Handle no subsets
         if subsets_matrix is None: 
             subsets_matrix=self._subsets_generator.all_active()    
+        # Time-of-flight: CPU projector 
+        if self.binning.has_tof(): 
+            return self._project_tof(activity,attenuation,roi_activity,roi_attenuation,offsets,locations,subsets_matrix) 
         # Pass on to the C library all the parameters required for projection 
         projection_data = PET_project_compressed(activity,attenuation,offsets,locations, subsets_matrix, 
             self.binning.N_axial, self.binning.N_azimuthal, 
@@ -558,6 +832,8 @@ class PET_Static_Scan():
         return projection_data 
 
     def backproject(self, projection_data, attenuation=None, roi_activity=None, roi_attenuation=None, offsets=None, locations=None, subsets_matrix=None): 
+        if self._sharded_projector is not None: 
+            return Image3D(self._sharded_projector.backproject(projection_data,attenuation,roi_activity,roi_attenuation,offsets,locations,subsets_matrix)) 
         if isinstance(projection_data,ndarray): 
             projection_data = float32(projection_data)
         else: 
@@ -567,9 +843,8 @@ class PET_Static_Scan():
         if attenuation is not None: 
             if not list(attenuation.shape) == list(self.attenuation_shape): 
                 raise UnexpectedParameter("Activity must have the same shape as self.attenuation_shape")
-        # By default, the center of the imaging volume is at the center of the scanner 
         if roi_activity  is None: 
-            roi_activity = ROI((0.5*self.activity_size[0],0.5*self.activity_size[1],0.5*self.activity_size[2],0,0,0))
+            roi_activity = self.get_roi_activity()
         # By default, the center of the imaging volume is at the center of the scanner 
         if roi_attenuation  is None: 
             roi_attenuation = ROI((0.5*self.attenuation_size[0],0.5*self.attenuation_size[1],0.5*self.attenuation_size[2],0,0,0))  
@@ -580,6 +855,9 @@ class PET_Static_Scan():
         # Handle no subsets
         if subsets_matrix is None: 
             subsets_matrix=self._subsets_generator.all_active()
+        # Time-of-flight: CPU backprojector 
+        if self.binning.has_tof(): 
+            return Image3D(self._backproject_tof(projection_data,attenuation,roi_activity,roi_attenuation,offsets,locations,subsets_matrix)) 
         # Pass on to the C library all the parameters required for back-projection 
         backprojection = PET_backproject_compressed(projection_data,attenuation,offsets,locations, subsets_matrix, 
             self.binning.N_axial, self.binning.N_azimuthal, self.binning.angular_step_axial, self.binning.angular_step_azimuthal, 
@@ -594,15 +872,55 @@ class PET_Static_Scan():
             self.backprojection_parameters.direction, self.backprojection_parameters.block_size)
         return Image3D(backprojection)
       
+    def _lines_of_response(self, offsets, locations): 
+        """Axial and azimuthal index, axial and azimuthal angle, u and v of each location of the compressed projection data. """
+        cache = getattr(self,"_lines_of_response_cache",None) 
+        if cache is not None and cache[0] is offsets and cache[1] is locations and cache[2] == self.binning.export_dictionary(): 
+            return cache[3] 
+        index = self._locations_index(offsets, locations) 
+        bins = where(index.ravel() >= 0)[0] 
+        order = index.ravel()[bins].argsort() 
+        i_axial, i_azimuthal, i_u, i_v = unravel_index(bins[order], index.shape) 
+        lines = (i_axial, i_azimuthal, self.binning.get_angles_axial()[i_axial], self.binning.get_angles_azimuthal()[i_azimuthal], 
+                 self.binning.get_coordinates_u()[i_u], self.binning.get_coordinates_v()[i_v]) 
+        self._lines_of_response_cache = (offsets, locations, self.binning.export_dictionary(), lines) 
+        return lines 
+
+    def _project_tof(self, activity, attenuation, roi_activity, roi_attenuation, offsets, locations, subsets_matrix): 
+        """Time-of-flight projection (see PET_tof), returns an array N_tof x N_locations. The samples along the lines 
+        of response are spaced by half of the smallest voxel (projection_parameters.sample_step is a parameter of the 
+        GPU projector). """
+        _verify_roi_not_rotated(roi_activity, roi_attenuation) 
+        i_axial, i_azimuthal, theta, phi, u, v = self._lines_of_response(offsets, locations) 
+        active = asarray(subsets_matrix)[i_axial,i_azimuthal] != 0 
+        projection = zeros((self.binning.N_tof,theta.size),dtype=float32,order="F") 
+        projection[:,active] = PET_project_tof(activity, self.activity_size, (roi_activity.x,roi_activity.y,roi_activity.z), 
+            attenuation, self.attenuation_size, (roi_attenuation.x,roi_attenuation.y,roi_attenuation.z), 
+            theta[active], phi[active], u[active], v[active], self.binning.N_tof, self.binning.size_tof, self.binning.tof_resolution) 
+        return projection 
+
+    def _backproject_tof(self, projection_data, attenuation, roi_activity, roi_attenuation, offsets, locations, subsets_matrix): 
+        """Time-of-flight backprojection of projection data N_tof x N_locations (see PET_tof). """
+        _verify_roi_not_rotated(roi_activity, roi_attenuation) 
+        i_axial, i_azimuthal, theta, phi, u, v = self._lines_of_response(offsets, locations) 
+        active = asarray(subsets_matrix)[i_axial,i_azimuthal] != 0 
+        projection_data = projection_data.reshape((self.binning.N_tof,theta.size),order="F")[:,active] 
+        return PET_backproject_tof(projection_data, self.activity_shape, self.activity_size, (roi_activity.x,roi_activity.y,roi_activity.z), 
+            attenuation, self.attenuation_size, (roi_attenuation.x,roi_attenuation.y,roi_attenuation.z), 
+            theta[active], phi[active], u[active], v[active], self.binning.N_tof, self.binning.size_tof, self.binning.tof_resolution) 
+
     def get_measurement(self): 
-        return (self._measurement_data,self._locations,self._offsets)
+        """Snapshot of the measurement: read-only views of (counts, locations, offsets). """
+        return (read_only(self._measurement_data),read_only(self._locations),read_only(self._offsets))
 
     def uncompressed_measurement(self): 
         uncompressed_measurement = self.uncompress(self._measurement_data) 
         return uncompressed_measurement 
                
     def set_measurement_data(self,measurement_data): 
-        self._measurement_data = measurement_data 
+        """Set the measurement: array 1 x N_locations, or N_tof x N_locations with time-of-flight binning. 
+        A private copy of the data is stored. """
+        self._measurement_data = snapshot(measurement_data) 
 
     def uncompress(self, projection_data, offsets=None, locations=None, N_u=None, N_v=None):
         if offsets is None: 
@@ -615,6 +933,44 @@ class PET_Static_Scan():
             N_v=self.binning.N_v
         return self.interface.uncompress(offsets, projection_data, locations, N_u, N_v)
 
+    def uncompressed_array(self, projection_data, offsets=None, locations=None): 
+        """Uncompress projection data to a numpy array of shape (N_axial, N_azimuthal, N_u, N_v). The time-of-flight 
+        bins, if any, are summed. """
+        if not isinstance(projection_data,ndarray): 
+            projection_data = projection_data.data 
+        if projection_data.ndim == 2 and projection_data.shape[0] > 1: 
+            projection_data = float32(projection_data.sum(0)).reshape((1,projection_data.shape[1]),order="F") 
+        uncompressed = self.uncompress(projection_data, offsets, locations)
+        if not isinstance(uncompressed,ndarray): 
+            uncompressed = uncompressed.data
+        return float32(uncompressed).reshape((self.binning.N_axial,self.binning.N_azimuthal,self.binning.N_u,self.binning.N_v))
+
+    def compress_array(self, array, offsets=None, locations=None): 
+        """Inverse of uncompressed_array(): extract the projection data at the locations defined by 'offsets' 
+        and 'locations' from an array of shape (N_axial, N_azimuthal, N_u, N_v). """
+        if offsets is None: 
+            offsets=self._offsets
+        if locations is None:
+            locations=self._locations 
+        index = self._locations_index(offsets, locations) 
+        valid = index >= 0 
+        data = zeros(max(locations.shape),dtype=float32) 
+        data[index[valid]] = asarray(array,dtype=float32).reshape(index.shape)[valid] 
+        return data.reshape((1,data.size),order="F")
+
+    def _locations_index(self, offsets, locations): 
+        """Index of each bin of the uncompressed projection in the compressed projection data (-1 where a bin 
+        is not an active location). The index is obtained by uncompressing the sequence of location numbers, 
+        hence it does not depend on the internal layout of 'offsets' and 'locations'. """
+        N = max(locations.shape)
+        # location numbers are split in two parts so that they are exactly represented in single precision 
+        k = arange(N,dtype=int64) 
+        low  = self.uncompressed_array(float32(k % 4096 + 1).reshape((1,N),order="F"), offsets, locations)
+        high = self.uncompressed_array(float32(k // 4096 + 1).reshape((1,N),order="F"), offsets, locations)
+        index = (int64(rint(high))-1)*4096 + int64(rint(low))-1 
+        index[rint(low)==0] = -1
+        return index 
+
     def enable_gpu_acceleration(self): 
         self.projection_parameters.gpu_acceleration = 1 
         self.backprojection_parameters.gpu_acceleration = 1 
@@ -623,22 +979,61 @@ class PET_Static_Scan():
         self.projection_parameters.gpu_acceleration = 0 
         self.backprojection_parameters.gpu_acceleration = 0 
 
+    def share_memory(self): 
+        """Move the measurement to shared memory (see occiput.Core.SharedMemory), so that it is exchanged with 
+        worker processes as a lightweight handle rather than copied. """
+        self._measurement_data = to_shared(self._measurement_data) 
+        self._offsets          = to_shared(self._offsets) 
+        self._locations        = to_shared(self._locations) 
+        return self 
+
+    def enable_sharded_projection(self, n_workers=None): 
+        """Distribute the angles of project() and backproject() across n_workers processes (default: number of CPUs), 
+        see PET_parallel.ShardedProjector. The projector runs on the CPU: GPU acceleration is disabled. The worker 
+        processes are created here and terminated by disable_sharded_projection(). """
+        self.disable_gpu_acceleration() 
+        self.disable_sharded_projection() 
+        self._sharded_projector = ShardedProjector(self, n_workers) 
+
+    def disable_sharded_projection(self): 
+        if getattr(self,'_sharded_projector',None) is not None: 
+            self._sharded_projector.close() 
+        self._sharded_projector = None 
+
     def load_static_measurement(self, time_bin=None): 
         if time_bin  is None: 
             R = self.interface.get_measurement_static() 
         else: 
             R = self.interface.get_measurement(time_bin) 
+        self._time_bin         = time_bin 
         self.time_start        = R['time_start'] 
         self.time_end          = R['time_end'] 
         self.N_counts          = R['N_counts']         
         self.N_locations       = R['N_locations']
         self.compression_ratio = R['compression_ratio']
         self.listmode_loss     = R['listmode_loss']
-        self._offsets          = R['offsets'] 
-        self._locations        = R['locations'] 
-        self._measurement_data = R['counts'] 
+        # private copies: the measurement does not depend on the memory of the interface (see get_measurement()) 
+        self._offsets          = snapshot(R['offsets']) 
+        self._locations        = snapshot(R['locations']) 
+        self._measurement_data = snapshot(R['counts']) 
+        self._need_normalization_update = True 
         self._construct_ilang_model() 
 
+    def unload_measurement(self): 
+        """Release the memory of the measurement; it is reloaded from the interface by load_static_measurement(). """
+        self._measurement_data = None 
+        self._offsets          = None 
+        self._locations        = None 
+        self._lines_of_response_cache = None 
+        self._need_normalization_update = True 
+
+    def is_measurement_loaded(self): 
+        return self._measurement_data is not None 
+
+    def get_measurement_nbytes(self): 
+        """Memory occupied by the measurement, [bytes]. """
+        return sum([asarray(a).nbytes for a in (self._measurement_data, self._offsets, self._locations) if a is not None]) 
+
     def set_full_sampling(self): 
         R = self.interface.full_sampling(self.binning.N_axial,self.binning.N_azimuthal,self.binning.N_u,self.binning.N_v) 
         self._offsets          = R['offsets'] 
@@ -677,7 +1072,7 @@ class PET_Static_Scan():
         return self._normalization
     
     def _update_normalization(self): 
-        self._normalization = self.backproject(ones((1,self.N_locations),dtype=float32,order="F")) 
+        self._normalization = self.backproject(ones((self.binning.N_tof,self.N_locations),dtype=float32,order="F")) 
         self._normalization.data = self._normalization.data + EPS
         self._need_normalization_update = False 
 
@@ -694,32 +1089,297 @@ class PET_Static_Scan():
             self._mask = uniform_cylinder(self.activity_shape, self.activity_size, [0.5*self.activity_size[0], 0.5*self.activity_size[1], 0.5*self.activity_size[2]], radius, self.activity_size[2], 2, 1, 0)
         return self._mask
         
-    def estimate_activity(self,iterations = DEFAULT_RECON_ITERATIONS, subset_size = DEFAULT_SUBSET_SIZE, subset_mode='random', epsilon=None): 
+    def get_support_box(self, threshold=DEFAULT_SUPPORT_THRESHOLD, margin=DEFAULT_SUPPORT_MARGIN, attenuation=None, downsampling=DEFAULT_SUPPORT_DOWNSAMPLING, iterations=DEFAULT_SUPPORT_ITERATIONS): 
+        """Estimate the bounding box of the object, in voxels of the activity volume: [[i0,i1],[j0,j1],[k0,k1]]. 
+        The support is the set of voxels above 'threshold' times the maximum of the attenuation map, if given, 
+        otherwise of a quick MLEM estimate of the activity ('iterations' iterations, no subsets, at resolution reduced 
+        by 'downsampling'). A plain backprojection is not used: its 1/r tails would exceed the threshold over most of 
+        the field of view, whereas the MLEM estimate is normalized by the sensitivity and its tails decay quickly. """
+        if attenuation is not None: 
+            if not isinstance(attenuation,ndarray): 
+                attenuation = attenuation.data
+            support = attenuation > threshold * attenuation.max() 
+            size = self.attenuation_size
+        else: 
+            full_shape = list(self.activity_shape)
+            state = (self._normalization, self._need_normalization_update, getattr(self,"_mask",None))
+            try: 
+                self.set_activity_shape([max(1,int(round(full_shape[k]*1.0/downsampling))) for k in range(3)])
+                mask = self.get_mask().data 
+                sensitivity = self.get_normalization().data 
+                estimate = ones(self.activity_shape,dtype=float32,order="F") * mask 
+                for i in range(iterations): 
+                    projection = asarray(self.project(estimate)) 
+                    estimate = estimate * self.backproject((self._measurement_data+EPS)/(projection+EPS)).data / sensitivity * mask 
+            finally: 
+                self.set_activity_shape(full_shape)
+                self._normalization, self._need_normalization_update = state[0], state[1] 
+                if state[2] is not None: 
+                    self._mask = state[2]
+            support = estimate > threshold * estimate.max() 
+            size = self.activity_size
+        box = [] 
+        for k in range(3): 
+            # indices of the slices (along axis k) that intersect the support
+            other_axes = tuple([a for a in range(3) if a != k])
+            active = where(support.any(axis=other_axes))[0]
+            voxel_support  = size[k]*1.0/support.shape[k]
+            voxel_activity = self.activity_size[k]*1.0/self.activity_shape[k]
+            if active.size == 0: 
+                box.append([0,self.activity_shape[k]])
+                continue
+            # physical extent with respect to the center of the volume, then voxels of the activity volume 
+            low  = active[0]*voxel_support - 0.5*size[k] - margin
+            high = (active[-1]+1)*voxel_support - 0.5*size[k] + margin
+            low  = int((low + 0.5*self.activity_size[k]) // voxel_activity)
+            high = int(-((-high - 0.5*self.activity_size[k]) // voxel_activity))
+            box.append([min(max(low,0),self.activity_shape[k]-1), max(min(high,self.activity_shape[k]),1)])
+        return box 
+
+    def _crop_activity_volume(self, box): 
+        """Restrict the activity volume to the voxels box=[[i0,i1],[j0,j1],[k0,k1]]: activity_shape, activity_size, 
+        ROI and mask are adapted, so that the projector only processes the box. Returns the state to be passed 
+        to _restore_activity_volume(). """
+        state = (list(self.activity_shape), list(self.activity_size), self.roi_activity, self.get_mask(), self._normalization, self._need_normalization_update)
+        roi   = self.get_roi_activity()
+        voxel = [self.activity_size[k]*1.0/self.activity_shape[k] for k in range(3)]
+        shape = [box[k][1]-box[k][0] for k in range(3)]
+        self.set_activity_shape(shape)
+        self.set_activity_size([shape[k]*voxel[k] for k in range(3)])
+        # FIXME: the translation of the ROI assumes that the activity volume is not rotated 
+        self.set_roi_activity(ROI((roi.x-box[0][0]*voxel[0], roi.y-box[1][0]*voxel[1], roi.z-box[2][0]*voxel[2], roi.theta_x, roi.theta_y, roi.theta_z)))
+        self._mask = Image3D(asfortranarray(state[3].data[box[0][0]:box[0][1],box[1][0]:box[1][1],box[2][0]:box[2][1]]))
+        return state 
+
+    def _restore_activity_volume(self, state): 
+        self.set_activity_shape(state[0])
+        self.set_activity_size(state[1])
+        self.set_roi_activity(state[2])
+        self._mask = state[3]
+        self._normalization, self._need_normalization_update = state[4], state[5]
+
+    def estimate_activity(self,iterations = DEFAULT_RECON_ITERATIONS, subset_size = DEFAULT_SUBSET_SIZE, subset_mode='random', epsilon=None, activity=None, crop_to_support=False, method='osem'): 
+        """Estimate the activity. 'method' is the name of an iterative algorithm ('osem', 'ros', 'bsrem', 'pcg'; 
+        see occiput.Reconstruction.Algorithms) or an instance of ReconstructionAlgorithm. If crop_to_support is True, the iterations are restricted 
+        to the bounding box of the object (see get_support_box()) and the result is pasted back into the full volume. 
+        With time-of-flight binning (binning.N_tof > 1) the measurement has one row per TOF bin and the TOF projector is used. """
         if epsilon is None: 
             epsilon=EPS
+        if self.binning.has_tof() and asarray(self._measurement_data).shape[0] != self.binning.N_tof: 
+            raise UnexpectedParameter("Time-of-flight binning: the measurement must have N_tof=%d rows (see set_measurement_data()). "%self.binning.N_tof)
+        if crop_to_support: 
+            box = self.get_support_box()
+            print_debug("- Reconstruction restricted to the support of the object: %s "%str(box))
+            if activity is not None: 
+                if not isinstance(activity,ndarray): 
+                    activity = activity.data
+                activity = activity[box[0][0]:box[0][1],box[1][0]:box[1][1],box[2][0]:box[2][1]]
+            state = self._crop_activity_volume(box)
+            try: 
+                cropped = self.estimate_activity(iterations, subset_size, subset_mode, epsilon, activity, method=method).data
+            finally: 
+                self._restore_activity_volume(state)
+            activity = zeros(self.activity_shape,dtype=float32,order="F")
+            activity[box[0][0]:box[0][1],box[1][0]:box[1][1],box[2][0]:box[2][1]] = cropped
+            return Image3D(activity)
         progress_bar = ProgressBar() 
         progress_bar.set_percentage(0.1)
-        activity = ones(self.activity_shape,dtype=float32,order="F")
-        for i in range(iterations):
-            # Subsets: 
-            if subset_size is None:
-                subsets_matrix=None
-            else: 
-                subsets_matrix = self._subsets_generator.new_subset(subset_mode,subset_size)
-            proj = self.project(activity,subsets_matrix=subsets_matrix)
-            if subset_size is None:
-                norm = self.get_normalization()  
-            else: 
-                norm = self.backproject(ones((1,self.N_locations),dtype=float32,order="F"), subsets_matrix=subsets_matrix) 
-            update = (self.backproject( (self._measurement_data+epsilon)/(proj+epsilon) ,subsets_matrix=subsets_matrix).data+epsilon) / (norm.data +epsilon) 
-
-            activity = activity * update * self.get_mask().data
-
-            progress_bar.set_percentage((i+1)*100.0/iterations) 
-            #print "Iteration: %d    max act: %f    min act: %f    max proj: %f    min proj: %f    max norm: %f    min norm: %f"%(i, activity.max(), activity.min(), proj.max(), proj.min(), norm.data.max(), norm.data.min() )
+        if activity is None: 
+            activity = ones(self.activity_shape,dtype=float32,order="F")
+        else: 
+            if not isinstance(activity,ndarray): 
+                activity = activity.data
+            if not list(activity.shape) == list(self.activity_shape): 
+                raise UnexpectedParameter("Initial activity must have the same shape as self.activity_shape")
+            activity = asfortranarray(float32(activity))
+        algorithm = get_algorithm(method, epsilon)
+        activity = algorithm.run(self, activity, iterations, subset_size, subset_mode, progress_bar.set_percentage)
         progress_bar.set_percentage(100.0)
+        return Image3D(asfortranarray(activity))
+
+    # The following methods expose the projection model to the reconstruction algorithms (occiput.Reconstruction.Algorithms)
+    def _new_subset(self, subset_size, subset_mode): 
+        if subset_size is None: 
+            return None 
+        return self._subsets_generator.new_subset(subset_mode,subset_size)
+
+    def _n_subsets(self, subset_size): 
+        if subset_size is None: 
+            return 1 
+        return max(1, int(self.binning.N_axial*self.binning.N_azimuthal/subset_size)) 
+
+    def _forward(self, activity, subset): 
+        return self.project(activity,subsets_matrix=subset) 
+
+    def _backward(self, projection_data, subset): 
+        return self.backproject(projection_data,subsets_matrix=subset).data 
+
+    def _measured(self, subset): 
+        return self._measurement_data 
+
+    def _sensitivity(self, subset): 
+        if subset is None: 
+            return self.get_normalization().data 
+        return self.backproject(ones((self.binning.N_tof,self.N_locations),dtype=float32,order="F"), subsets_matrix=subset).data 
+
+    def _constraint(self, activity): 
+        return activity * self.get_mask().data 
+
+    def get_listmode_events(self, shuffle=True, seed=None): 
+        """Event stream of the measurement: one location number (index in the compressed projection data) per 
+        count. The binned measurement does not retain the order of arrival, hence the events are shuffled, 
+        so that consecutive blocks of the stream are statistically equivalent. """
+        counts = int64(rint(asarray(self._measurement_data).ravel()))
+        events = repeat(arange(counts.size,dtype=int64), maximum(counts,0))
+        if shuffle: 
+            RandomState(seed).shuffle(events) 
+        return events 
+
+    def estimate_activity_listmode(self, iterations=DEFAULT_RECON_ITERATIONS, n_subsets=DEFAULT_LISTMODE_SUBSETS, events=None, epsilon=None, activity=None, method='osem'): 
+        """Listmode (event-by-event) reconstruction: each sub-iteration projects and backprojects only along the 
+        lines of response of one block of the event stream, hence the work per iteration scales with the number 
+        of counts rather than with the size of the sinogram. 'events' is a sequence of location numbers in order of 
+        arrival (see get_listmode_events(), used if 'events' is None). 'method' is as in estimate_activity(). """
+        if epsilon is None: 
+            epsilon=EPS 
+        if events is None: 
+            events = self.get_listmode_events() 
+        progress_bar = ProgressBar() 
+        progress_bar.set_percentage(0.1) 
+        if activity is None: 
+            activity = ones((self.activity_shape[0],self.activity_shape[1],self.activity_shape[2]),dtype=float32, order="F")
+        else: 
+            if not isinstance(activity,ndarray): 
+                activity = activity.data 
+            if not list(activity.shape) == list(self.activity_shape): 
+                raise UnexpectedParameter("Initial activity must have the same shape as self.activity_shape")
+            activity = asfortranarray(float32(activity))
+        model = ListmodeSubsets(self, events, n_subsets) 
+        activity = get_algorithm(method, epsilon).run(model, activity, iterations, None, None, progress_bar.set_percentage) 
+        progress_bar.set_percentage(100.0)
+        return Image3D(asfortranarray(activity))
+
+    def estimate_activity_multiresolution(self, iterations=DEFAULT_MULTIRESOLUTION_ITERATIONS, downsampling=DEFAULT_MULTIRESOLUTION_DOWNSAMPLING, subset_size=DEFAULT_SUBSET_SIZE, subset_mode='random', epsilon=None, method='osem'): 
+        """Coarse-to-fine reconstruction. Level k runs iterations[k] iterations with activity_shape reduced by the factor 
+        downsampling[k]; the estimate is then upsampled and used to initialise the next level. subset_size is either 
+        a scalar or a list with one entry per level. """
+        if len(iterations) != len(downsampling): 
+            raise UnexpectedParameter("'iterations' and 'downsampling' must have the same number of resolution levels.")
+        if subset_size is None or isscalar(subset_size): 
+            subset_size = [subset_size]*len(iterations)
+        full_shape = list(self.activity_shape)
+        activity = None 
+        try: 
+            for level in range(len(iterations)): 
+                shape = [max(1,int(round(full_shape[k]*1.0/downsampling[level]))) for k in range(3)]
+                print_debug("- Multi-resolution reconstruction, level %d: activity_shape %s, %d iterations "%(level,str(shape),iterations[level]))
+                self.set_activity_shape(shape)
+                if activity is not None and list(activity.shape) != shape: 
+                    activity = resample_activity(activity, self.activity_size, shape)
+                activity = self.estimate_activity(iterations[level], subset_size[level], subset_mode, epsilon, activity=activity, method=method).data
+        finally: 
+            self.set_activity_shape(full_shape)
+        if list(activity.shape) != full_shape: 
+            activity = resample_activity(activity, self.activity_size, full_shape)
         return Image3D(activity)
             
+    def rebin(self, method='ssrb'): 
+        """Rebin the 3D measurement into a stack of 2D sinograms. Returns a new PET_Static_Scan, with the same interface 
+        and imaging volume and with N_azimuthal=1, that reconstructs with (much cheaper) 2D projections. 
+        Single slice rebinning ('ssrb') assigns each oblique projection to the transaxial plane that contains the 
+        midpoint of its lines of response. """
+        if method == 'fore': 
+            raise UnexpectedParameter("'%s' rebinning not yet supported."%str(method))
+        elif method != 'ssrb': 
+            raise UnexpectedParameter("'method' parameter %s not recognised."%str(method))
+        sinogram = self.uncompressed_array(self._measurement_data) 
+        v = self.binning.get_coordinates_v() 
+        step_v = self.binning.size_v * 1.0 / self.binning.N_v 
+        rebinned = zeros((self.binning.N_axial,1,self.binning.N_u,self.binning.N_v),dtype=float32) 
+        n_segments = zeros(self.binning.N_v,dtype=float32) 
+        for j, phi in enumerate(self.binning.get_angles_azimuthal()): 
+            # the lines of response that project onto v in the oblique plane cross the axis of the scanner at z = v/cos(phi): 
+            # direct plane z receives the oblique data at v = z*cos(phi)
+            positions = (v*cos(phi) + 0.5*self.binning.size_v) / step_v - 0.5 
+            values, valid = interpolate_along_axis(sinogram[:,j,:,:], positions, axis=2) 
+            # the oblique lines of response are longer by a factor 1/cos(phi) 
+            rebinned[:,0,:,:] += values * cos(phi) 
+            n_segments += valid 
+        rebinned = rebinned / maximum(n_segments,1).reshape((1,1,1,self.binning.N_v)) 
+        binning = self.binning.export_dictionary() 
+        binning['n_azimuthal'] = 1 
+        binning['angular_step_azimuthal'] = 0.0 
+        return self._derived_scan(Binning(binning), rebinned) 
+
+    def downsample(self, axial=1, u=1, v=1): 
+        """Downsample the measurement in the projection domain: 'axial' adjacent axial angles are merged (angular mashing), 
+        'u' adjacent radial bins and 'v' adjacent planes are merged. Returns a new PET_Static_Scan with the coarser binning 
+        (see Binning.downsample()), for 'draft' reconstructions at a fraction of the cost of the projector. 
+        The merged bins are averaged rather than summed, so that the reconstructed images have the same scale. """
+        binning = self.binning.downsample(axial, u, v) 
+        sinogram = self.uncompressed_array(self._measurement_data) 
+        N_axial, N_azimuthal, N_u, N_v = sinogram.shape 
+        if axial > 1: 
+            # Output angle k is at k*axial*angular_step_axial: input angles within 'axial' steps contribute with 
+            # triangular weights, so that each input angle contributes to the output with total weight 1. 
+            # Angles before 0 wrap around to the end of [0,pi): the projection at angle theta-pi is the projection 
+            # at theta, with u reversed and opposite azimuthal angle. 
+            wrapped  = sinogram[N_axial-(axial-1):,::-1,::-1,:] 
+            extended = concatenate((wrapped,sinogram),axis=0) 
+            mashed = zeros((N_axial/axial,N_azimuthal,N_u,N_v),dtype=float32) 
+            for d in range(-(axial-1),axial): 
+                start = axial-1+d 
+                mashed += (axial-abs(d))*1.0/axial * extended[start:start+N_axial:axial,:,:,:] 
+            sinogram = mashed / axial 
+        if u > 1: 
+            sinogram = sinogram.reshape((sinogram.shape[0],N_azimuthal,N_u/u,u,N_v)).mean(3) 
+        if v > 1: 
+            sinogram = sinogram.reshape((sinogram.shape[0],N_azimuthal,N_u/u,N_v/v,v)).mean(4) 
+        return self._derived_scan(binning, sinogram) 
+
+    def _derived_scan(self, binning, measurement): 
+        """New PET_Static_Scan with the same interface, imaging volume and settings as this scan, with the given binning 
+        and measurement (array of shape (N_axial, N_azimuthal, N_u, N_v)) stored with full sampling. The derived 
+        scan has no time-of-flight bins. """
+        binning.N_tof = 1 
+        scan = PET_Static_Scan() 
+        scan.set_interface(self.interface) 
+        scan.set_binning(binning) 
+        scan.set_full_sampling() 
+        scan._measurement_data = scan.compress_array(measurement) 
+        scan.N_counts          = self.N_counts 
+        scan.time_start        = self.time_start 
+        scan.time_end          = self.time_end 
+        scan.listmode_loss     = self.listmode_loss 
+        scan.compression_ratio = 1.0 
+        scan.scanner_detected  = self.scanner_detected 
+        scan.activity_shape    = list(self.activity_shape) 
+        scan.activity_size     = list(self.activity_size) 
+        scan.attenuation_shape = list(self.attenuation_shape) 
+        scan.attenuation_size  = list(self.attenuation_size) 
+        scan.roi_activity      = self.roi_activity 
+        scan.projection_parameters     = copy.copy(self.projection_parameters) 
+        scan.backprojection_parameters = copy.copy(self.backprojection_parameters) 
+        scan._construct_ilang_model() 
+        return scan 
+
+    def estimate_activity_fbp(self, window=DEFAULT_FBP_WINDOW, cutoff=DEFAULT_FBP_CUTOFF): 
+        """Quick-look reconstruction by filtered backprojection: the uncompressed sinogram is ramp-filtered along 
+        the radial direction and backprojected once. Oblique (azimuthal) projections are filtered as 2D projections 
+        and averaged, without reprojection of the missing data. No correction for attenuation or randoms is applied: 
+        the image is meant for quality control. """
+        print_debug("- Filtered backprojection, window: %s, cutoff: %f "%(window,cutoff))
+        sinogram = self.uncompressed_array(self._measurement_data)
+        filtered = ramp_filter(sinogram, axis=2, pixel_size=self.binning.size_u*1.0/self.binning.N_u, window=window, cutoff=cutoff)
+        R = self.interface.full_sampling(self.binning.N_axial,self.binning.N_azimuthal,self.binning.N_u,self.binning.N_v) 
+        offsets   = R['offsets']
+        locations = R['locations']
+        filtered = self.compress_array(filtered, offsets, locations)
+        activity = self.backproject(filtered, offsets=offsets, locations=locations).data 
+        # angular sampling of the axial angles in [0,pi); each azimuthal segment contributes one estimate
+        activity = activity * pi / (self.binning.N_axial * self.binning.N_azimuthal) * self.get_mask().data
+        return Image3D(asfortranarray(float32(activity)))
+
     def volume_render(self,volume,scale=1.0): 
         # FIXME: use the VolumeRender object in occiput.Visualization (improve it), the following is a quick fix: 
         R = self.interface.full_sampling(180,1,256,256) 
@@ -788,8 +1448,17 @@ class PET_Static_Scan():
         table = ipy_table.set_global_style(float_format="%3.3f")        
         return table._repr_html_()
 
+    def __copy__(self): 
+        return _copy_scan(self) 
+
+    def __deepcopy__(self, memo): 
+        return _copy_scan(self, memo) 
+
     def __del__(self):
-        del(self.interface) 
+        """Release the interface: its memory is freed when no other scan refers to it. """
+        self.disable_sharded_projection() 
+        if getattr(self,'interface',None) is not None: 
+            self.interface.release() 
 
 
         
@@ -828,6 +1497,12 @@ class PET_Dynamic_Scan():
             self.binning = Binning(binning)
 
     def set_interface(self,interface): 
+        """The scan holds a reference to the (shared) handle of the interface, see PET_interface.InterfaceHandle. """
+        interface = InterfaceHandle.wrap(interface) 
+        if interface is not None: 
+            interface.acquire() 
+        if self.interface is not None: 
+            self.interface.release() 
         self.interface = interface 
 
     def _construct_ilang_model(self):
@@ -844,8 +1519,9 @@ class PET_Dynamic_Scan():
     def plot_motion_parameters(self): 
         self.__motion_events.plot_motion()
         
-    def load_listmode_file(self, hdr_filename, time_bins=None, data_filename=None, motion_files_path=None): 
-        """Load measurement data from a listmode file. """
+    def load_listmode_file(self, hdr_filename, time_bins=None, data_filename=None, motion_files_path=None, lazy=False): 
+        """Load measurement data from a listmode file. If lazy is True, the measurement of each frame is extracted 
+        from the interface only when it is needed (see load_frame()). """
         #Optionally load motion information: 
         if motion_files_path: 
             vNAV = load_vnav_mprage(motion_files_path) 
@@ -944,7 +1620,10 @@ class PET_Dynamic_Scan():
             PET_t = PET_Static_Scan() 
             PET_t.set_interface(self.interface) 
             PET_t.set_binning(self.binning) 
-            PET_t.load_static_measurement(t) 
+            if lazy: 
+                PET_t._time_bin = t 
+            else: 
+                PET_t.load_static_measurement(t) 
             PET_t.scanner_detected = self.scanner_detected 
             # make list of static scans
             self._dynamic.append(PET_t) 
@@ -973,12 +1652,85 @@ class PET_Dynamic_Scan():
         self.N_locations              = R['N_locations']
         self.compression_ratio        = R['compression_ratio']
         self.listmode_loss            = R['listmode_loss']    
-        self._offsets                 = R['offsets']
-        self._locations               = R['locations'] 
-        self._static_measurement_data = R['counts'] 
+        self._offsets                 = snapshot(R['offsets'])
+        self._locations               = snapshot(R['locations']) 
+        self._static_measurement_data = snapshot(R['counts']) 
+
+    def load_frame(self, t): 
+        """Frame t, with its measurement loaded. """
+        frame = self._dynamic[t] 
+        if not frame.is_measurement_loaded(): 
+            frame.load_static_measurement(t) 
+        return frame 
+
+    def reconstruct_frames(self, reconstruct=None, save=None, frames=None, queue_depth=DEFAULT_QUEUE_DEPTH, memory_ceiling=None, **kwds): 
+        """Reconstruct the frames with a pipeline that loads the next frames and saves the previous ones in background 
+        threads while a frame is reconstructed (see PET_pipeline.FramePipeline). 'reconstruct' is a function of the frame 
+        (default: frame.estimate_activity(**kwds)); 'save' is a function (t, image) or a file name pattern such as 
+        'frame_%03d.nii'. Returns the list of the reconstructed images. """
+        if reconstruct is None: 
+            reconstruct = lambda frame: frame.estimate_activity(**kwds) 
+        pipeline = FramePipeline(self, reconstruct, save, queue_depth, memory_ceiling) 
+        return pipeline.run(frames) 
+
+    def estimate_motion(self, reference='static', frames=None, reconstruct=None, degrees_of_freedom=6, cost_function=DEFAULT_MOTION_COST, 
+                        sigma=DEFAULT_MOTION_SIGMA, n_workers=None, set_roi=None, iterations=DEFAULT_MOTION_ITERATIONS, n_points=None, **kwds): 
+        """Estimate the rigid motion of each frame with respect to the reference: 'static' (the static scan) or the 
+        index of a frame. The frames are reconstructed quickly ('reconstruct' is a function of the frame, default: 
+        frame.estimate_activity(iterations, **kwds)) and registered onto the reconstruction of the reference in 
+        n_workers processes, each frame starting from the motion of the previous frame (see 
+        occiput.Registration.TranslationRotation.register_to_reference()), on n_points points (default: the voxels of 
+        the reference). Returns the list of the motion parameters [tx,ty,tz,rx,ry,rz] ([mm] and [rad]) of the frames: 
+        the transformation (see transformation_matrix_6DOF()) that moves the reconstruction of the frame onto the 
+        reconstruction of the reference, in the coordinates of the activity volume, with rotations about the center of 
+        the reference volume. If set_roi is True, the motion is compensated by the roi_activity of each frame, so that 
+        the frames are then reconstructed in the space of the reference (see _moved_roi()). With time-of-flight binning 
+        the ROIs can only be translated: set_roi (default: True, False if the frames have time-of-flight binning) raises 
+        UnexpectedParameter for rotated time-of-flight frames, before any ROI is modified. """
+        if reconstruct is None: 
+            reconstruct = lambda frame: frame.estimate_activity(iterations, **kwds) 
+        if frames is None: 
+            frames = range(len(self._dynamic)) 
+        frames = list(frames) 
+        images = self.reconstruct_frames(reconstruct, frames=frames) 
+        if reference == 'static': 
+            reference_scan = self.static 
+            reference_image = reconstruct(self.static) 
+        elif reference in frames: 
+            reference_scan = self._dynamic[reference] 
+            reference_image = images[frames.index(reference)] 
+        else: 
+            reference_scan = self.load_frame(reference) 
+            reference_image = reconstruct(reference_scan) 
+        # images in the coordinates of the activity volume [mm]: voxel i is centered at (i+0.5)*voxel, as in the projectors 
+        def to_space(image, scan): 
+            voxel = [scan.activity_size[k]*1.0/scan.activity_shape[k] for k in range(3)] 
+            affine = diag(voxel+[1]) 
+            affine[0:3,3] = [0.5*v for v in voxel] 
+            return Image3D(data=image.data, affine=affine, space="world") 
+        images = [to_space(image, self._dynamic[t]) for image, t in zip(images, frames)] 
+        reference_image = to_space(reference_image, reference_scan) 
+        if n_points is None: 
+            n_points = list(reference_image.shape) 
+        motion = register_to_reference(images, reference_image, None, degrees_of_freedom, sigma, cost_function, n_workers, n_points=n_points) 
+        motion = [concatenate((m, zeros(6-m.size))) for m in motion] 
+        if set_roi is None: 
+            set_roi = not any(self._dynamic[t].binning.has_tof() for t in frames) 
+        if set_roi: 
+            # as register_to_reference(): rotations about the center of the reference 
+            center = reference_image.get_world_grid(reference_image.shape).center() 
+            rois = [_moved_roi(self._dynamic[t].get_roi_activity(), transformation_matrix_6DOF(m, center)) for t, m in zip(frames, motion)] 
+            # verify all the ROIs before modifying the frames 
+            for t, roi in zip(frames, rois): 
+                if self._dynamic[t].binning.has_tof() and (roi.theta_x != 0 or roi.theta_y != 0 or roi.theta_z != 0): 
+                    raise UnexpectedParameter("The time-of-flight projector does not support rotated ROIs: estimate the motion with degrees_of_freedom=3, or set_roi=False. ") 
+            for t, roi in zip(frames, rois): 
+                self._dynamic[t].set_roi_activity(roi) 
+        return motion 
 
     def get_static_measurement(self): 
-        return (self._static_measurement_data,self._locations,self._offsets)
+        """Snapshot of the static measurement: read-only views of (counts, locations, offsets). """
+        return (read_only(self._static_measurement_data),read_only(self._locations),read_only(self._offsets))
 
     def uncompressed_measurement(self): 
         uncompressed_measurement = self.uncompress(self._static_measurement_data) 
@@ -1073,10 +1825,17 @@ class PET_Dynamic_Scan():
         """This method makes the object addressable like a list. """
         return self._dynamic[i] 
 
+    def __copy__(self): 
+        return _copy_scan(self) 
+
+    def __deepcopy__(self, memo): 
+        return _copy_scan(self, memo) 
+
     def __del__(self):
-        """Delete interface when the object is deleted: interface needs explicit 
-        deletion in order to manage C library memory deallocation  """
-        self.interface.free_memory()
+        """Release the interface: the memory of the C library is freed when neither the dynamic scan nor any 
+        of its frames refer to it, hence the frames can outlive the dynamic scan. """
+        if getattr(self,'interface',None) is not None: 
+            self.interface.release() 
 
         
         
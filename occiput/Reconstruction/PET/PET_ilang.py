@@ -10,10 +10,19 @@ import ilang
 import ilang.Models 
 from ilang.Models import Model 
 from ilang.Graphs import ProbabilisticGraphicalModel 
+import weakref 
 
 __all__ = ['PET_Static_Poisson','PET_Dynamic_Poisson','ProbabilisticGraphicalModel']
 
 
+def _scan_reference(PET_scan): 
+    # The scan owns its model: a weak reference avoids a reference cycle, that would prevent the scan from 
+    # releasing its interface when deleted (see PET_interface.InterfaceHandle) 
+    if PET_scan is None or isinstance(PET_scan, weakref.ProxyTypes): 
+        return PET_scan 
+    return weakref.proxy(PET_scan) 
+
+
 
 class PET_Static_Poisson(Model): 
     variables = {'lambda':'continuous','alpha':'continuous','z':'discrete'} 
@@ -24,12 +33,12 @@ class PET_Static_Poisson(Model):
             name = self.__class__.__name__
         Model.__init__(self, name) 
         # PET scan
-        self.PET_scan = PET_scan    
+        self.PET_scan = _scan_reference(PET_scan)    
         # small number
         self.EPS = 1e9
 
     def set_PET_scan(self, PET_scan): 
-        self.PET_scan = PET_scan 
+        self.PET_scan = _scan_reference(PET_scan) 
 
     def init(self): 
         pass 
@@ -67,7 +76,7 @@ class PET_Dynamic_Poisson(Model):
             name = self.__class__.__name__
         Model.__init__(self, name) 
         # PET scan object: 
-        self.PET_scan = PET_scan 
+        self.PET_scan = _scan_reference(PET_scan) 
         self.N_time_bins = self.PET_scan.N_time_bins 
         # Variables and dependencies: 
         self._lambda = None 
@@ -85,7 +94,7 @@ class PET_Dynamic_Poisson(Model):
             self.dependencies.append([var_name_roi,var_name_counts,'directed']) 
 
     def set_PET_scan(self, PET_scan): 
-        self.PET_scan = PET_scan 
+        self.PET_scan = _scan_reference(PET_scan) 
 
     def init(self): 
         pass 
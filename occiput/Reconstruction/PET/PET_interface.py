@@ -0,0 +1,103 @@
+
+# occiput
+# Stefano Pedemonte
+# Harvard University, Martinos Center for Biomedical Imaging
+# Boston, MA, USA
+
+# Reference-counted, thread-safe handles to the PET scanner interfaces (C library). The interface is shared by
+# the dynamic scan and by its frames: each scan acquires the handle when it is assigned and releases it when it
+# is deleted; the memory of the C library is freed when the last scan releases the handle. Calls to the
+# interface are serialized by a lock, so that frames can be used from multiple threads.
+
+
+__all__ = ['InterfaceHandle','snapshot','read_only']
+
+
+import threading
+import numpy
+
+
+
+def snapshot(array):
+    """Private copy of 'array': it does not depend on the memory of the C library. """
+    if array is None:
+        return None
+    return numpy.array(array, copy=True, order="K")
+
+
+def read_only(array):
+    """Read-only view of 'array': the snapshots are exposed as read-only views, while the (writeable) private
+    copies are passed to the C library. """
+    if not isinstance(array,numpy.ndarray):
+        return array
+    view = array.view()
+    view.flags.writeable = False
+    return view
+
+
+
+class InterfaceHandle(object):
+    """Handle to a scanner interface: attributes are forwarded to the interface, method calls are executed
+    while holding the lock of the handle. Use InterfaceHandle.wrap() to obtain the handle of an interface. """
+    def __init__(self, interface):
+        self.__dict__['_interface'] = interface
+        self.__dict__['_lock']      = threading.RLock()
+        self.__dict__['_count']     = 0
+
+    @staticmethod
+    def wrap(interface):
+        if interface is None or isinstance(interface, InterfaceHandle):
+            return interface
+        return InterfaceHandle(interface)
+
+    def acquire(self):
+        with self._lock:
+            if self._interface is None:
+                raise RuntimeError("The scanner interface has already been released. ")
+            self.__dict__['_count'] = self._count + 1
+        return self
+
+    def release(self):
+        """Release one reference; when no references are left, free the memory of the C library. """
+        with self._lock:
+            if self._count == 0:
+                return
+            self.__dict__['_count'] = self._count - 1
+            if self._count == 0 and self._interface is not None:
+                if hasattr(self._interface,'free_memory'):
+                    self._interface.free_memory()
+                self.__dict__['_interface'] = None
+
+    def get_reference_count(self):
+        return self._count
+
+    def __getattr__(self, name):
+        # handles created without __init__ (e.g. by copy or pickle) have no interface
+        interface = self.__dict__.get('_interface')
+        if interface is None:
+            raise AttributeError("The scanner interface has been released: no attribute %s. "%name)
+        attribute = getattr(interface, name)
+        if not callable(attribute):
+            return attribute
+        lock = self._lock
+        def locked_call(*args, **kwds):
+            with lock:
+                return attribute(*args, **kwds)
+        return locked_call
+
+    def __setattr__(self, name, value):
+        setattr(self._interface, name, value)
+
+    def __copy__(self):
+        """Copies share the handle: they hold a new reference to the interface. """
+        return self.acquire()
+
+    def __deepcopy__(self, memo):
+        return self.acquire()
+
+    def __nonzero__(self):
+        return self._interface is not None
+
+    def __repr__(self):
+        return "Handle (%d references) to %s"%(self._count, repr(self._interface))
+
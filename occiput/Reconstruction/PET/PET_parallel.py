@@ -0,0 +1,170 @@
+# occiput
+# Stefano Pedemonte
+# Harvard University, Martinos Center for Biomedical Imaging
+# Boston, MA, USA
+
+# Projection and backprojection sharded across worker processes. The active angles (axial, azimuthal) of the
+# subsets matrix are partitioned into shards; each worker projects (backprojects) one shard. The activity
+# volume and the outputs are held in shared memory (see occiput.Core.SharedMemory): the workers write their
+# pieces of the projection data in place and their partial backprojections in separate slots, that are summed
+# by tree reduction.
+# Each ShardedProjector owns a pool of worker processes, forked once when the projector is created: the
+# workers inherit a copy of the scan; the data of each call (geometry of the scan, ROIs, shared arrays) is
+# sent along with the jobs, so that concurrent calls and different projectors do not interfere.
+
+
+__all__ = ['ShardedProjector','shard_angles']
+
+
+import multiprocessing
+import weakref
+import numpy
+from occiput.Core.SharedMemory import shared_array, to_shared
+
+
+# State of a worker process (not of the parent): its copy of the scan, see _worker_init()
+_worker = {}
+
+# Attributes of the scan that are sent to the workers at each call (they may change after the workers are forked)
+_SCAN_STATE = ['activity_shape','activity_size','attenuation_shape','attenuation_size','binning',
+               'projection_parameters','backprojection_parameters']
+
+
+
+def shard_angles(subsets_matrix, n_shards):
+    """Partition the active angles of 'subsets_matrix' (N_axial x N_azimuthal) into at most n_shards subsets
+    matrices of (approximately) the same number of active angles. """
+    subsets_matrix = numpy.asarray(subsets_matrix)
+    active = numpy.argwhere(subsets_matrix != 0)
+    shards = []
+    for block in numpy.array_split(active, max(1,min(n_shards,len(active)))):
+        if len(block) == 0:
+            continue
+        shard = numpy.zeros(subsets_matrix.shape,dtype=subsets_matrix.dtype)
+        shard[block[:,0],block[:,1]] = 1
+        shards.append(shard)
+    return shards
+
+
+def _worker_init(scan_reference):
+    # The workers are forked: the weak reference resolves to the copy of the scan of the worker process,
+    # that runs the projector locally
+    scan = scan_reference()
+    scan._sharded_projector = None
+    _worker['scan'] = scan
+
+
+def _worker_scan(call):
+    # Copy of the scan of the worker, updated with the state of the call
+    scan = _worker['scan']
+    for name, value in call['state'].items():
+        setattr(scan, name, value)
+    scan._lines_of_response_cache = (call['offsets'], call['locations'], scan.binning.export_dictionary(), call['lines'])
+    return scan
+
+
+def _project_shard(job):
+    call, k = job
+    scan = _worker_scan(call)
+    shard = call['shards'][k]
+    projection = scan.project(call['activity'], call['attenuation'], call['roi_activity'], call['roi_attenuation'], call['offsets'], call['locations'], shard)
+    output = call['output']
+    projection = numpy.asarray(projection, dtype=numpy.float32).reshape(output.shape, order="F")
+    i_axial, i_azimuthal = call['lines'][0:2]
+    columns = shard[i_axial,i_azimuthal] != 0
+    output[:,columns] = projection[:,columns]
+    return k
+
+
+def _backproject_shard(job):
+    call, k = job
+    scan = _worker_scan(call)
+    backprojection = scan.backproject(call['projection_data'], call['attenuation'], call['roi_activity'], call['roi_attenuation'], call['offsets'], call['locations'], call['shards'][k])
+    call['output'][...,k] = backprojection.data
+    return k
+
+
+def _reduce_pair(job):
+    slots, (i, j) = job
+    slots[...,i] += slots[...,j]
+    return i
+
+
+
+class ShardedProjector():
+    """Drop-in replacement of PET_Static_Scan.project() and PET_Static_Scan.backproject() that distributes the
+    angles across n_workers processes (default: number of CPUs). Meant for the CPU projectors: the workers are
+    forked when the projector is created, hence they should not share a GPU context with the parent process.
+    The workers are terminated by close(). """
+    def __init__(self, scan, n_workers=None):
+        if n_workers is None:
+            n_workers = multiprocessing.cpu_count()
+        # weak reference: the scan owns the projector (see PET_Static_Scan.enable_sharded_projection)
+        self._scan = weakref.ref(scan)
+        self.n_workers = max(1,int(n_workers))
+        self._shared_lines = None
+        self._pool = multiprocessing.Pool(self.n_workers, initializer=_worker_init, initargs=(self._scan,))
+
+    def _prepare(self, attenuation, roi_activity, roi_attenuation, offsets, locations, subsets_matrix):
+        """State of the call, sent to the workers along with the jobs. The arrays are in shared memory,
+        hence they are exchanged as lightweight handles. """
+        scan = self._scan()
+        if self._pool is None:
+            raise RuntimeError("The sharded projector has been closed. ")
+        if offsets is None:
+            offsets = scan._offsets
+        if locations is None:
+            locations = scan._locations
+        if subsets_matrix is None:
+            subsets_matrix = scan._subsets_generator.all_active()
+        if roi_activity is None:
+            roi_activity = scan.get_roi_activity()
+        if attenuation is not None:
+            attenuation = to_shared(numpy.float32(getattr(attenuation,'data',attenuation)))
+        lines = scan._lines_of_response(offsets, locations)
+        # the lines of response are moved to shared memory once for each measurement
+        cached = self._shared_lines
+        if cached is None or cached[0] is not lines:
+            cached = (lines, to_shared(offsets), to_shared(locations), tuple(to_shared(a) for a in lines))
+            self._shared_lines = cached
+        return {'state':dict((name,getattr(scan,name)) for name in _SCAN_STATE), 'attenuation':attenuation,
+                'roi_activity':roi_activity, 'roi_attenuation':roi_attenuation, 'offsets':cached[1], 'locations':cached[2],
+                'lines':cached[3], 'shards':shard_angles(subsets_matrix, self.n_workers)}
+
+    def project(self, activity, attenuation=None, roi_activity=None, roi_attenuation=None, offsets=None, locations=None, subsets_matrix=None):
+        if not isinstance(activity,numpy.ndarray):
+            activity = activity.data
+        call = self._prepare(attenuation, roi_activity, roi_attenuation, offsets, locations, subsets_matrix)
+        call['activity'] = to_shared(numpy.float32(activity))
+        call['output'] = shared_array((self._scan().binning.N_tof, call['lines'][0].size))
+        self._pool.map(_project_shard, [(call,k) for k in range(len(call['shards']))])
+        return numpy.array(call['output'], order="F")
+
+    def backproject(self, projection_data, attenuation=None, roi_activity=None, roi_attenuation=None, offsets=None, locations=None, subsets_matrix=None):
+        if not isinstance(projection_data,numpy.ndarray):
+            projection_data = projection_data.data
+        call = self._prepare(attenuation, roi_activity, roi_attenuation, offsets, locations, subsets_matrix)
+        n = len(call['shards'])
+        call['projection_data'] = to_shared(numpy.float32(projection_data))
+        call['output'] = slots = shared_array(tuple(self._scan().activity_shape) + (max(n,1),))
+        self._pool.map(_backproject_shard, [(call,k) for k in range(n)])
+        # tree reduction of the partial backprojections: at each level, slot i accumulates slot i+step
+        step = 1
+        while step < n:
+            self._pool.map(_reduce_pair, [(slots,(i,i+step)) for i in range(0,n-step,2*step)])
+            step = 2*step
+        return numpy.array(slots[...,0], order="F")
+
+    def close(self):
+        """Terminate the worker processes. """
+        if getattr(self,'_pool',None) is not None:
+            self._pool.terminate()
+            self._pool.join()
+            self._pool = None
+        self._shared_lines = None
+
+    def __del__(self):
+        self.close()
+
+    def __repr__(self):
+        return "Sharded projector: %d worker processes"%self.n_workers
@@ -0,0 +1,164 @@
+
+# occiput
+# Stefano Pedemonte
+# Harvard University, Martinos Center for Biomedical Imaging
+# Boston, MA, USA
+
+# Pipelined processing of the frames of a dynamic scan: a loader thread extracts the measurement of the next
+# frames, the calling thread reconstructs, a writer thread saves the reconstructed images. The stages communicate
+# through bounded queues; the memory occupied by the frames in flight (measurements and images) is bounded by a
+# ceiling.
+
+
+__all__ = ['FramePipeline','DEFAULT_QUEUE_DEPTH']
+
+
+import threading
+import Queue
+import sys
+import numpy
+
+
+DEFAULT_QUEUE_DEPTH = 2                 # number of frames loaded ahead, and number of images waiting to be saved
+
+
+
+class _Stop(object):
+    pass
+
+
+
+class FramePipeline(object):
+    """Pipeline for the reconstruction of the frames of a PET_Dynamic_Scan.
+    reconstruct:    function of the frame (PET_Static_Scan) that returns the reconstructed image.
+    save:           None, function (t, image) or file name pattern (e.g. 'frame_%03d.nii').
+    queue_depth:    number of frames loaded ahead of the reconstruction and of images waiting to be saved.
+    memory_ceiling: maximum memory [bytes] of the frames in flight (None: no limit); a frame is always loaded if
+                    no other frame is in flight.
+    Frames that are loaded by the pipeline are unloaded once reconstructed. """
+    def __init__(self, scan, reconstruct, save=None, queue_depth=DEFAULT_QUEUE_DEPTH, memory_ceiling=None):
+        self.scan = scan
+        self.reconstruct = reconstruct
+        if isinstance(save, basestring):
+            pattern = save
+            save = lambda t, image: image.save_to_file(pattern%t)
+        self.save = save
+        self.queue_depth = max(1,int(queue_depth))
+        self.memory_ceiling = memory_ceiling
+        self._memory = 0
+        self._memory_condition = threading.Condition()
+        self._error = None
+
+    def _reserve(self, nbytes):
+        with self._memory_condition:
+            self._memory += nbytes
+
+    def _release(self, nbytes):
+        with self._memory_condition:
+            self._memory -= nbytes
+            self._memory_condition.notify_all()
+
+    def _wait_memory(self):
+        if self.memory_ceiling is None:
+            return
+        with self._memory_condition:
+            while self._memory > 0 and self._memory >= self.memory_ceiling and self._error is None:
+                self._memory_condition.wait(0.1)
+
+    def _fail(self):
+        self._error = sys.exc_info()
+        with self._memory_condition:
+            self._memory_condition.notify_all()
+
+    def _put(self, queue, item):
+        # the consumer may have failed: do not block forever on a full queue
+        while self._error is None:
+            try:
+                queue.put(item, timeout=0.1)
+                return True
+            except Queue.Full:
+                pass
+        return False
+
+    def _load(self, frames, loaded):
+        try:
+            for t in frames:
+                self._wait_memory()
+                if self._error is not None:
+                    return
+                frame = self.scan[t]
+                unload = not frame.is_measurement_loaded()
+                frame = self.scan.load_frame(t)
+                nbytes = frame.get_measurement_nbytes() if unload else 0
+                self._reserve(nbytes)
+                if not self._put(loaded, (t, frame, unload, nbytes)):
+                    if unload:
+                        frame.unload_measurement()
+                    self._release(nbytes)
+                    return
+        except:
+            self._fail()
+        finally:
+            # the reconstruction consumes the queue until the end, also in case of errors
+            loaded.put(_Stop())
+
+    def _write(self, reconstructed):
+        try:
+            while True:
+                item = reconstructed.get()
+                if isinstance(item, _Stop):
+                    return
+                t, image, nbytes = item
+                if self._error is None:
+                    self.save(t, image)
+                self._release(nbytes)
+        except:
+            self._fail()
+            # keep draining, so that the reconstruction is not blocked
+            while not isinstance(reconstructed.get(), _Stop):
+                pass
+
+    def run(self, frames=None):
+        """Process the frames (default: all); returns the list of the reconstructed images. """
+        if frames is None:
+            frames = range(len(self.scan._dynamic))
+        frames = list(frames)
+        loaded = Queue.Queue(self.queue_depth)
+        reconstructed = Queue.Queue(self.queue_depth)
+        loader = threading.Thread(target=self._load, args=(frames, loaded), name="occiput frame loader")
+        loader.daemon = True
+        loader.start()
+        writer = None
+        if self.save is not None:
+            writer = threading.Thread(target=self._write, args=(reconstructed,), name="occiput frame writer")
+            writer.daemon = True
+            writer.start()
+        images = []
+        while True:
+            item = loaded.get()
+            if isinstance(item, _Stop):
+                break
+            t, frame, unload, nbytes = item
+            try:
+                if self._error is None:
+                    image = self.reconstruct(frame)
+                    images.append(image)
+                    if writer is not None:
+                        image_nbytes = numpy.asarray(getattr(image,'data',image)).nbytes
+                        self._reserve(image_nbytes)
+                        if not self._put(reconstructed, (t, image, image_nbytes)):
+                            self._release(image_nbytes)
+            except:
+                self._fail()
+            finally:
+                if unload:
+                    frame.unload_measurement()
+                self._release(nbytes)
+        if writer is not None:
+            reconstructed.put(_Stop())
+            writer.join()
+        loader.join()
+        if self._error is not None:
+            raise self._error[0], self._error[1], self._error[2]
+        return images
+
@@ -0,0 +1,172 @@
+
+# occiput
+# Stefano Pedemonte
+# Harvard University, Martinos Center for Biomedical Imaging
+# Boston, MA, USA
+
+# Time-of-flight (TOF) projector and backprojector for PET, CPU implementation (numpy).
+# The lines of response (LOR) are described by the axial angle theta, the azimuthal angle phi (tilt with
+# respect to the transaxial plane) and the coordinates (u,v) on the detector plane:
+#   e_u = ( cos(theta),             sin(theta),             0        )
+#   e_v = ( sin(theta)*sin(phi),   -cos(theta)*sin(phi),    cos(phi) )
+#   d   = (-sin(theta)*cos(phi),    cos(theta)*cos(phi),    sin(phi) )
+# The points of a LOR are center + m + t*d, where 'center' is the center of the scanner in the coordinates of the
+# volume [mm], m = u*e_u + v*e_v + v*tan(phi)*d is the midpoint between the two detectors (the point of the LOR
+# halfway across the transaxial section of the cylinder of the scanner) and t is the TOF coordinate: the signed
+# distance from the midpoint, as in the listmode and TOF sinogram conventions. For oblique LORs the midpoint is
+# shifted by v*tan(phi) along the LOR from the plane through the center of the scanner orthogonal to the LOR.
+# The line integrals are computed by trilinear interpolation at samples spaced by at most half of the smallest
+# voxel (see sample_step_of()).
+
+
+__all__ = ['PET_project_tof','PET_backproject_tof','tof_kernel','tof_bin_centers','lor_geometry','sample_step_of']
+
+
+import numpy
+
+
+DEFAULT_BLOCK_SIZE = 4096                                     # number of lines of response processed at once
+FWHM_TO_SIGMA = 1.0 / (2.0*numpy.sqrt(2.0*numpy.log(2.0)))
+
+
+
+def tof_bin_centers(N_tof, size_tof):
+    """Centers of the TOF bins along the line of response [mm]. """
+    return (numpy.arange(N_tof) + 0.5) * size_tof * 1.0 / N_tof - 0.5 * size_tof
+
+
+def tof_kernel(t, N_tof, size_tof, tof_resolution):
+    """Weights of the TOF bins (array N_tof x len(t)) for points at TOF coordinate t [mm]. The timing response
+    is Gaussian with full width at half maximum tof_resolution [mm]; the weight of a bin is the response at
+    the bin center times the bin width, so that the weights of a point sum to (approximately) 1. """
+    t = numpy.asarray(t,dtype=numpy.float64).reshape((1,-1))
+    if N_tof <= 1:
+        return numpy.ones((1,t.size),dtype=numpy.float32)
+    width = size_tof * 1.0 / N_tof
+    sigma = tof_resolution * FWHM_TO_SIGMA
+    d = t - tof_bin_centers(N_tof, size_tof).reshape((-1,1))
+    return numpy.float32( width / (numpy.sqrt(2.0*numpy.pi)*sigma) * numpy.exp(-0.5*d**2/sigma**2) )
+
+
+def lor_geometry(theta, phi, u, v):
+    """Midpoints (between the two detectors) and unit directions of the lines of response, arrays n x 3, with
+    respect to the center of the scanner. """
+    theta, phi = numpy.asarray(theta,dtype=numpy.float64), numpy.asarray(phi,dtype=numpy.float64)
+    u, v = numpy.asarray(u,dtype=numpy.float64), numpy.asarray(v,dtype=numpy.float64)
+    ct, st, cp, sp = numpy.cos(theta), numpy.sin(theta), numpy.cos(phi), numpy.sin(phi)
+    directions = numpy.column_stack(( -st*cp, ct*cp, sp ))
+    # the point on the plane through the center of the scanner, moved along the LOR to the detectors' midpoint
+    points = numpy.column_stack(( u*ct + v*st*sp, u*st - v*ct*sp, v*cp )) + (v*numpy.tan(phi))[:,None] * directions
+    return points, directions
+
+
+
+def sample_step_of(size, shape):
+    """Default distance [mm] between the samples along the lines of response in a volume of physical size 'size'
+    and 'shape' voxels: half of the smallest voxel, so that the trilinear interpolation does not skip voxels. """
+    return 0.5 * (numpy.float64(size) / numpy.float64(shape)).min()
+
+
+def _sampling_positions(size, sample_step, points=None, directions=None):
+    """TOF coordinates of the samples along the lines of response: they cover the diagonal of the volume about
+    the point of each LOR closest to the center of the scanner (at distance |points.directions| from the
+    midpoint). """
+    length = numpy.sqrt((numpy.float64(size)**2).sum())
+    if points is not None:
+        length += 2*numpy.abs((points*directions).sum(1)).max()
+    n = int(numpy.ceil(length / sample_step)) + 1
+    return (numpy.arange(n) - 0.5*(n-1)) * sample_step
+
+
+def _voxel_coordinates(points, directions, t, center, size, shape):
+    """Continuous voxel indices (n x n_samples x 3) of the samples along the lines of response. """
+    voxel = numpy.float64(size) / numpy.float64(shape)
+    p = (numpy.float64(center) + points)[:,None,:] + t[None,:,None] * directions[:,None,:]
+    return p / voxel - 0.5
+
+
+def _trilinear_weights(coordinates, shape):
+    """Flat (Fortran order) indices and weights of the 8 neighbours of each sample; samples outside of the
+    volume have weight 0. """
+    i0 = numpy.floor(coordinates).astype(numpy.int64)
+    f = coordinates - i0
+    shape = numpy.int64(shape)
+    for dx in (0,1):
+        for dy in (0,1):
+            for dz in (0,1):
+                i = i0 + numpy.array([dx,dy,dz])
+                w = numpy.where(dx, f[...,0], 1-f[...,0]) * numpy.where(dy, f[...,1], 1-f[...,1]) * numpy.where(dz, f[...,2], 1-f[...,2])
+                inside = ((i >= 0) & (i < shape)).all(-1)
+                i = numpy.where(inside[...,None], i, 0)
+                yield i[...,0] + shape[0]*(i[...,1] + shape[1]*i[...,2]), numpy.float32(w*inside)
+
+
+def _interpolate(volume_flat, coordinates, shape):
+    values = numpy.zeros(coordinates.shape[:-1],dtype=numpy.float32)
+    for index, weight in _trilinear_weights(coordinates, shape):
+        values += volume_flat[index] * weight
+    return values
+
+
+def _interpolate_adjoint(values, coordinates, shape, out_flat):
+    # the 8 neighbours of all the samples are accumulated by a single bincount
+    indexes, weights = zip(*[(index.ravel(), (values*weight).ravel()) for index, weight in _trilinear_weights(coordinates, shape)])
+    accumulated = numpy.bincount(numpy.concatenate(indexes), weights=numpy.concatenate(weights))
+    out_flat[0:accumulated.size] += accumulated
+
+
+def _attenuation_factors(attenuation, attenuation_size, center_attenuation, points, directions):
+    if attenuation is None:
+        return 1.0
+    shape = attenuation.shape
+    sample_step = sample_step_of(attenuation_size, shape)
+    t = _sampling_positions(attenuation_size, sample_step, points, directions)
+    coordinates = _voxel_coordinates(points, directions, t, center_attenuation, attenuation_size, shape)
+    mu = _interpolate(numpy.float32(attenuation).ravel(order="F"), coordinates, shape)
+    return numpy.exp(-mu.sum(1) * sample_step)
+
+
+
+def PET_project_tof(activity, activity_size, center_activity, attenuation, attenuation_size, center_attenuation,
+                    theta, phi, u, v, N_tof, size_tof, tof_resolution, sample_step=None, block_size=DEFAULT_BLOCK_SIZE):
+    """Project 'activity' along the lines of response (theta, phi, u, v) into N_tof TOF bins. Returns an array
+    N_tof x n_LOR (Fortran order). 'center_activity' and 'center_attenuation' are the coordinates of the center
+    of the scanner in the activity and attenuation volumes [mm]; 'attenuation' can be None. 'sample_step' [mm]
+    is at most (and defaults to) sample_step_of() the activity volume; the attenuation is sampled at half of its smallest voxel. """
+    activity = numpy.float32(activity)
+    shape = activity.shape
+    sample_step = sample_step_of(activity_size, shape) if sample_step is None else min(sample_step, sample_step_of(activity_size, shape))
+    activity_flat = activity.ravel(order="F")
+    n = numpy.asarray(theta).size
+    projection = numpy.zeros((max(N_tof,1),n),dtype=numpy.float32,order="F")
+    for start in range(0,n,block_size):
+        block = slice(start,min(start+block_size,n))
+        points, directions = lor_geometry(theta[block], phi[block], u[block], v[block])
+        t = _sampling_positions(activity_size, sample_step, points, directions)
+        kernel = tof_kernel(t, N_tof, size_tof, tof_resolution) * numpy.float32(sample_step)
+        coordinates = _voxel_coordinates(points, directions, t, center_activity, activity_size, shape)
+        values = _interpolate(activity_flat, coordinates, shape)
+        projection[:,block] = kernel.dot(values.T) * _attenuation_factors(attenuation, attenuation_size, center_attenuation, points, directions)
+    return projection
+
+
+def PET_backproject_tof(projection_data, activity_shape, activity_size, center_activity, attenuation, attenuation_size, center_attenuation,
+                        theta, phi, u, v, N_tof, size_tof, tof_resolution, sample_step=None, block_size=DEFAULT_BLOCK_SIZE):
+    """Adjoint of PET_project_tof(): backproject 'projection_data' (N_tof x n_LOR) into a volume of shape
+    'activity_shape'. """
+    projection_data = numpy.float32(projection_data).reshape((max(N_tof,1),-1),order="F")
+    shape = tuple(numpy.int64(activity_shape))
+    sample_step = sample_step_of(activity_size, shape) if sample_step is None else min(sample_step, sample_step_of(activity_size, shape))
+    backprojection = numpy.zeros(int(numpy.prod(shape)),dtype=numpy.float64)
+    n = numpy.asarray(theta).size
+    for start in range(0,n,block_size):
+        block = slice(start,min(start+block_size,n))
+        points, directions = lor_geometry(theta[block], phi[block], u[block], v[block])
+        t = _sampling_positions(activity_size, sample_step, points, directions)
+        kernel = tof_kernel(t, N_tof, size_tof, tof_resolution) * numpy.float32(sample_step)
+        data = projection_data[:,block] * _attenuation_factors(attenuation, attenuation_size, center_attenuation, points, directions)
+        values = data.T.dot(kernel)
+        coordinates = _voxel_coordinates(points, directions, t, center_activity, activity_size, shape)
+        _interpolate_adjoint(values, coordinates, shape, backprojection)
+    return numpy.asfortranarray(numpy.float32(backprojection.reshape(shape,order="F")))
+
@@ -17,10 +17,14 @@ from numpy.random import randint
 from occiput.Core.NiftyCore_wrap import SPECT_project_parallelholes, SPECT_backproject_parallelholes, has_NiftyCore
 from occiput.Core import Image3D
 from occiput.Visualization import ProgressBar, svgwrite, has_svgwrite, ipy_table, has_ipy_table
+from occiput.Reconstruction.Filters import ramp_filter
+from occiput.Reconstruction.Algorithms import get_algorithm
 
 
 DEFAULT_ITERATIONS  = 20
 DEFAULT_SUBSET_SIZE = 32
+DEFAULT_FBP_WINDOW  = 'ramp'
+DEFAULT_FBP_CUTOFF  = 1.0
 EPS                 = 1e-9
 
 
@@ -286,37 +290,60 @@ class SPECT_Static_Scan(object):
         self._norm = self.backproject(ones(( self._p_n_pix_x,self._p_n_pix_y,self._p_gantry_angular_positions ),dtype=float32, order="F") ).data 
         self._need_update_norm = False 
 
-    def estimate_activity(self, iterations=DEFAULT_ITERATIONS, subset_size=DEFAULT_SUBSET_SIZE, subset_mode='random'): 
+    def estimate_activity(self, iterations=DEFAULT_ITERATIONS, subset_size=DEFAULT_SUBSET_SIZE, subset_mode='random', activity=None, method='osem'): 
+        """Estimate the activity. 'method' is the name of an iterative algorithm ('osem', 'ros', 'bsrem', 'pcg'; 
+        see occiput.Reconstruction.Algorithms) or an instance of ReconstructionAlgorithm. """
         progress_bar = ProgressBar() 
         progress_bar.set_percentage(0.1)
-        activity = ones((self._p_n_pix_x,self._p_n_pix_y,self._p_n_pix_x),dtype=float32, order="F")
-        for i in range(iterations): 
-            # Subsets: 
-            if subset_size  is None:
-                subsets_array=None
-                subset_size=self._p_gantry_angular_positions
-            elif subset_size>=self._p_gantry_angular_positions: 
-                subsets_array=None
-                subset_size=self._p_gantry_angular_positions
-            else:
-                subsets_array = self._subset_generator.new_subset(subset_mode,subset_size)
-            if subsets_array is not None: 
-                proj = self.project(activity,subsets_array=subsets_array).data
-                P = (self._measurement[:,:,where(subsets_array)].reshape((self._p_n_pix_x,self._p_n_pix_y,subset_size))+EPS)/(proj+EPS)
-                norm = self.backproject(ones(( self._p_n_pix_x,self._p_n_pix_y,subset_size ),dtype=float32, order="F"), subsets_array=subsets_array).data 
-                update = (self.backproject( P ,subsets_array=subsets_array).data+EPS) / (norm +EPS) 
-            else: 
-                proj = self.project(activity).data
-                P = (self._measurement+EPS)/(proj+EPS)   
-                norm = self.get_normalization()  
-                update = (self.backproject( P ).data+EPS) / (norm +EPS) 
-            activity = activity * update #* self.get_mask().data
-
-            progress_bar.set_percentage((i+1)*100.0/iterations) 
-            #print "Iteration: %d    max act: %f    min act: %f    max proj: %f    min proj: %f    max norm: %f    min norm: %f"%(i, activity.max(), activity.min(), proj.max(), proj.min(), norm.data.max(), norm.data.min() )
+        if activity is None: 
+            activity = ones((self._p_n_pix_x,self._p_n_pix_y,self._p_n_pix_x),dtype=float32, order="F")
+        elif not isinstance(activity,ndarray): 
+            activity = activity.data 
+        algorithm = get_algorithm(method, EPS) 
+        activity = algorithm.run(self, activity, iterations, subset_size, subset_mode, progress_bar.set_percentage) 
         progress_bar.set_percentage(100.0)
         return Image3D(activity)
+
+    # The following methods expose the projection model to the reconstruction algorithms (occiput.Reconstruction.Algorithms)
+    def _new_subset(self, subset_size, subset_mode): 
+        if subset_size is None or subset_size >= self._p_gantry_angular_positions: 
+            return None 
+        return self._subset_generator.new_subset(subset_mode,subset_size)
+
+    def _n_subsets(self, subset_size): 
+        if subset_size is None: 
+            return 1 
+        return max(1, int(self._p_gantry_angular_positions/subset_size)) 
+
+    def _forward(self, activity, subset): 
+        return self.project(activity,subsets_array=subset).data 
+
+    def _backward(self, projection, subset): 
+        return self.backproject(projection,subsets_array=subset).data 
+
+    def _measured(self, subset): 
+        if subset is None: 
+            return self._measurement 
+        return self._measurement[:,:,where(subset)[0]] 
+
+    def _sensitivity(self, subset): 
+        if subset is None: 
+            return self.get_normalization() 
+        return self.backproject(ones(( self._p_n_pix_x,self._p_n_pix_y,int(subset.sum()) ),dtype=float32, order="F"), subsets_array=subset).data 
+
+    def _constraint(self, activity): 
+        return activity 
             
+    def estimate_activity_fbp(self, window=DEFAULT_FBP_WINDOW, cutoff=DEFAULT_FBP_CUTOFF): 
+        """Quick-look reconstruction by filtered backprojection: the projections are ramp-filtered along the 
+        transaxial direction of the detector and backprojected once. Neither attenuation nor the collimator 
+        response are compensated: the image is meant for quality control. """
+        filtered = ramp_filter(self._measurement, axis=0, pixel_size=self._p_pix_size_x_mm, window=window, cutoff=cutoff)
+        activity = self.backproject(filtered).data
+        # pi/N_positions holds both for acquisitions over 180 and over 360 degrees
+        activity = activity * pi / self._p_gantry_angular_positions 
+        return Image3D(float32(activity))
+
     def volume_render(self,volume,scale=1.0): 
         # FIXME: use the VolumeRenderer object in occiput.Visualization (improve it), the following is a quick fix: 
         if isinstance(volume,ndarray): 
@@ -2,4 +2,6 @@
 import PET
 import SPECT
 import CT
+import Filters
+import Algorithms
 
@@ -7,5 +7,7 @@
 
 from ilang_models import SSD_ilang
 
-from registration import Registration_Two_Images, Registration_Longitudinal, Registration_N_Images
+from registration import Registration_Two_Images, Registration_Longitudinal, Registration_N_Images, register_to_reference
+from rigid import transformation_matrix_6DOF, parameters_6DOF, derivative_intensity_6DOF, rigid_ssd
+from metrics import ssd, ncc, mutual_information, get_metric
 
@@ -7,6 +7,7 @@
 import numpy
 from occiput.Core import Image3D, Grid3D, Transform_6DOF
 from ilang.Models import Model 
+from .rigid import rigid_ssd 
 
 
 
@@ -24,15 +25,15 @@ class SSD_ilang( Model ):
         source = self.get_value('source') 
         target = self.get_value('target') 
         sigma  = self.get_value('sigma')
-        log_p = 0.0
+        log_p = rigid_ssd(source, target, transformation, sigma) 
         return log_p
 
     def log_conditional_probability_gradient_transformation(self,transformation): 
         source = self.get_value('source') 
         target = self.get_value('target') 
         sigma  = self.get_value('sigma')
-        gradient = numpy.asarray([0.0,0.0,0.0,0.0,0.0,0.0]) 
-        return gradient 
+        log_p, gradient = rigid_ssd(source, target, transformation, sigma, gradient=True) 
+        return gradient.reshape(numpy.shape(transformation)) 
         
     def sample_conditional_probability_target(self): 
         return 0    
@@ -0,0 +1,125 @@
+
+# occiput
+# Stefano Pedemonte
+# Harvard University, Martinos Center for Biomedical Imaging
+# Boston, MA, USA
+
+# Similarity metrics for intensity-based registration: sum of squared differences (SSD), normalized cross
+# correlation (NCC) and mutual information (MI, Mattes et al. 2003). The metrics are functions of the resampled
+# source and of the target at the same points, with signature
+#     metric(resampled, target, derivatives=None, weight=1.0, ranges=None)
+# They return the similarity (larger is better) or, if 'derivatives' (array [n_parameters,...]: derivatives of the
+# resampled source with respect to the parameters of the transformation) is given, the similarity and its gradient
+# with respect to the parameters. 'weight' scales sums over a sample of points (SSD); 'ranges' is
+# ((source_min,source_max),(target_min,target_max)), the intensity ranges of the histograms (MI).
+
+
+__all__ = ['ssd','ncc','mutual_information','get_metric','METRICS','DEFAULT_N_BINS']
+
+
+import numpy
+
+
+DEFAULT_N_BINS = 32
+
+
+
+class UnknownParameter(Exception):
+    def __init__(self,msg):
+        self.msg = str(msg)
+    def __str__(self):
+        return "Unkwnown parameter: %s"%(self.msg)
+
+
+
+def _gradient(derivatives, coefficients):
+    # sum over the points of coefficients * derivatives, for each parameter
+    return numpy.tensordot(derivatives, coefficients, coefficients.ndim)
+
+
+def ssd(resampled, target, derivatives=None, weight=1.0, ranges=None):
+    """Negative sum of squared differences: -0.5*weight*||resampled-target||^2. """
+    difference = numpy.float64(resampled) - target
+    value = -0.5 * weight * (difference**2).sum()
+    if derivatives is None:
+        return value
+    return value, -weight * _gradient(derivatives, difference)
+
+
+def ncc(resampled, target, derivatives=None, weight=1.0, ranges=None):
+    """Normalized cross correlation of resampled and target (in [-1,1]). """
+    r = numpy.float64(resampled) - numpy.mean(resampled)
+    t = numpy.float64(target) - numpy.mean(target)
+    rr = (r**2).sum()
+    tt = (t**2).sum()
+    if rr == 0 or tt == 0:
+        value = 0.0
+        if derivatives is None:
+            return value
+        return value, numpy.zeros(derivatives.shape[0])
+    value = (r*t).sum() / numpy.sqrt(rr*tt)
+    if derivatives is None:
+        return value
+    # the means do not contribute: r and t have zero mean
+    return value, _gradient(derivatives, t/numpy.sqrt(rr*tt) - value*r/rr)
+
+
+def _bspline3_weights(u):
+    # weights of the cubic B-spline at the 4 bins floor(xi)-1..floor(xi)+2 and their derivatives, u = xi-floor(xi)
+    u2 = u*u
+    u3 = u2*u
+    weights = [(1-u)**3/6.0, 0.5*u3 - u2 + 2.0/3, -0.5*u3 + 0.5*u2 + 0.5*u + 1.0/6, u3/6.0]
+    derivatives = [-0.5*(1-u)**2, 1.5*u2 - 2*u, -1.5*u2 + u + 0.5, 0.5*u2]
+    return weights, derivatives
+
+
+def mutual_information(resampled, target, derivatives=None, weight=1.0, ranges=None, n_bins=DEFAULT_N_BINS):
+    """Mutual information of resampled and target (Mattes et al.): the joint histogram is built with a cubic B-spline
+    Parzen window for the resampled source and a zero-order window for the target, so that the MI is a
+    differentiable function of the resampled intensities. The histogram is computed with vectorized binning of all
+    the points (n_bins bins per image). """
+    r = numpy.float64(resampled).ravel()
+    t = numpy.float64(target).ravel()
+    n = r.size
+    if ranges is None:
+        ranges = ((r.min(),r.max()),(t.min(),t.max()))
+    # the ranges may be integers (e.g. the range of an integer image): the steps are computed in floating point
+    (r_min,r_max), (t_min,t_max) = numpy.float64(ranges)
+    # source: continuous bin coordinate in [1,n_bins], spread over 4 of n_bins+3 bins by the cubic B-spline
+    r_step = max(r_max-r_min, 1e-12) / (n_bins-1)
+    xi = 1 + numpy.clip((r - r_min) / r_step, 0, n_bins-1)
+    bins_r = numpy.floor(xi)
+    weights, weights_derivatives = _bspline3_weights(xi - bins_r)
+    # target: bin index in [0,n_bins-1]
+    t_step = max(t_max-t_min, 1e-12) / n_bins
+    bins_t = numpy.clip(numpy.floor((t - t_min) / t_step).astype(numpy.int64), 0, n_bins-1)
+    n_r = n_bins + 3
+    bins = bins_t*n_r + bins_r.astype(numpy.int64) - 1
+    joint = numpy.bincount(numpy.concatenate([bins+offset for offset in range(4)]), weights=numpy.concatenate(weights), minlength=n_r*n_bins)
+    joint = joint.reshape((n_bins,n_r)) / n
+    p_t = joint.sum(1)
+    p_r = joint.sum(0)
+    nonzero = numpy.nonzero(joint)
+    log_ratio = numpy.zeros(joint.shape)
+    log_ratio[nonzero] = numpy.log(joint[nonzero] / p_r[nonzero[1]])
+    value = (joint * log_ratio).sum() - (p_t[p_t > 0] * numpy.log(p_t[p_t > 0])).sum()
+    if derivatives is None:
+        return value
+    # dMI = sum dp * log(p/p_r) (the marginal of the target does not change); dp/dxi from the B-spline weights
+    log_ratio = log_ratio.ravel()
+    coefficients = sum(weights_derivatives[offset] * log_ratio[bins+offset] for offset in range(4)) / (n*r_step)
+    return value, _gradient(derivatives, coefficients.reshape(numpy.shape(resampled)))
+
+
+
+METRICS = {'ssd':ssd, 'ncc':ncc, 'mi':mutual_information}
+
+
+def get_metric(metric):
+    """Metric function of the given name ('ssd','ncc','mi'); functions are returned unchanged. """
+    if callable(metric):
+        return metric
+    if str(metric).lower() not in METRICS:
+        raise UnknownParameter("Metric %s unknown (known metrics: %s). "%(str(metric), str(METRICS.keys())))
+    return METRICS[str(metric).lower()]
+
@@ -6,20 +6,48 @@
 
 
 import numpy
+import multiprocessing
 from .ilang_models import SSD_ilang
+from .rigid import transformation_matrix_6DOF, derivative_intensity_6DOF, derivative_intensity_6DOF_points
+from .metrics import get_metric
 from ilang.Graphs import ProbabilisticGraphicalModel 
 from ilang.Samplers import Sampler 
 from occiput.Visualization import MultipleVolumesNiftyCore
-from occiput.Core import Image3D, Transform_Translation 
+from occiput.Core import Image3D, Grid3D, Transform_Affine, Transform_Translation, resample_images_on_grid 
+from occiput import global_settings 
 
 
 DEFAULT_N_POINTS = [100,100,100]
 DEFAULT_N_ITER   = 30
 DEFAULT_SIGMA    = 3000000
+DEFAULT_PYRAMID  = [4,2,1]          # downsampling factors of the levels of the image pyramid, coarse to fine 
+DEFAULT_CACHE_SIZE = 4             # number of resampled source images kept in memory (see Registration_Two_Images) 
+DEFAULT_SAMPLING_FRACTION = 0.05   # fraction of the points of the grid used by stochastic sampling 
+DEFAULT_COST_FUNCTION = 'ssd'      # similarity metric (see metrics.py): 'ssd', 'ncc' or 'mi' 
+DEFAULT_TEMPLATE_ITERATIONS = 3    # alternations of registration and template update (see Registration_N_Images) 
+
+
+# State of a worker process of _map_pairs() (not of the parent): the pairs to register, see _worker_init() 
+_worker = {} 
+
+
+
+class UnknownParameter(Exception):
+    def __init__(self,msg):
+        self.msg = str(msg)
+    def __str__(self):
+        return "Unkwnown parameter: %s"%(self.msg)
+
 
 
 class Registration_Two_Images(object): 
     def __init__( self, source=None, target=None, degrees_of_freedom=3, sigma=DEFAULT_SIGMA, initial_transformation=None ): 
+        self.__pyramid = {} 
+        self.__cache = [] 
+        self.cache_size = DEFAULT_CACHE_SIZE 
+        self.__sample = None 
+        self.__ranges = None 
+        self.set_cost_function(DEFAULT_COST_FUNCTION) 
         self.set_source(source)
         self.set_target(target)  
         self.set_sigma(sigma)
@@ -54,36 +82,170 @@ class Registration_Two_Images(object):
         return self.__transformation 
 
     def set_cost_function(self,cost): 
-        pass 
+        """Similarity metric: 'ssd' (sum of squared differences), 'ncc' (normalized cross correlation), 'mi' (mutual 
+        information) or a function with the signature of the functions in metrics.py. The log likelihood is the 
+        metric divided by sigma (the default sigma is scaled for SSD; use e.g. set_sigma(1e-3) with 'ncc' and 'mi'). """
+        self.cost_function = get_metric(cost) 
 
-    def __initialize_registration(self, optimization_method='QuasiNewton_L_BFGS_B', n_points=DEFAULT_N_POINTS): 
-        self.ilang_graph.set_node_value('source',self.source.data)
-        self.ilang_graph.set_node_value('target',self.target.data)
+    def __initialize_registration(self, optimization_method='QuasiNewton_L_BFGS_B', n_points=DEFAULT_N_POINTS, factor=1): 
         self.ilang_graph.set_node_value('sigma',self.sigma)
-
         if n_points == None: 
             n_points = self.target.shape
-        self.grid = self.target.get_world_grid(n_points) 
-        self.resampled_target = self.target.compute_resample_on_grid(self.grid) 
-
+        self.__set_level(factor, n_points) 
         self.ilang_sampler.set_node_sampling_method_manual('transformation',optimization_method)
 
-    def register(self, optimization_method='GradientAscent',iterations=DEFAULT_N_ITER, n_points=DEFAULT_N_POINTS):  
-        self.__initialize_registration(optimization_method, n_points)
-        self.ilang_graph.set_node_value('transformation',self.transformation)
-        self.ilang_sampler.sample(iterations) 
-        self.transformation = self.ilang_graph.get_node_value('transformation')
+    def __set_level(self, factor, n_points): 
+        # grid of the level of the pyramid: n_points/factor points; source and target smoothed accordingly 
+        n_points = tuple(max(2,int(numpy.ceil(n*1.0/factor))) for n in n_points) 
+        self.grid = self.target.get_world_grid(n_points) 
+        self.rotation_center = self.grid.center() 
+        self.source_level = self.__get_pyramid_level('source', factor, n_points) 
+        target_level = self.__get_pyramid_level('target', factor, n_points) 
+        key = ('resampled_target', factor, n_points) 
+        if key not in self.__pyramid: 
+            self.__pyramid[key] = target_level.compute_resample_on_grid(self.grid) 
+        self.resampled_target = self.__pyramid[key] 
+        # intensity ranges of the histograms of the metrics (the resampled source includes the background) 
+        source_data = self.source_level.data 
+        self.__ranges = ((min(source_data.min(),self.source_level.background), source_data.max()), 
+                         (self.resampled_target.data.min(), self.resampled_target.data.max())) 
+        self.ilang_graph.set_node_value('source',self.source_level.data)
+        self.ilang_graph.set_node_value('target',target_level.data)
+        self.__cache = [] 
+        self.__sample = None 
+
+    def __draw_sample(self, sampling, fraction): 
+        """Draw a subset of the points of the grid: 'random' (uniform, without replacement) or 'stratified' (one 
+        random point in each cell of a regular partition of the grid). The log likelihood and its gradient are then 
+        evaluated, and the source resampled, only at these points. """
+        shape = numpy.int64(self.grid.get_grid_shape()) 
+        if sampling == 'random': 
+            n = max(1,int(round(fraction*shape.prod()))) 
+            flat = numpy.random.choice(int(shape.prod()), n, replace=False) 
+            index = numpy.column_stack(numpy.unravel_index(flat, tuple(shape))) 
+        elif sampling == 'stratified': 
+            step = max(1,int(round((1.0/fraction)**(1.0/3)))) 
+            cells = numpy.column_stack([c.ravel() for c in numpy.mgrid[0:shape[0]:step,0:shape[1]:step,0:shape[2]:step]]) 
+            index = numpy.minimum(cells + numpy.random.randint(0, step, cells.shape), shape-1) 
+        else: 
+            raise UnknownParameter("Sampling method %s unknown (known methods: 'random', 'stratified'). "%str(sampling)) 
+        if self.grid.is_implicit(): 
+            A = self.grid.get_affine() 
+            points = index.dot(A[0:3,0:3].transpose()) + A[0:3,3] 
+        else: 
+            points = self.grid.data[index[:,0],index[:,1],index[:,2]] 
+        self.__sample = {'index':index, 'grid':Grid3D(numpy.float32(points).reshape((-1,1,1,3)), self.grid.space), 
+                         'target':self.resampled_target.data[index[:,0],index[:,1],index[:,2]], 
+                         'weight':shape.prod()*1.0/len(index)} 
+        self.__cache = [] 
+
+    def __get_source_gradient(self): 
+        # spatial gradient of the source of the current level, in the coordinates of the space (cached) 
+        key = ('source_gradient', id(self.source_level)) 
+        if key not in self.__pyramid: 
+            source = self.source_level 
+            inverse = numpy.linalg.inv(numpy.float64(source.affine.data)[0:3,0:3]) 
+            gradient = numpy.gradient(numpy.float32(source.data)) 
+            self.__pyramid[key] = [Image3D(data=numpy.float32(sum(inverse[k,j]*gradient[k] for k in range(3))), affine=source.affine.data, space=source.space) for j in range(3)] 
+        return self.__pyramid[key] 
+
+    def __resample_source(self, transformation, gradient=False): 
+        """Intensity of the source of the current level at the points of the grid (or of the sample of points) 
+        transformed by 'transformation' and, if gradient is True, its derivatives with respect to the parameters. 
+        The results are cached by transformation: the log likelihood and its gradient at the same transformation 
+        share one resampling. """
+        key = tuple(numpy.float64(transformation).ravel()) 
+        for i, entry in enumerate(self.__cache): 
+            if entry[0] == key: 
+                self.__cache.append(self.__cache.pop(i)) 
+                break 
+        else: 
+            entry = [key, None, None, None] 
+            self.__cache.append(entry) 
+            if len(self.__cache) > max(1,self.cache_size): 
+                self.__cache.pop(0) 
+        T = self.get_transformation_matrix(transformation) 
+        if self.__sample is not None: 
+            # sample of points: the spatial gradient of the source is resampled at the transformed points 
+            grid = self.__sample['grid'] 
+            if entry[1] is None: 
+                entry[1] = self.source_level.compute_resample_on_grid(grid, affine_grid_to_world=T).data.reshape(-1) 
+            if gradient and entry[3] is None: 
+                g = numpy.column_stack([g.compute_resample_on_grid(grid, affine_grid_to_world=T).data.reshape(-1) for g in self.__get_source_gradient()]) 
+                g = g.dot(numpy.float64(T.data)[0:3,0:3].transpose()) 
+                entry[3] = derivative_intensity_6DOF_points(g, grid.data.reshape((-1,3)), transformation, self.rotation_center) 
+        else: 
+            if entry[1] is None: 
+                if gradient: 
+                    resampled, entry[2] = self.source_level.compute_resample_and_gradient_on_grid(self.grid, affine_grid_to_world=T) 
+                else: 
+                    resampled = self.source_level.compute_resample_on_grid(self.grid, affine_grid_to_world=T) 
+                entry[1] = resampled.data 
+            if gradient and entry[3] is None: 
+                if entry[2] is None: 
+                    entry[2] = numpy.gradient(entry[1]) 
+                entry[3] = derivative_intensity_6DOF(entry[2], self.grid, transformation, self.rotation_center) 
+        if gradient: 
+            return entry[1], entry[3] 
+        return entry[1] 
+
+    def __get_target(self): 
+        if self.__sample is not None: 
+            return self.__sample['target'], self.__sample['weight'] 
+        return self.resampled_target.data, 1.0 
+
+    def __get_pyramid_level(self, name, factor, n_points): 
+        # smoothed image (cached): the standard deviation of the Gaussian is half the spacing of the grid of the level 
+        key = (name, factor, n_points) 
+        if key not in self.__pyramid: 
+            image = getattr(self, name) 
+            if factor == 1: 
+                self.__pyramid[key] = image 
+            else: 
+                spacing = self.grid.span() / (numpy.float64(n_points)-1) 
+                self.__pyramid[key] = image.compute_smoothed(0.5*spacing) 
+        return self.__pyramid[key] 
+
+    def register(self, optimization_method='GradientAscent',iterations=DEFAULT_N_ITER, n_points=DEFAULT_N_POINTS, pyramid=DEFAULT_PYRAMID, sampling=None, sampling_fraction=DEFAULT_SAMPLING_FRACTION):  
+        """Estimate the transformation, coarse to fine: at each level of the pyramid (list of downsampling factors, 
+        e.g. [4,2,1]) the images are smoothed and resampled on a grid of n_points/factor points, and the 
+        optimization starts from the transformation estimated at the previous level. 'iterations' is the number of 
+        iterations per level (or a list, one per level). 
+        sampling: None (all the points of the grid), 'random' or 'stratified': the log likelihood and its gradient 
+        are evaluated on a fraction 'sampling_fraction' of the points of the grid, drawn again at every iteration. """
+        if pyramid is None: 
+            pyramid = [1] 
+        if numpy.isscalar(iterations): 
+            iterations = [iterations]*len(pyramid) 
+        for factor, n_iter in zip(pyramid, iterations): 
+            self.__initialize_registration(optimization_method, n_points, factor)
+            self.ilang_graph.set_node_value('transformation',self.transformation)
+            if sampling is None: 
+                self.ilang_sampler.sample(n_iter) 
+            else: 
+                for i in range(n_iter): 
+                    self.__draw_sample(sampling, sampling_fraction) 
+                    self.ilang_sampler.sample(1) 
+                self.__sample = None 
+            self.transformation = self.ilang_graph.get_node_value('transformation')
 
     def set_source(self,source): 
         self.source = source
+        self.__clear_pyramid() 
         if hasattr(self,'target'): 
             self.__set_space()
         
     def set_target(self,target): 
         self.target = target
+        self.__clear_pyramid() 
         if hasattr(self,'source'): 
             self.__set_space()
 
+    def __clear_pyramid(self): 
+        self.__pyramid = {} 
+        self.__cache = [] 
+        self.rotation_center = None 
+
     def set_sigma(self,sigma):
         self.sigma = sigma
 
@@ -92,11 +254,17 @@ class Registration_Two_Images(object):
         result.transform( self.get_transformation_matrix() )
         return result
     
-    def get_transformation_matrix(self):
-        #rot = self.__transformation[0:3]
-        #tra = self.__transformation[3:6]    
-        tra = self.__transformation
-        return Transform_Translation(tra, self.space, self.space)    #FIXME: rotation and translation 
+    def get_transformation_matrix(self, transformation=None):
+        """Transform_Affine of the parameters: [tx,ty,tz] or [tx,ty,tz,rx,ry,rz] (see transformation_matrix_6DOF()); 
+        rotations are about the center of the registration grid. """
+        if transformation is None: 
+            transformation = self.__transformation 
+        transformation = numpy.float64(transformation).ravel() 
+        if transformation.size <= 3: 
+            return Transform_Translation(transformation, self.space, self.space) 
+        if self.rotation_center is None: 
+            self.rotation_center = self.target.get_world_grid(self.target.shape).center() 
+        return Transform_Affine(transformation_matrix_6DOF(transformation, self.rotation_center), self.space, self.space) 
 
     def display(self): 
         D = MultipleVolumesNiftyCore([self.source, self.target, self.get_result()])
@@ -105,31 +273,19 @@ class Registration_Two_Images(object):
 
     def __G(self,transformation): 
 #        print "Transformation: ", transformation 
-        #rot = transformation[0:3]
-        #tra = transformation[3:6]
-        tra = transformation
-        T = Transform_Translation(tra, self.space, self.space)    #FIXME: rotation and translation 
-        re_s = self.source.compute_resample_on_grid(self.grid, affine_grid_to_world=T)  #FIXME: memoize
-        gr_s = self.source.compute_gradient_on_grid(self.grid, affine_grid_to_world=T)
-        re_t = self.resampled_target 
-        G_tra0 = (re_t.data-re_t.data*gr_s[0]).sum()
-        G_tra1 = (re_t.data-re_t.data*gr_s[1]).sum()
-        G_tra2 = (re_t.data-re_t.data*gr_s[2]).sum()
-        G_tra = [G_tra0, G_tra1, G_tra2]
-        G = numpy.asarray([G_tra[0], G_tra[1], G_tra[2]]) / self.sigma
+        # analytic derivatives of the resampled source with respect to the parameters, from its spatial gradient 
+        resampled, D = self.__resample_source(transformation, gradient=True) 
+        target, weight = self.__get_target() 
+        G = self.cost_function(resampled, target, D, weight, self.__ranges)[1] / self.sigma 
 #        print "gradient:       ", G
 #        print "log_likelihood: ", self.__P(transformation)
         return G
 
     def __P(self,transformation): 
-        # FIXME: memoize (now image is resampled to compute log_p and the gradient) 
         #print transformation 
-        #rot = transformation[0:3]
-        #tra = transformation[3:6]
-        tra  = transformation
-        T = Transform_Translation(tra, self.space, self.space)    #FIXME: rotation and translation 
-        resampled_source = self.source.compute_resample_on_grid(self.grid, affine_grid_to_world=T) 
-        P = -numpy.linalg.norm(resampled_source.data - self.resampled_target.data) / self.sigma  #FIXME: verify
+        resampled = self.__resample_source(transformation) 
+        target, weight = self.__get_target() 
+        P = self.cost_function(resampled, target, None, weight, self.__ranges) / self.sigma 
 #        print "log_likelihood: ", P
         return P
 
@@ -144,19 +300,141 @@ class Registration_Two_Images(object):
 
 
 
+def _register_pair(payload, k): 
+    source, target, initial_transformation = payload['pairs'][k] 
+    registration = Registration_Two_Images(source, target, degrees_of_freedom=len(initial_transformation), sigma=payload['sigma']) 
+    registration.set_transformation(initial_transformation) 
+    registration.set_cost_function(payload['cost_function']) 
+    registration.register(**payload['options']) 
+    return numpy.float64(registration.transformation).ravel() 
+
+
+def _worker_init(payload): 
+    # The workers are forked, possibly after the parent has initialised CUDA: they resample on the CPU 
+    global_settings.disable_gpu() 
+    for source, target, initial_transformation in payload['pairs']: 
+        source.use_gpu = 0 
+        target.use_gpu = 0 
+    _worker['payload'] = payload 
+
+
+def _register_pair_in_worker(k): 
+    return _register_pair(_worker['payload'], k) 
+
+
+def _map_pairs(pairs, n_workers=None, sigma=DEFAULT_SIGMA, cost_function=DEFAULT_COST_FUNCTION, options={}): 
+    """Solve the pairwise registrations [(source, target, initial_transformation), ...] in n_workers processes 
+    (default: number of CPUs); 'options' are the arguments of Registration_Two_Images.register(). Returns the list 
+    of the estimated parameters. The workers are forked for each call and inherit the pairs (the images are not 
+    copied); they do not use the GPU. """
+    if n_workers is None: 
+        n_workers = multiprocessing.cpu_count() 
+    n_workers = max(1,min(int(n_workers),len(pairs))) 
+    payload = {'pairs':pairs, 'sigma':sigma, 'cost_function':cost_function, 'options':options} 
+    if n_workers == 1: 
+        return [_register_pair(payload, k) for k in range(len(pairs))] 
+    pool = multiprocessing.Pool(n_workers, initializer=_worker_init, initargs=(payload,)) 
+    try: 
+        return pool.map(_register_pair_in_worker, range(len(pairs))) 
+    finally: 
+        pool.close() 
+        pool.join() 
+
+
+def _map_pairs_warm_start(sources, targets, transformations, n_workers=None, sigma=DEFAULT_SIGMA, cost_function=DEFAULT_COST_FUNCTION, options={}): 
+    """Register sources[k] onto targets[k], concurrently, in two rounds: first the even k, starting from 
+    transformations[k], then the odd k, each starting from the transformation estimated for k-1. Returns the list 
+    of the estimated parameters. """
+    transformations = list(transformations) 
+    for first in [0,1]: 
+        indexes = range(first,len(sources),2) 
+        if first == 1: 
+            for k in indexes: 
+                transformations[k] = transformations[k-1].copy() 
+        pairs = [(sources[k], targets[k], transformations[k]) for k in indexes] 
+        for k, transformation in zip(indexes, _map_pairs(pairs, n_workers, sigma, cost_function, options)): 
+            transformations[k] = transformation 
+    return transformations 
+
+
+def register_to_reference(images, reference, transformations=None, degrees_of_freedom=6, sigma=DEFAULT_SIGMA, cost_function=DEFAULT_COST_FUNCTION, 
+                          n_workers=None, optimization_method='GradientAscent', iterations=DEFAULT_N_ITER, n_points=DEFAULT_N_POINTS, pyramid=DEFAULT_PYRAMID): 
+    """Register each of the images (e.g. the frames of a dynamic scan) onto the reference image. The registrations 
+    run concurrently in n_workers processes (default: number of CPUs), in two rounds: the even images start from 
+    'transformations' (see Registration_N_Images.set_transformation(); None: identity), the odd images from the 
+    transformation estimated for the previous image. Returns the list of the parameters; T_i moves image i onto the 
+    reference, rotations are about the center of the reference. See Registration_Two_Images.register() for the 
+    other arguments. """
+    get_metric(cost_function) 
+    options = {'optimization_method':optimization_method, 'iterations':iterations, 'n_points':n_points, 'pyramid':pyramid} 
+    transformations = _initial_transformations(transformations, len(images), degrees_of_freedom) 
+    return _map_pairs_warm_start(images, [reference]*len(images), transformations, n_workers, sigma, cost_function, options) 
+
+
+def _transformation_matrix(transformation, target): 
+    # as Registration_Two_Images.get_transformation_matrix(): rotations are about the center of the target 
+    center = target.get_world_grid(target.shape).center() 
+    return transformation_matrix_6DOF(transformation, center) 
+
+
+def _initial_transformations(tr, n, degrees_of_freedom): 
+    # one array of parameters per pair, from None (identity), one array for all the pairs or a list 
+    if tr is None: 
+        tr = numpy.zeros(degrees_of_freedom) 
+    if numpy.ndim(tr) == 1: 
+        tr = [tr]*n 
+    if len(tr) != n: 
+        raise UnknownParameter("Expected %d transformations, %d given. "%(n,len(tr))) 
+    return [numpy.float64(t).ravel() for t in tr] 
+
+
+
 class Registration_Longitudinal(): 
-    def __init__(self, images ): 
+    def __init__(self, images, degrees_of_freedom=3, sigma=DEFAULT_SIGMA ): 
         self.__images = images 
+        self.degrees_of_freedom = degrees_of_freedom 
+        self.sigma = sigma 
+        self.set_cost_function(DEFAULT_COST_FUNCTION) 
+        self.set_transformation(None) 
         self.__make_graph() 
         
     def set_transformation(self,tr): 
-        pass 
+        """Initial parameters of the transformations T_i (image i onto image i+1): one array per pair of consecutive 
+        images, one array for all the pairs, or None (identity). """
+        self.transformations = _initial_transformations(tr, len(self.__images)-1, self.degrees_of_freedom) 
 
     def set_cost_function(self,cost): 
-        pass 
+        get_metric(cost) 
+        self.cost_function = cost 
         
-    def register(self): 
-        pass 
+    def register(self, optimization_method='GradientAscent', iterations=DEFAULT_N_ITER, n_points=DEFAULT_N_POINTS, pyramid=DEFAULT_PYRAMID, n_workers=None): 
+        """Register each image onto the next one. The pairs are registered concurrently in n_workers processes 
+        (default: number of CPUs), in two rounds: first the even pairs (0-1, 2-3, ..), then the odd pairs (1-2, 
+        3-4, ..), each starting from the transformation estimated for the previous pair. See 
+        Registration_Two_Images.register() for the other arguments. """
+        options = {'optimization_method':optimization_method, 'iterations':iterations, 'n_points':n_points, 'pyramid':pyramid} 
+        images = self.__images 
+        self.transformations = _map_pairs_warm_start(images[0:-1], images[1:], self.transformations, n_workers, self.sigma, self.cost_function, options) 
+        for k, transformation in enumerate(self.transformations): 
+            self.ilang_graph.set_node_value('T_%d'%k, transformation) 
+
+    def get_transformation_matrices(self): 
+        """Transform_Affine of each pair: T_i moves image i onto image i+1. """
+        images = self.__images 
+        return [Transform_Affine(_transformation_matrix(t, images[k+1]), images[k].space, images[k].space) for k, t in enumerate(self.transformations)] 
+
+    def get_result(self): 
+        """Images aligned to the last image (composition of the transformations of the following pairs). """
+        matrices = [m.data for m in self.get_transformation_matrices()] 
+        results = [] 
+        for k, image in enumerate(self.__images): 
+            matrix = numpy.eye(4) 
+            for m in matrices[k:]: 
+                matrix = numpy.dot(m, matrix) 
+            result = image.copy() 
+            result.transform(Transform_Affine(matrix, image.space, image.space)) 
+            results.append(result) 
+        return results 
 
     def __make_graph(self): 
         self.ilang_graph = ProbabilisticGraphicalModel()
@@ -182,18 +460,70 @@ class Registration_Longitudinal():
 
 
 class Registration_N_Images(): 
-    def __init__(self, images ): 
+    def __init__(self, images, degrees_of_freedom=3, sigma=DEFAULT_SIGMA ): 
         self.__images = images 
+        self.degrees_of_freedom = degrees_of_freedom 
+        self.sigma = sigma 
+        self.template = None 
+        self.set_cost_function(DEFAULT_COST_FUNCTION) 
+        self.set_transformation(None) 
         self.__make_graph() 
         
     def set_transformation(self,tr): 
-        pass 
+        """Initial parameters of the transformations T_i (image i onto the template): one array per image, one 
+        array for all the images, or None (identity). """
+        self.transformations = _initial_transformations(tr, len(self.__images), self.degrees_of_freedom) 
 
     def set_cost_function(self,cost): 
-        pass 
+        get_metric(cost) 
+        self.cost_function = cost 
         
-    def register(self): 
-        pass 
+    def register(self, optimization_method='GradientAscent', iterations=DEFAULT_N_ITER, n_points=DEFAULT_N_POINTS, pyramid=DEFAULT_PYRAMID, template_iterations=DEFAULT_TEMPLATE_ITERATIONS, n_workers=None): 
+        """Groupwise registration: alternate the registration of all the images onto the template, concurrently in 
+        n_workers processes (default: number of CPUs), and the update of the template (mean of the transformed 
+        images). The first round uses the image pyramid, the following rounds start from the previous estimates and 
+        use only the finest level. The mean of the parameters is removed at each round, so that the template does 
+        not drift (exact for translations). See Registration_Two_Images.register() for the other arguments. """
+        if pyramid is None: 
+            pyramid = [1] 
+        options = {'optimization_method':optimization_method, 'iterations':iterations, 'n_points':n_points, 'pyramid':pyramid} 
+        self.update_template() 
+        for i in range(template_iterations): 
+            if i == 1: 
+                options['pyramid'] = pyramid[-1:] 
+                if not numpy.isscalar(iterations): 
+                    options['iterations'] = iterations[-1:] 
+            pairs = [(image, self.template, t) for image, t in zip(self.__images, self.transformations)] 
+            self.transformations = _map_pairs(pairs, n_workers, self.sigma, self.cost_function, options) 
+            mean = numpy.mean(self.transformations, 0) 
+            self.transformations = [t - mean for t in self.transformations] 
+            self.update_template() 
+        for k, transformation in enumerate(self.transformations): 
+            self.ilang_graph.set_node_value('T_%d'%k, transformation) 
+        self.ilang_graph.set_node_value('template', self.template.data) 
+
+    def update_template(self): 
+        """Template: mean of the images transformed by the current transformations, on the voxels of the first 
+        image. All the images are resampled in one batched pass (see resample_images_on_grid()). """
+        reference = self.__images[0] 
+        affine = numpy.float64(reference.affine.data) 
+        grid = Grid3D(space=reference.space, shape=reference.shape, affine=affine) 
+        resampled = resample_images_on_grid(self.__images, grid, self.get_transformation_matrices()) 
+        self.template = Image3D(data=numpy.float32(numpy.mean(resampled,0)), affine=affine, space=reference.space) 
+
+    def get_transformation_matrices(self): 
+        """Transform_Affine of each image: T_i moves image i onto the template. """
+        reference = self.__images[0] 
+        return [Transform_Affine(_transformation_matrix(t, reference), image.space, image.space) for image, t in zip(self.__images, self.transformations)] 
+
+    def get_result(self): 
+        """Images aligned to the template. """
+        results = [] 
+        for image, matrix in zip(self.__images, self.get_transformation_matrices()): 
+            result = image.copy() 
+            result.transform(matrix) 
+            results.append(result) 
+        return results 
 
     def __make_graph(self): 
         self.ilang_graph = ProbabilisticGraphicalModel()
@@ -0,0 +1,129 @@
+
+# occiput
+# Stefano Pedemonte
+# Harvard University, Martinos Center for Biomedical Imaging
+# Boston, MA, USA
+
+# Parametrization of the rigid transformations used for registration and analytic derivatives of the intensity
+# of the transformed (resampled) image with respect to the parameters. The parameters are [tx,ty,tz]
+# (translation) or [tx,ty,tz,rx,ry,rz] (rotation about the x, y and z axes through a rotation center, followed by
+# the translation). A transformation T moves the image: the resampled image is r(p) = image(T^-1 p).
+
+
+__all__ = ['transformation_matrix_6DOF','parameters_6DOF','rotation_jacobian_6DOF','derivative_intensity_6DOF','derivative_intensity_6DOF_points','rigid_ssd']
+
+
+import numpy
+from occiput.Core import Image3D, Grid3D, Transform_Affine
+from occiput.Core.Core import derivative_rigid_parameters
+
+
+
+def _rotation_matrices(angles):
+    c = numpy.cos(angles)
+    s = numpy.sin(angles)
+    Rx = numpy.asarray([[1,0,0],[0,c[0],-s[0]],[0,s[0],c[0]]])
+    Ry = numpy.asarray([[c[1],0,s[1]],[0,1,0],[-s[1],0,c[1]]])
+    Rz = numpy.asarray([[c[2],-s[2],0],[s[2],c[2],0],[0,0,1]])
+    dRx = numpy.asarray([[0,0,0],[0,-s[0],-c[0]],[0,c[0],-s[0]]])
+    dRy = numpy.asarray([[-s[1],0,c[1]],[0,0,0],[-c[1],0,-s[1]]])
+    dRz = numpy.asarray([[-s[2],-c[2],0],[c[2],-s[2],0],[0,0,0]])
+    return (Rx,Ry,Rz), (dRx,dRy,dRz)
+
+
+def transformation_matrix_6DOF(parameters, rotation_center=None):
+    """Rigid transformation (4x4 array) of parameters [tx,ty,tz,rx,ry,rz]: rotation by rx, ry, rz [rad] about the
+    x, y and z axes through 'rotation_center' (in this order), followed by the translation [tx,ty,tz]. With three
+    parameters, translation only. """
+    parameters = numpy.float64(parameters).ravel()
+    matrix = numpy.eye(4)
+    if parameters.size > 3:
+        if rotation_center is None:
+            rotation_center = numpy.zeros(3)
+        (Rx,Ry,Rz), _ = _rotation_matrices(parameters[3:6])
+        R = Rz.dot(Ry).dot(Rx)
+        matrix[0:3,0:3] = R
+        matrix[0:3,3] = numpy.float64(rotation_center) - R.dot(rotation_center)
+    matrix[0:3,3] += parameters[0:3]
+    return matrix
+
+
+def parameters_6DOF(matrix):
+    """Parameters [tx,ty,tz,rx,ry,rz] of a rigid transformation (4x4 array) with rotation about the origin: inverse of
+    transformation_matrix_6DOF(parameters). The angle ry is in [-pi/2,pi/2]. """
+    matrix = numpy.float64(matrix)
+    R = matrix[0:3,0:3]
+    rx = numpy.arctan2(R[2,1], R[2,2])
+    ry = numpy.arctan2(-R[2,0], numpy.sqrt(R[2,1]**2 + R[2,2]**2))
+    rz = numpy.arctan2(R[1,0], R[0,0])
+    return numpy.concatenate((matrix[0:3,3], [rx,ry,rz]))
+
+
+def rotation_jacobian_6DOF(angles):
+    """Matrix J (3x3) that maps a change of the rotation angles [rx,ry,rz] to the equivalent small rotation
+    [wx,wy,wz] about the x, y and z axes composed with the rotation: dR R^T = [J dangles]_x. """
+    (Rx,Ry,Rz), (dRx,dRy,dRz) = _rotation_matrices(numpy.float64(angles))
+    R = Rz.dot(Ry).dot(Rx)
+    J = numpy.zeros((3,3))
+    for k, dR in enumerate([Rz.dot(Ry).dot(dRx), Rz.dot(dRy).dot(Rx), dRz.dot(Ry).dot(Rx)]):
+        W = dR.dot(R.transpose())
+        J[:,k] = [W[2,1], W[0,2], W[1,0]]
+    return J
+
+
+def _index_to_space(grid):
+    # linear part of the map from the indexes of an (affine) grid to its coordinates, from the corners of the grid
+    corners = grid.corners()
+    shape = grid.get_grid_shape()
+    A = numpy.zeros((3,3))
+    for k in range(3):
+        A[:,k] = (corners[:,1<<(2-k)] - corners[:,0]) / max(shape[k]-1,1)
+    return A
+
+
+def derivative_intensity_6DOF(gradient, grid, parameters, rotation_center=None):
+    """Derivatives (array [n_parameters,n_1,n_2,n_3]) of the resampled image r(p) = image(T^-1 p) on the points of
+    'grid' with respect to the parameters of T. 'gradient' is the gradient of the resampled image with respect to
+    the indexes of the grid (e.g. numpy.gradient()). One pass over the grid, no additional resampling. """
+    # gradient with respect to the coordinates of the points
+    inverse = numpy.linalg.inv(_index_to_space(grid))
+    gradient_space = [sum(inverse[k,j]*gradient[k] for k in range(3)) for j in range(3)]
+    return derivative_intensity_6DOF_points(gradient_space, grid, parameters, rotation_center)
+
+
+def derivative_intensity_6DOF_points(gradient, points, parameters, rotation_center=None):
+    """As derivative_intensity_6DOF(), for arbitrary points (array [...,3] or GridND): 'gradient' is the gradient
+    of the resampled image with respect to the coordinates of the points (list of 3 arrays or array [...,3]). """
+    parameters = numpy.float64(parameters).ravel()
+    if rotation_center is None:
+        rotation_center = numpy.zeros(3)
+    # the rotation center moves with the translation
+    T = transformation_matrix_6DOF(parameters, rotation_center)
+    center = T[0:3,0:3].dot(rotation_center) + T[0:3,3]
+    derivatives = derivative_rigid_parameters(gradient, points, center)
+    if parameters.size <= 3:
+        return derivatives[0:parameters.size]
+    J = rotation_jacobian_6DOF(parameters[3:6])
+    derivatives[3:6] = numpy.tensordot(J.transpose(), derivatives[3:6], 1)
+    return derivatives
+
+
+def rigid_ssd(source, target, parameters, sigma=1.0, rotation_center=None, gradient=False):
+    """Log likelihood -0.5*||r-target||^2/sigma of the source (array) transformed by the rigid transformation of
+    the given parameters and resampled on the voxels of the target (array), and, if gradient is True, its
+    gradient with respect to the parameters. The images are in voxel coordinates; the default rotation center is
+    the center of the target. """
+    target = numpy.asarray(target)
+    if rotation_center is None:
+        rotation_center = (numpy.float64(target.shape)-1) / 2.0
+    grid = Grid3D(shape=target.shape, affine=numpy.eye(4))
+    T = Transform_Affine(transformation_matrix_6DOF(parameters, rotation_center))
+    source = Image3D(data=numpy.asarray(source))
+    if not gradient:
+        resampled = source.compute_resample_on_grid(grid, affine_grid_to_world=T)
+        return -0.5 * ((resampled.data - target)**2).sum() / sigma
+    resampled, resampled_gradient = source.compute_resample_and_gradient_on_grid(grid, affine_grid_to_world=T)
+    derivatives = derivative_intensity_6DOF(resampled_gradient, grid, parameters, rotation_center)
+    difference = resampled.data - target
+    return -0.5 * (difference**2).sum() / sigma, -numpy.tensordot(derivatives, difference, 3) / sigma
+
@@ -12,6 +12,7 @@ from ilang.Graphs import ProbabilisticGraphicalModel
 from ilang.Samplers import Sampler
 
 from occiput.Core import Image3D 
+from occiput.Registration.TranslationRotation.rigid import rigid_ssd 
 from occiput.Visualization import MultipleVolumes
 
 try: 
@@ -19,13 +20,17 @@ try:
     from NiftyCore.NiftyReg import deriv_intensity_wrt_space_rigid
     from NiftyCore.NiftyReg import deriv_intensity_wrt_transformation_rigid
     from NiftyCore.NiftyReg import deriv_ssd_wrt_transformation_rigid
-    from NiftyCore.NiftyReg import gaussian_smoothing
 except: 
     has_niftycore = False
     print "Please install NiftyCore"
 else: 
     has_niftycore = True 
 
+try: 
+    from NiftyCore.NiftyReg import gaussian_smoothing
+except: 
+    from occiput.Core.Smoothing import gaussian_smoothing
+
 import numpy
 
 
@@ -45,16 +50,13 @@ class ModelRigidSSD(Model):
     def log_conditional_probability_transformation(self,T): 
         source    = self.get_value('source')
         target    = self.get_value('target')
-        #return -.5*numpy.dot(numpy.dot((x-mu),hessian),(x-mu).T)
-        FIXME
-        return 0
+        return rigid_ssd(source, target, T) 
 
     def log_conditional_probability_gradient_transformation(self,T): 
         source    = self.get_value('source')
         target    = self.get_value('target')      
-        #return -.5*numpy.dot((x-mu),hessian+hessian.T) 
-        # FIXME
-        return numpy.random.rand(6)*4/30000
+        log_p, gradient = rigid_ssd(source, target, T, gradient=True) 
+        return gradient.reshape(numpy.shape(T)) 
 
 
 
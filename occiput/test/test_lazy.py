@@ -0,0 +1,46 @@
+
+# occiput
+# Stefano Pedemonte
+# Harvard University, Martinos Center for Biomedical Imaging
+# Boston, MA, USA
+
+# Tests of the lazy image views (occiput.Core.LazyImage3D) against the resampling of Image3D.
+
+
+import unittest
+import numpy
+from occiput.Core import Image3D, Grid3D, Transform_Affine
+from occiput.Registration.TranslationRotation import transformation_matrix_6DOF
+
+
+
+class TestLazyImage3D(unittest.TestCase):
+    def setUp(self):
+        self.image = Image3D(data=numpy.float32(numpy.random.RandomState(0).rand(10,11,12)), space="world")
+        self.image.background = 0.25
+        self.T = Transform_Affine(transformation_matrix_6DOF([0.3,-0.2,0.1,0.05,0.02,-0.04],[5,5,5]), map_from="world", map_to="world")
+
+    def test_affine_grid_to_world(self):
+        implicit = Grid3D(space="world", shape=(6,7,8), affine=numpy.diag([1.2,1.1,1.0,1.0]))
+        explicit = Grid3D(implicit.data, space="world")
+        for grid in implicit, explicit:
+            expected = self.image.compute_resample_on_grid(grid, affine_grid_to_world=self.T).data
+            resampled = self.image.lazy().compute_resample_on_grid(grid, affine_grid_to_world=self.T).data
+            self.assertTrue(numpy.allclose(resampled, expected, atol=1e-5))
+
+    def test_resample_twice_keeps_crop(self):
+        # the points of the second box are points of the first box, or outside of it: resampling twice is exact
+        expected = self.image.compute_resample_in_box([2,2,2],[7,8,9],[6,7,8]).compute_resample_in_box([0,1,2],[9,10,11],[10,10,10])
+        resampled = self.image.lazy().compute_resample_in_box([2,2,2],[7,8,9],[6,7,8]).compute_resample_in_box([0,1,2],[9,10,11],[10,10,10])
+        self.assertTrue(numpy.allclose(resampled.data, expected.data, atol=1e-6))
+        self.assertTrue((resampled.data == 0.25).any())
+
+    def test_errors_raise(self):
+        view = self.image.lazy()
+        self.assertRaises(TypeError, view.transform, numpy.eye(4))
+        self.assertRaises(ValueError, view.compute_resample_in_space_of_image, Image3D(data=numpy.zeros((2,2,2)), space="other"))
+
+
+
+if __name__ == '__main__':
+    unittest.main()
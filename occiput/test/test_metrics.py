@@ -0,0 +1,79 @@
+
+# occiput
+# Stefano Pedemonte
+# Harvard University, Martinos Center for Biomedical Imaging
+# Boston, MA, USA
+
+# Tests of the similarity metrics for registration (occiput.Registration.TranslationRotation.metrics).
+
+
+import unittest
+import numpy
+from occiput.Registration.TranslationRotation.metrics import ssd, ncc, mutual_information
+
+
+
+class TestMutualInformation(unittest.TestCase):
+    def test_integer_image(self):
+        # integer images have integer intensity ranges: the histogram steps must not be rounded to 0
+        random = numpy.random.RandomState(0)
+        source = numpy.int16(random.randint(0,21,(12,12,12)))
+        target = numpy.int16(20 - source)
+        ranges = ((source.min(),source.max()),(target.min(),target.max()))
+        value = mutual_information(source, target, ranges=ranges)
+        self.assertTrue(numpy.isfinite(value))
+        self.assertAlmostEqual(value, mutual_information(numpy.float64(source), numpy.float64(target)), 6)
+        derivatives = numpy.ones((1,)+source.shape)
+        value, gradient = mutual_information(source, target, derivatives, ranges=ranges)
+        self.assertTrue(numpy.isfinite(gradient).all())
+
+    def test_identical_images(self):
+        # the MI of an image with itself is larger than the MI with an unrelated image
+        random = numpy.random.RandomState(1)
+        image = random.rand(10,10,10)
+        self.assertTrue(mutual_information(image, image) > mutual_information(image, random.rand(10,10,10)))
+
+
+
+class TestSimilarity(unittest.TestCase):
+    def test_ssd_ncc_identical_images(self):
+        image = numpy.random.RandomState(2).rand(8,8,8)
+        self.assertEqual(ssd(image, image), 0.0)
+        self.assertAlmostEqual(ncc(image, image), 1.0, 10)
+        self.assertAlmostEqual(ncc(image, -image), -1.0, 10)
+
+
+
+class TestGradients(unittest.TestCase):
+    # the resampled source is a linear function of the parameters: r(p) = r0 + sum_k p_k D_k, so that the
+    # gradient returned by the metric can be compared to finite differences
+    def setUp(self):
+        random = numpy.random.RandomState(3)
+        self.r0 = random.rand(6,7,8)
+        self.target = 0.5*self.r0 + random.rand(6,7,8)
+        self.derivatives = random.randn(3,6,7,8)
+        self.p = numpy.float64([0.1,-0.05,0.02])
+
+    def _verify_gradient(self, metric, **kwds):
+        resampled = lambda p: self.r0 + numpy.tensordot(p, self.derivatives, 1)
+        value, gradient = metric(resampled(self.p), self.target, self.derivatives, **kwds)
+        self.assertAlmostEqual(value, metric(resampled(self.p), self.target, **kwds), 10)
+        eps = 1e-6
+        differences = [(metric(resampled(self.p+eps*e), self.target, **kwds) - metric(resampled(self.p-eps*e), self.target, **kwds)) / (2*eps) for e in numpy.eye(3)]
+        self.assertTrue(numpy.allclose(gradient, differences, rtol=1e-4, atol=1e-6*numpy.abs(differences).max()))
+
+    def test_ssd(self):
+        self._verify_gradient(ssd, weight=0.3)
+
+    def test_ncc(self):
+        self._verify_gradient(ncc)
+
+    def test_mutual_information(self):
+        # fixed ranges, wider than the intensities: the histogram bins do not depend on the parameters
+        self._verify_gradient(mutual_information, ranges=((-2.0,3.0),(0.0,1.5)), n_bins=16)
+
+
+
+if __name__ == '__main__':
+    unittest.main()
+
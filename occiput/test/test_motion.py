@@ -0,0 +1,189 @@
+
+# occiput
+# Stefano Pedemonte
+# Harvard University, Martinos Center for Biomedical Imaging
+# Boston, MA, USA
+
+# Tests of the motion estimation of dynamic PET scans (PET_Dynamic_Scan.estimate_motion()): a phantom is moved by
+# known rigid transformations, projected with the time-of-flight projector and reconstructed; the estimated motion
+# and the compensating ROIs are compared to the known motion. The convention of the rotations of the ROI (see
+# _roi_matrix()) is verified against the NiftyCore projector, when it is installed.
+
+
+import unittest
+import numpy
+from occiput.Core import Image3D
+from occiput.Registration.TranslationRotation import transformation_matrix_6DOF, parameters_6DOF
+from occiput.Reconstruction.PET.PET import PET_Static_Scan, PET_Dynamic_Scan, PET_Interface_Petlink32, Binning, ROI, UnexpectedParameter, _moved_roi, DEFAULT_BINNING
+from occiput.Core.NiftyCore_wrap import has_NiftyCore
+from occiput.Reconstruction.PET.PET_tof import PET_project_tof, PET_backproject_tof
+
+
+SHAPE     = [16,16,16]
+SIZE      = [40.0,40.0,40.0]                 # [mm]
+N_TOF     = 7
+SIZE_TOF  = 70.0
+TOF_FWHM  = 10.0
+MLEM_ITERATIONS = 8
+
+
+
+def _lines_of_response():
+    theta, phi, u, v = numpy.meshgrid(numpy.linspace(0,numpy.pi,6,endpoint=False), [-0.4,0.0,0.4],
+                                      numpy.linspace(-20,20,17), numpy.linspace(-20,20,17), indexing='ij')
+    return theta.ravel(), phi.ravel(), u.ravel(), v.ravel()
+
+
+def _phantom(points):
+    # asymmetric arrangement of smooth blobs, in the coordinates of the scanner [mm]
+    blobs = [((-5.0,-3.0,-2.0),(4.0,3.0,3.0),1.0), ((6.0,2.0,1.0),(3.0,5.0,3.0),0.8), ((0.0,6.0,-4.0),(3.0,3.0,5.0),0.6)]
+    activity = numpy.zeros(points.shape[:-1])
+    for center, width, weight in blobs:
+        activity += weight * numpy.exp(-0.5*(((points-center)/width)**2).sum(-1))
+    return activity
+
+
+def _voxel_centers():
+    voxel = numpy.float64(SIZE) / SHAPE
+    index = numpy.mgrid[0:SHAPE[0],0:SHAPE[1],0:SHAPE[2]]
+    return numpy.rollaxis(index,0,4) * voxel + 0.5*voxel
+
+
+def _moved_phantom(motion, shape, size):
+    """Phantom moved by 'motion' (4x4, coordinates of the activity volume [mm]), sampled at the voxel centers. """
+    voxel = numpy.float64(size) / shape
+    points = numpy.rollaxis(numpy.mgrid[0:shape[0],0:shape[1],0:shape[2]],0,4) * voxel + 0.5*voxel
+    inverse = numpy.linalg.inv(motion)
+    return numpy.float32(_phantom(points.dot(inverse[0:3,0:3].T) + inverse[0:3,3] - 0.5*numpy.float64(size)))
+
+
+def _measurement(motion):
+    """Projection of the phantom moved by 'motion' (4x4, coordinates of the scanner), with the activity volume at the
+    center of the scanner. """
+    center = 0.5*numpy.float64(SIZE)
+    inverse = numpy.linalg.inv(motion)
+    points = _voxel_centers() - center
+    activity = _phantom(points.dot(inverse[0:3,0:3].T) + inverse[0:3,3])
+    return PET_project_tof(activity, SIZE, center, None, SIZE, center, *(_lines_of_response()+(N_TOF,SIZE_TOF,TOF_FWHM)))
+
+
+def _reconstruct(frame):
+    """MLEM reconstruction of the frame in the activity volume of its ROI. """
+    roi = frame.get_roi_activity()
+    center = (roi.x,roi.y,roi.z)
+    lines = _lines_of_response()
+    project = lambda x: PET_project_tof(x, SIZE, center, None, SIZE, center, *(lines+(N_TOF,SIZE_TOF,TOF_FWHM)))
+    backproject = lambda y: PET_backproject_tof(y, SHAPE, SIZE, center, None, SIZE, center, *(lines+(N_TOF,SIZE_TOF,TOF_FWHM)))
+    sensitivity = backproject(numpy.ones((N_TOF,lines[0].size))) + 1e-9
+    activity = numpy.ones(SHAPE,dtype=numpy.float32)
+    for i in range(MLEM_ITERATIONS):
+        activity = activity * backproject(frame.measurement / (project(activity)+1e-9)) / sensitivity
+    return Image3D(data=activity)
+
+
+def _frame(motion):
+    frame = PET_Static_Scan()
+    frame.activity_shape = list(SHAPE)
+    frame.activity_size = list(SIZE)
+    binning = Binning()
+    binning.N_tof = N_TOF
+    frame.set_binning(binning)
+    frame.measurement = _measurement(motion)
+    return frame
+
+
+class _Scan(PET_Dynamic_Scan):
+    # dynamic scan made of the given frames, reconstructed in sequence
+    def __init__(self, motions):
+        self.interface = None
+        self.static = _frame(numpy.eye(4))
+        self._dynamic = [_frame(motion) for motion in motions]
+
+    def reconstruct_frames(self, reconstruct=None, save=None, frames=None, **kwds):
+        return [reconstruct(self._dynamic[t]) for t in frames]
+
+
+
+class TestMovedROI(unittest.TestCase):
+    def test_rotations_are_composed(self):
+        roi = ROI((20.0,19.0,21.0,0.1,-0.2,0.3))
+        transformation = transformation_matrix_6DOF([1.0,-2.0,0.5,0.2,0.1,-0.25], [20.0,20.0,20.0])
+        moved = _moved_roi(roi, transformation)
+        expected = transformation.dot(transformation_matrix_6DOF([roi.x,roi.y,roi.z,roi.theta_x,roi.theta_y,roi.theta_z]))
+        matrix = transformation_matrix_6DOF([moved.x,moved.y,moved.z,moved.theta_x,moved.theta_y,moved.theta_z])
+        self.assertTrue(numpy.allclose(matrix, expected))
+
+    def test_parameters_6DOF(self):
+        parameters = numpy.float64([3.0,-1.0,2.0,0.4,-0.3,1.2])
+        self.assertTrue(numpy.allclose(parameters_6DOF(transformation_matrix_6DOF(parameters)), parameters))
+
+
+
+@unittest.skipIf(not has_NiftyCore, "NiftyCore is not installed")
+class TestROIConvention(unittest.TestCase):
+    # projecting the phantom moved by M with the ROI r, or the phantom with the ROI _moved_roi(r, M^-1), gives the
+    # same projection if _roi_matrix() has the sign and the order of the rotations of the projector
+    def setUp(self):
+        self.scan = PET_Static_Scan()
+        self.scan.set_interface(PET_Interface_Petlink32())
+        self.scan.set_binning(Binning(dict(DEFAULT_BINNING, n_axial=60, angular_step_axial=numpy.pi/60, n_azimuthal=5,
+                                           angular_step_azimuthal=0.05, size_u=128.0, size_v=64.0, n_u=64, n_v=32)))
+        self.scan.set_full_sampling()
+        self.scan.set_activity_shape([32,32,32])
+        self.scan.set_activity_size([64.0,64.0,64.0])
+
+    def _projection(self, activity, roi):
+        projection = self.scan.project(activity, roi_activity=roi)
+        return numpy.float64(getattr(projection,'data',projection))
+
+    def test_rotations(self):
+        shape, size = self.scan.activity_shape, self.scan.activity_size
+        roi = ROI((33.0,31.0,32.5,0.0,0.0,0.0))
+        center = 0.5*numpy.float64(size)
+        for parameters in [(0,0,0,0.3,0,0), (0,0,0,0,0.3,0), (0,0,0,0,0,0.3), (2.0,-1.0,1.5,0.2,-0.25,0.3)]:
+            motion = transformation_matrix_6DOF(parameters, center)
+            expected = self._projection(_moved_phantom(motion, shape, size), roi)
+            projection = self._projection(_moved_phantom(numpy.eye(4), shape, size), _moved_roi(roi, numpy.linalg.inv(motion)))
+            self.assertTrue(numpy.linalg.norm(projection-expected) < 0.05*numpy.linalg.norm(expected), parameters)
+
+
+
+class TestEstimateMotion(unittest.TestCase):
+    def test_rigid_motion(self):
+        # motion of the phantom in the scanner: rotation about the z axis and translation
+        motions = [numpy.eye(4), transformation_matrix_6DOF([2.0,-1.5,1.0,0,0,0]), transformation_matrix_6DOF([0.0,1.0,-1.0,0.0,0.0,0.15])]
+        scan = _Scan(motions)
+        estimated = scan.estimate_motion(reconstruct=_reconstruct, degrees_of_freedom=6, n_workers=1)
+        # the estimated transformation moves the frame onto the reference, about the center of the volume
+        center = 0.5*numpy.float64(SIZE)
+        shift = transformation_matrix_6DOF(center)
+        for motion, parameters in zip(motions, estimated):
+            expected = shift.dot(numpy.linalg.inv(motion)).dot(numpy.linalg.inv(shift))
+            transformation = transformation_matrix_6DOF(parameters, center)
+            self.assertTrue(numpy.allclose(transformation[0:3,0:3], expected[0:3,0:3], atol=0.03))
+            self.assertTrue(numpy.allclose(transformation[0:3,3], expected[0:3,3], atol=0.5))
+        # the time-of-flight projector does not rotate the ROIs: by default the ROIs are not set, and requesting
+        # them raises before anything is written
+        self.assertTrue(all(frame.roi_activity is None for frame in scan._dynamic))
+        self.assertRaises(UnexpectedParameter, scan.estimate_motion, reconstruct=_reconstruct, degrees_of_freedom=6, n_workers=1, set_roi=True)
+        self.assertTrue(all(frame.roi_activity is None for frame in scan._dynamic))
+
+    def test_translation_is_compensated(self):
+        translations = [(0.0,0.0,0.0), (2.0,-1.5,1.0), (-1.0,2.0,1.5)]
+        scan = _Scan([transformation_matrix_6DOF(t) for t in translations])
+        scan.estimate_motion(reconstruct=_reconstruct, degrees_of_freedom=3, n_workers=1, set_roi=True)
+        reference = _reconstruct(scan.static).data
+        for frame, translation in zip(scan._dynamic, translations):
+            roi = frame.get_roi_activity()
+            # the ROI is the position of the center of the scanner in the volume: it moves opposite to the phantom
+            self.assertTrue(numpy.allclose([roi.x,roi.y,roi.z], 0.5*numpy.float64(SIZE)-translation, atol=0.5))
+            self.assertEqual((roi.theta_x,roi.theta_y,roi.theta_z), (0,0,0))
+            # the frame is then reconstructed in the space of the reference
+            compensated = _reconstruct(frame).data
+            self.assertTrue(numpy.corrcoef(compensated.ravel(), reference.ravel())[0,1] > 0.98)
+
+
+
+if __name__ == '__main__':
+    unittest.main()
+
@@ -0,0 +1,90 @@
+
+# occiput
+# Stefano Pedemonte
+# Harvard University, Martinos Center for Biomedical Imaging
+# Boston, MA, USA
+
+# Tests of the CPU resampling functions (occiput.Core.Resampling), against scipy.ndimage.
+
+
+import unittest
+import numpy
+from occiput.Core.Resampling import TR_resample_grid, TR_resample_grid_batch, resample_axis_aligned, INTERPOLATION_LINEAR, INTERPOLATION_POINT
+try:
+    from scipy.ndimage import map_coordinates
+except ImportError:
+    has_scipy = False
+else:
+    has_scipy = True
+
+
+
+def _affine(random):
+    # rotation, scale and translation: voxel indexes of the image -> space of the grid
+    angles = random.uniform(-0.5,0.5,3)
+    c, s = numpy.cos(angles), numpy.sin(angles)
+    Rx = numpy.asarray([[1,0,0],[0,c[0],-s[0]],[0,s[0],c[0]]])
+    Ry = numpy.asarray([[c[1],0,s[1]],[0,1,0],[-s[1],0,c[1]]])
+    Rz = numpy.asarray([[c[2],-s[2],0],[s[2],c[2],0],[0,0,1]])
+    affine = numpy.eye(4)
+    affine[0:3,0:3] = Rz.dot(Ry).dot(Rx).dot(numpy.diag(random.uniform(0.5,2.0,3)))
+    affine[0:3,3] = random.uniform(-10,10,3)
+    return affine
+
+
+
+class TestResampleGrid(unittest.TestCase):
+    def setUp(self):
+        self.random = numpy.random.RandomState(0)
+        self.data = numpy.float32(self.random.rand(12,10,9))
+        self.affine = _affine(self.random)
+
+    def _grid(self, indexes):
+        # points of the grid (array [4,5,6,3]) at the given voxel indexes of the image
+        return (indexes.dot(self.affine[0:3,0:3].T) + self.affine[0:3,3]).reshape((4,5,6,3))
+
+    @unittest.skipIf(not has_scipy, "scipy is not installed")
+    def test_linear_matches_map_coordinates(self):
+        # points inside of the image, where the boundary conditions do not matter
+        indexes = self.random.uniform(0.5, numpy.float64(self.data.shape)-1.5, (120,3))
+        resampled = TR_resample_grid(self.data, self._grid(indexes), self.affine, 0.0, 0, INTERPOLATION_LINEAR, n_threads=2, slab_size=1)
+        expected = map_coordinates(numpy.float64(self.data), indexes.T, order=1).reshape((4,5,6))
+        self.assertTrue(numpy.allclose(resampled, expected, atol=1e-5))
+
+    @unittest.skipIf(not has_scipy, "scipy is not installed")
+    def test_nearest_matches_map_coordinates(self):
+        indexes = self.random.uniform(0.5, numpy.float64(self.data.shape)-1.5, (120,3))
+        resampled = TR_resample_grid(self.data, self._grid(indexes), self.affine, 0.0, 0, INTERPOLATION_POINT)
+        expected = map_coordinates(self.data, indexes.T, order=0).reshape((4,5,6))
+        self.assertTrue(numpy.allclose(resampled, expected))
+
+    def test_outside_is_background(self):
+        indexes = self.random.uniform(20, 30, (120,3))
+        resampled = TR_resample_grid(self.data, self._grid(indexes), self.affine, 2.5)
+        self.assertTrue(numpy.allclose(resampled, 2.5))
+
+    def test_axis_aligned_matches_general(self):
+        # axis-aligned affine: grid indexes -> voxel indexes of the image
+        affine = numpy.diag([0.7,1.3,0.9,1.0])
+        affine[0:3,3] = [-1.2,0.4,-0.6]
+        shape = (15,8,11)
+        indexes = numpy.rollaxis(numpy.mgrid[0:shape[0],0:shape[1],0:shape[2]],0,4)
+        expected = TR_resample_grid(self.data, numpy.float64(indexes), numpy.linalg.inv(affine), 1.5)
+        resampled = resample_axis_aligned(self.data, affine, shape, 1.5)
+        self.assertTrue(numpy.allclose(resampled, expected, atol=1e-5))
+
+    def test_batch_matches_single(self):
+        # several images and affines on the same grid, mixed interpolation modes
+        images = [self.data, numpy.float64(self.random.rand(7,9,8)), self.data[::-1]]
+        affines = [self.affine, _affine(self.random), numpy.eye(4)]
+        modes = [INTERPOLATION_LINEAR, INTERPOLATION_POINT, INTERPOLATION_LINEAR]
+        grid = self._grid(self.random.uniform(-2, 12, (120,3)))
+        resampled = TR_resample_grid_batch(images, grid, affines, 0.5, modes, n_threads=3, slab_size=1)
+        for data, affine, mode, r in zip(images, affines, modes, resampled):
+            self.assertTrue(numpy.allclose(r, TR_resample_grid(data, grid, affine, 0.5, 0, mode)))
+
+
+
+if __name__ == '__main__':
+    unittest.main()
+
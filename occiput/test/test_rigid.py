@@ -0,0 +1,82 @@
+
+# occiput
+# Stefano Pedemonte
+# Harvard University, Martinos Center for Biomedical Imaging
+# Boston, MA, USA
+
+# Tests of the rigid transformations of the registration and of their derivatives
+# (occiput.Registration.TranslationRotation.rigid).
+
+
+import unittest
+import numpy
+from occiput.Core import Image3D, Grid3D, Transform_Affine
+from occiput.Registration.TranslationRotation.rigid import transformation_matrix_6DOF, parameters_6DOF, rotation_jacobian_6DOF, derivative_intensity_6DOF, rigid_ssd
+
+
+
+def _blob(shape, center, width):
+    index = numpy.mgrid[0:shape[0],0:shape[1],0:shape[2]]
+    return numpy.float32(numpy.exp(-0.5*sum(((index[k]-center[k])/width[k])**2 for k in range(3))))
+
+
+
+class TestTransformation(unittest.TestCase):
+    def test_rotation_center_is_fixed(self):
+        center = numpy.float64([3.0,-2.0,5.0])
+        matrix = transformation_matrix_6DOF([0,0,0,0.3,-0.2,0.5], center)
+        self.assertTrue(numpy.allclose(matrix[0:3,0:3].dot(center) + matrix[0:3,3], center))
+
+    def test_parameters_6DOF(self):
+        parameters = numpy.float64([1.0,2.0,-3.0,-0.7,0.4,2.5])
+        self.assertTrue(numpy.allclose(parameters_6DOF(transformation_matrix_6DOF(parameters)), parameters))
+
+    def test_rotation_jacobian(self):
+        # dR R^T = [J dangles]_x, by finite differences
+        angles = numpy.float64([0.3,-0.2,0.5])
+        R = lambda a: transformation_matrix_6DOF(numpy.concatenate(([0,0,0],a)))[0:3,0:3]
+        J = rotation_jacobian_6DOF(angles)
+        eps = 1e-6
+        for k in range(3):
+            W = (R(angles+eps*numpy.eye(3)[k]) - R(angles-eps*numpy.eye(3)[k])).dot(R(angles).T) / (2*eps)
+            self.assertTrue(numpy.allclose([W[2,1],W[0,2],W[1,0]], J[:,k], atol=1e-6))
+
+
+
+class TestRigidGradient(unittest.TestCase):
+    # the analytic derivatives use the gradient of the resampled (linearly interpolated) image: they approximate
+    # the finite differences of the resampling, for smooth images
+    def setUp(self):
+        self.shape = (24,26,28)
+        self.source = _blob(self.shape, (11,13,12), (3.0,4.5,3.5))
+        self.target = _blob(self.shape, (12,12,14), (3.0,4.5,3.5))
+        self.center = (numpy.float64(self.shape)-1) / 2.0
+        self.parameters = numpy.float64([0.3,-0.2,0.4,0.05,-0.04,0.07])
+
+    def test_derivative_intensity(self):
+        grid = Grid3D(shape=self.shape, affine=numpy.eye(4))
+        source = Image3D(data=self.source)
+        resample = lambda p: numpy.float64(source.compute_resample_on_grid(grid, affine_grid_to_world=Transform_Affine(transformation_matrix_6DOF(p, self.center))).data)
+        resampled, gradient = source.compute_resample_and_gradient_on_grid(grid, affine_grid_to_world=Transform_Affine(transformation_matrix_6DOF(self.parameters, self.center)))
+        derivatives = derivative_intensity_6DOF(gradient, grid, self.parameters, self.center)
+        eps = 1e-3
+        for k, e in enumerate(numpy.eye(6)):
+            differences = (resample(self.parameters+eps*e) - resample(self.parameters-eps*e)) / (2*eps)
+            # the finite differences of the linear interpolation are not smooth: compare directions and scales
+            self.assertTrue((derivatives[k]*differences).sum() > 0.95*numpy.linalg.norm(derivatives[k])*numpy.linalg.norm(differences))
+            self.assertTrue(abs((derivatives[k]*differences).sum() / (differences**2).sum() - 1) < 0.15)
+
+    def test_rigid_ssd_gradient(self):
+        value, gradient = rigid_ssd(self.source, self.target, self.parameters, gradient=True)
+        self.assertAlmostEqual(value, rigid_ssd(self.source, self.target, self.parameters), 4)
+        eps = 1e-3
+        differences = numpy.float64([(rigid_ssd(self.source, self.target, self.parameters+eps*e) - rigid_ssd(self.source, self.target, self.parameters-eps*e)) / (2*eps) for e in numpy.eye(6)])
+        # direction of ascent
+        self.assertTrue(gradient.dot(differences) > 0.98*numpy.linalg.norm(gradient)*numpy.linalg.norm(differences))
+        self.assertTrue(numpy.allclose(gradient[0:3], differences[0:3], rtol=0.1))
+
+
+
+if __name__ == '__main__':
+    unittest.main()
+
@@ -0,0 +1,85 @@
+
+# occiput
+# Stefano Pedemonte
+# Harvard University, Martinos Center for Biomedical Imaging
+# Boston, MA, USA
+
+# Tests of the time-of-flight projector and backprojector (occiput.Reconstruction.PET.PET_tof).
+
+
+import unittest
+import numpy
+from occiput.Reconstruction.PET.PET_tof import PET_project_tof, PET_backproject_tof, tof_kernel, tof_bin_centers, lor_geometry, sample_step_of
+
+
+SHAPE    = (10,12,8)
+SIZE     = (30.0,36.0,20.0)                  # [mm]
+N_TOF    = 5
+SIZE_TOF = 60.0
+TOF_FWHM = 15.0
+
+
+
+def _lines_of_response(random, n):
+    return random.uniform(0,numpy.pi,n), random.uniform(-0.5,0.5,n), random.uniform(-15,15,n), random.uniform(-10,10,n)
+
+
+
+class TestProjectorTOF(unittest.TestCase):
+    def setUp(self):
+        self.random = numpy.random.RandomState(0)
+        self.lines = _lines_of_response(self.random, 300)
+        # the volume is not centered in the scanner
+        self.center = (14.0,19.0,9.0)
+
+    def _adjointness(self, attenuation):
+        activity = numpy.float32(self.random.rand(*SHAPE))
+        data = numpy.float32(self.random.rand(N_TOF,self.lines[0].size))
+        projection = PET_project_tof(activity, SIZE, self.center, attenuation, SIZE, self.center, *(self.lines+(N_TOF,SIZE_TOF,TOF_FWHM)), block_size=64)
+        backprojection = PET_backproject_tof(data, SHAPE, SIZE, self.center, attenuation, SIZE, self.center, *(self.lines+(N_TOF,SIZE_TOF,TOF_FWHM)), block_size=64)
+        # <Ax, y> == <x, A^T y>
+        self.assertAlmostEqual((numpy.float64(projection)*data).sum() / (numpy.float64(activity)*backprojection).sum(), 1.0, 5)
+
+    def test_adjointness(self):
+        self._adjointness(None)
+
+    def test_adjointness_attenuation(self):
+        self._adjointness(numpy.float32(0.01*self.random.rand(*SHAPE)))
+
+    def test_tof_bins_sum_to_non_tof(self):
+        # the weights of the TOF bins of a point in the field of view sum to 1 (the TOF bins cover the volume)
+        activity = numpy.float32(self.random.rand(*SHAPE))
+        tof = PET_project_tof(activity, SIZE, self.center, None, SIZE, self.center, *(self.lines+(N_TOF,SIZE_TOF,TOF_FWHM)))
+        non_tof = PET_project_tof(activity, SIZE, self.center, None, SIZE, self.center, *(self.lines+(1,SIZE_TOF,TOF_FWHM)))
+        self.assertTrue(numpy.allclose(tof.sum(0), non_tof[0], rtol=0.02, atol=1e-3*non_tof.max()))
+
+    def test_line_integral(self):
+        # uniform volume, line along the y axis through the volume: the integral is the length of the chord
+        activity = numpy.ones(SHAPE,dtype=numpy.float32)
+        projection = PET_project_tof(activity, SIZE, self.center, None, SIZE, self.center, [0.0], [0.0], [0.0], [0.0], 1, SIZE_TOF, TOF_FWHM)
+        # (the interpolated volume decays linearly to 0 over one voxel beyond the outer voxel centers)
+        self.assertAlmostEqual(projection[0,0] / SIZE[1], 1.0, 2)
+
+    def test_tof_origin_is_lor_midpoint(self):
+        # oblique LOR (theta=0): the midpoint between the detectors is at y=0, z=v/cos(phi); a blob at distance 10 mm
+        # from it along the LOR is at TOF coordinate 10 (v*tan(phi) = 2.3 mm less than from the orthogonal plane)
+        phi, v = 0.28, 8.0
+        points, directions = lor_geometry([0.0], [phi], [0.0], [v])
+        self.assertTrue(numpy.allclose(points[0], [0.0, 0.0, v/numpy.cos(phi)]))
+        shape, size = (40,40,40), (40.0,40.0,40.0)
+        center = numpy.float64(size)/2
+        position = center + points[0] + 10.0*directions[0]
+        voxels = (numpy.rollaxis(numpy.mgrid[0:40,0:40,0:40],0,4) + 0.5) * numpy.float64(size)/shape
+        blob = numpy.float32(numpy.exp(-0.5*((voxels-position)**2).sum(-1)/1.5**2))
+        projection = PET_project_tof(blob, size, center, None, size, center, [0.0], [phi], [0.0], [v], 41, 82.0, 6.0)[:,0]
+        self.assertAlmostEqual((tof_bin_centers(41, 82.0)*projection).sum() / projection.sum(), 10.0, 1)
+
+    def test_sample_step(self):
+        self.assertEqual(sample_step_of(SIZE, SHAPE), 0.5*min(numpy.float64(SIZE)/SHAPE))
+        self.assertTrue(numpy.allclose(tof_kernel(numpy.linspace(-10,10,7), N_TOF, SIZE_TOF, TOF_FWHM).sum(0), 1.0, rtol=0.01))
+
+
+
+if __name__ == '__main__':
+    unittest.main()
+